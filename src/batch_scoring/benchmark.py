@@ -0,0 +1,110 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Throughput benchmark for the batch scoring job.
+
+Scores a sample of users with each number of workers and model batch size,
+and reports the scored user x movie rows per second. For example:
+
+    python -m src.batch_scoring.benchmark --model-dir model \
+        --transform-workflow-dir transform_workflow \
+        --num-workers 1,4,8 --batch-sizes 16384,65536
+"""
+
+import sys
+import json
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from src.batch_scoring import scorer
+
+NUM_USERS = 2000
+RANDOM_STATE = 42
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--model-dir", required=True, type=str)
+
+    parser.add_argument("--transform-workflow-dir", required=True, type=str)
+
+    parser.add_argument("--num-users", type=int, default=NUM_USERS)
+
+    parser.add_argument("--num-workers", type=str, default="1,2,4")
+
+    parser.add_argument("--batch-sizes", type=str, default=str(scorer.BATCH_SIZE))
+
+    parser.add_argument("--num-candidates", type=int, default=None)
+
+    parser.add_argument("--top-n", type=int, default=scorer.TOP_N)
+
+    parser.add_argument(
+        "--memory-budget-mb", type=int, default=scorer.MEMORY_BUDGET_MB
+    )
+
+    parser.add_argument("--output-file", type=str, default=None)
+
+    return parser.parse_args()
+
+
+def run(args):
+    users = scorer.encode_users(args.transform_workflow_dir)
+    if args.num_users < len(users):
+        users = np.sort(
+            np.random.RandomState(RANDOM_STATE).choice(
+                users, args.num_users, replace=False
+            )
+        )
+
+    results = []
+    for num_workers in [int(value) for value in args.num_workers.split(",")]:
+        for batch_size in [int(value) for value in args.batch_sizes.split(",")]:
+            output_dir = tempfile.mkdtemp()
+            stats = scorer.run(
+                args.model_dir,
+                args.transform_workflow_dir,
+                output_dir,
+                users,
+                num_workers=num_workers,
+                # One shard per worker, so that all of them are busy.
+                users_per_shard=-(-len(users) // num_workers),
+                memory_budget_mb=args.memory_budget_mb,
+                top_n=args.top_n,
+                batch_size=batch_size,
+                num_candidates=args.num_candidates,
+            )
+            tf.io.gfile.rmtree(output_dir)
+            result = {"batch_size": batch_size, **stats}
+            logging.info(
+                f"num_workers={num_workers} batch_size={batch_size}: "
+                f"{result['rows_per_second']:.0f} rows/s"
+            )
+            results.append(result)
+
+    if args.output_file:
+        with tf.io.gfile.GFile(args.output_file, "w") as file:
+            json.dump(results, file, indent=2)
+        logging.info(f"Benchmark results are written to {args.output_file}.")
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Python Version = {sys.version}")
+    logging.info(f"TensorFlow Version = {tf.__version__}")
+    run(get_args())
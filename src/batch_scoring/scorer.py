@@ -0,0 +1,270 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batch scoring of users x candidate movies with the saved Keras model.
+
+The users are split into shards, scored by a pool of processes that each load
+the model once, and the top-N movies of each user are written to one parquet
+file per shard. The ids are encoded with the vocabularies of the transform
+workflow directly, without running it, since the model inputs are only the
+encoded ids and the genres of the movies.
+"""
+
+import os
+import time
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow.io as tf_io
+
+from src.common import categories, multihot, utils
+from src.common.movie_features import MovieFeatureTable
+from src.retrieval.artifact import get_item_ids
+from src.retrieval.index import top_k
+
+TOP_N = 20
+BATCH_SIZE = 1024 * 64
+MEMORY_BUDGET_MB = 2048
+USERS_PER_SHARD = 10000
+COMPRESSION = "snappy"
+# The ids and genres of one scored pair, besides the activations of the model.
+INPUT_ROW_BYTES = 64
+# Bytes of one scored pair outside the model: its int64 user and movie rows,
+# its score, the negated copy and the int64 index of the top-N selection.
+PAIR_BYTES = 32
+# Bytes of one top-N movie of a user: its position and score, and their copies
+# in the parquet columns.
+RESULT_BYTES = 24
+
+
+def get_row_bytes(recommendation_model):
+    # Bytes of one scored pair while the model runs: its inputs and the float32
+    # activations of every layer.
+    width = 0
+    for layer in recommendation_model.layers:
+        output_shape = layer.output_shape
+        if isinstance(output_shape, tuple) and output_shape[-1]:
+            width += output_shape[-1]
+    return INPUT_ROW_BYTES + 4 * width
+
+
+class BatchScorer:
+    # Scores chunks of users against the num_candidates most frequent movies.
+    # Categorify encodes by descending frequency, so these are the movies
+    # encoded as 1..num_candidates, all of them by default. Half of the memory
+    # budget bounds the pairs of a model batch, the other half the top-N
+    # movies of a chunk of users, which is written as one row group.
+
+    def __init__(
+        self,
+        model_dir,
+        workflow_dir,
+        top_n=TOP_N,
+        batch_size=BATCH_SIZE,
+        memory_budget_bytes=MEMORY_BUDGET_MB * 1024 ** 2,
+        num_candidates=None,
+    ):
+        from src.model_training import evaluation
+
+        self._evaluation = evaluation
+        self.model = evaluation.load_model(model_dir)
+        self.movie_features = MovieFeatureTable.load(workflow_dir)
+        self.user_ids = categories.read_categories(workflow_dir, "userId")
+        self.movie_ids = get_item_ids(workflow_dir)
+        num_movies = self.movie_features.num_movies - 1
+        self.candidates = np.arange(
+            1, min(num_candidates or num_movies, num_movies) + 1
+        )
+        self.top_n = min(top_n, len(self.candidates))
+
+        row_bytes = get_row_bytes(self.model) + PAIR_BYTES
+        self.batch_size = max(
+            1, min(batch_size, memory_budget_bytes // 2 // row_bytes)
+        )
+        self.users_per_chunk = max(
+            1, memory_budget_bytes // 2 // (RESULT_BYTES * self.top_n)
+        )
+
+    def score(self, users):
+        # Returns the candidate positions and scores of the top-N movies of each
+        # encoded user. At most batch_size pairs are held at a time: groups of
+        # users are scored against blocks of candidates, and the top-N of each
+        # block is merged into the running top-N of the group.
+        num_candidates = len(self.candidates)
+        block_size = min(num_candidates, self.batch_size)
+        group_size = max(1, self.batch_size // block_size)
+        positions = np.empty((len(users), self.top_n), dtype=np.int64)
+        scores = np.empty((len(users), self.top_n), dtype=np.float32)
+        for group_start in range(0, len(users), group_size):
+            group = users[group_start : group_start + group_size]
+            best_positions = np.empty((len(group), 0), dtype=np.int64)
+            best_scores = np.empty((len(group), 0), dtype=np.float32)
+            for block_start in range(0, num_candidates, block_size):
+                block = np.arange(
+                    block_start, min(block_start + block_size, num_candidates)
+                )
+                block_scores = self._evaluation.predict(
+                    self.model,
+                    np.repeat(group, len(block)),
+                    np.tile(self.candidates[block], len(group)),
+                    self.movie_features,
+                ).reshape(len(group), len(block))
+                block_positions, block_scores = top_k(block_scores, self.top_n)
+                merged_positions = np.concatenate(
+                    [best_positions, block[block_positions]], axis=1
+                )
+                order, best_scores = top_k(
+                    np.concatenate([best_scores, block_scores], axis=1), self.top_n
+                )
+                best_positions = np.take_along_axis(merged_positions, order, axis=1)
+            group_rows = slice(group_start, group_start + len(group))
+            positions[group_rows] = best_positions
+            scores[group_rows] = best_scores
+        return positions, scores
+
+    def score_shard(self, users, output_file):
+        # Scores the encoded users of a shard chunk by chunk, and writes one row
+        # group per chunk. Returns the number of users and of scored pairs, and
+        # the seconds spent, without the start of the worker.
+        start_time = time.time()
+        schema = pa.schema(
+            [
+                ("userId", pa.int64()),
+                ("movieIds", pa.list_(pa.int64())),
+                ("scores", pa.list_(pa.float32())),
+            ]
+        )
+        with utils.open_arrow_file(output_file, "wb") as file:
+            with pq.ParquetWriter(file, schema, compression=COMPRESSION) as writer:
+                for start in range(0, len(users), self.users_per_chunk):
+                    chunk = users[start : start + self.users_per_chunk]
+                    positions, scores = self.score(chunk)
+                    offsets = multihot.lengths_to_offsets(
+                        np.full(len(chunk), self.top_n)
+                    )
+                    table = pa.Table.from_arrays(
+                        [
+                            pa.array(self.user_ids[chunk].astype(np.int64)),
+                            multihot.to_list_array(
+                                self.movie_ids[self.candidates[positions]].reshape(-1),
+                                offsets,
+                            ),
+                            multihot.to_list_array(
+                                scores.astype(np.float32).reshape(-1), offsets
+                            ),
+                        ],
+                        schema=schema,
+                    )
+                    writer.write_table(table)
+        return (
+            len(users),
+            len(users) * len(self.candidates),
+            time.time() - start_time,
+        )
+
+
+_scorer = None
+
+
+def _init_worker(scorer_kwargs, num_threads):
+    global _scorer
+    import tensorflow as tf
+
+    # The cores are shared by the processes of the pool.
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _scorer = BatchScorer(**scorer_kwargs)
+
+
+def _score_shard(task):
+    users, output_file = task
+    return _scorer.score_shard(users, output_file)
+
+
+def encode_users(workflow_dir, raw_user_ids=None):
+    # Encoded ids of the given raw user ids, or of all the users of the
+    # vocabulary. Unknown users are dropped.
+    vocabulary = categories.read_categories(workflow_dir, "userId")
+    if raw_user_ids is None:
+        return np.arange(1, len(vocabulary))
+    positions = pd.Index(vocabulary[1:].astype(np.int64)).get_indexer(
+        np.asarray(raw_user_ids)
+    )
+    return np.unique(positions[positions >= 0] + 1)
+
+
+def run(
+    model_dir,
+    workflow_dir,
+    output_dir,
+    users,
+    num_workers=None,
+    users_per_shard=USERS_PER_SHARD,
+    memory_budget_mb=MEMORY_BUDGET_MB,
+    **scorer_kwargs,
+):
+    # Scores the encoded users with a pool of num_workers processes, each with
+    # an equal part of the memory budget. Returns the scoring stats.
+    num_workers = num_workers or os.cpu_count()
+    tf_io.gfile.makedirs(output_dir)
+    tasks = [
+        (
+            users[start : start + users_per_shard],
+            os.path.join(output_dir, f"part-{index:05d}.parquet"),
+        )
+        for index, start in enumerate(range(0, len(users), users_per_shard))
+    ]
+    scorer_kwargs.update(
+        model_dir=model_dir,
+        workflow_dir=workflow_dir,
+        memory_budget_bytes=memory_budget_mb * 1024 ** 2 // num_workers,
+    )
+
+    start_time = time.time()
+    num_users, num_rows, worker_seconds = 0, 0, 0.0
+    # Spawned processes do not inherit the TensorFlow state of the parent.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        num_workers,
+        initializer=_init_worker,
+        initargs=(scorer_kwargs, max(1, os.cpu_count() // num_workers)),
+    ) as pool:
+        for shard_users, shard_rows, shard_seconds in pool.imap_unordered(
+            _score_shard, tasks
+        ):
+            num_users += shard_users
+            num_rows += shard_rows
+            worker_seconds += shard_seconds
+            logging.info(f"Scored {num_users}/{len(users)} users.")
+    seconds = time.time() - start_time
+
+    stats = {
+        "users": num_users,
+        "shards": len(tasks),
+        "scored_rows": num_rows,
+        "seconds": seconds,
+        "rows_per_second": num_rows / max(seconds, 1e-9),
+        # Without loading the model in each worker.
+        "scoring_rows_per_second": num_rows
+        / max(worker_seconds / num_workers, 1e-9),
+        "num_workers": num_workers,
+    }
+    logging.info(
+        f"Scored {num_rows} pairs of {num_users} users in {seconds:.1f}s "
+        f"({stats['rows_per_second']:.0f} rows/s)."
+    )
+    return stats
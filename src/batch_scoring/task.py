@@ -0,0 +1,122 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The entrypoint for the offline batch scoring job.
+
+Writes the top-N movies of each user, as scored by the saved Keras model, to
+sharded parquet files with the columns userId, movieIds and scores. For
+example:
+
+    python -m src.batch_scoring.task --model-dir model \
+        --transform-workflow-dir transform_workflow \
+        --output-dir recommendations --top-n 20 --num-workers 8
+"""
+
+import sys
+import json
+import logging
+import argparse
+
+import pandas as pd
+import tensorflow as tf
+
+from src.batch_scoring import scorer
+from src.common import utils
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--model-dir", required=True, type=str)
+
+    parser.add_argument("--transform-workflow-dir", required=True, type=str)
+
+    parser.add_argument("--output-dir", required=True, type=str)
+
+    parser.add_argument(
+        "--users-file",
+        default=None,
+        type=str,
+        help="Parquet or CSV file with the userId column of the users to score. "
+        "All the users of the workflow are scored by default.",
+    )
+
+    parser.add_argument("--top-n", default=scorer.TOP_N, type=int)
+
+    parser.add_argument(
+        "--num-candidates",
+        default=None,
+        type=int,
+        help="Only score the most frequent movies. All the movies by default.",
+    )
+
+    parser.add_argument("--batch-size", default=scorer.BATCH_SIZE, type=int)
+
+    parser.add_argument(
+        "--memory-budget-mb",
+        default=scorer.MEMORY_BUDGET_MB,
+        type=int,
+        help="Memory for the scores and model batches, shared by the workers.",
+    )
+
+    parser.add_argument(
+        "--num-workers",
+        default=None,
+        type=int,
+        help="Scoring processes. The number of CPUs by default.",
+    )
+
+    parser.add_argument("--users-per-shard", default=scorer.USERS_PER_SHARD, type=int)
+
+    parser.add_argument("--stats-file", default=None, type=str)
+
+    return parser.parse_args()
+
+
+def read_user_ids(users_file):
+    if users_file.endswith(".csv"):
+        with tf.io.gfile.GFile(users_file, "r") as file:
+            return pd.read_csv(file, usecols=["userId"])["userId"].values
+    with utils.open_arrow_file(users_file) as file:
+        return pd.read_parquet(file, columns=["userId"])["userId"].values
+
+
+def main():
+    args = get_args()
+    raw_user_ids = read_user_ids(args.users_file) if args.users_file else None
+    users = scorer.encode_users(args.transform_workflow_dir, raw_user_ids)
+    logging.info(f"Scoring {len(users)} users...")
+    stats = scorer.run(
+        args.model_dir,
+        args.transform_workflow_dir,
+        args.output_dir,
+        users,
+        num_workers=args.num_workers,
+        users_per_shard=args.users_per_shard,
+        memory_budget_mb=args.memory_budget_mb,
+        top_n=args.top_n,
+        batch_size=args.batch_size,
+        num_candidates=args.num_candidates,
+    )
+    if args.stats_file:
+        with tf.io.gfile.GFile(args.stats_file, "w") as file:
+            json.dump(stats, file, indent=2)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Python Version = {sys.version}")
+    logging.info(f"TensorFlow Version = {tf.__version__}")
+    logging.info(f"Task started...")
+    main()
+    logging.info(f"Task completed.")
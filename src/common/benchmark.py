@@ -0,0 +1,135 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Throughput benchmark for the directory transfers of common utils.
+
+Copies a directory with each number of workers, first into an empty
+destination and then again into the copied one, where every file is skipped,
+and reports bytes/s and files/s of both. The source is a directory of random
+files written to local disk by default, so it runs without cloud storage. For
+example:
+
+    python -m src.common.benchmark --num-files 200 --file-size-mb 4 \
+        --num-workers 1,4,16
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import tensorflow.io as tf_io
+
+from src.common import utils
+
+NUM_FILES = 100
+FILE_SIZE_MB = 4
+RANDOM_STATE = 42
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--source-dir",
+        type=str,
+        default=None,
+        help="Directory to copy. Random local files are written by default.",
+    )
+
+    parser.add_argument(
+        "--destination-dir",
+        type=str,
+        default=None,
+        help="Where the copies are written. A local temporary directory by default.",
+    )
+
+    parser.add_argument("--num-files", type=int, default=NUM_FILES)
+
+    parser.add_argument("--file-size-mb", type=float, default=FILE_SIZE_MB)
+
+    parser.add_argument(
+        "--num-workers", type=str, default=str(utils.NUM_TRANSFER_WORKERS)
+    )
+
+    parser.add_argument("--output-file", type=str, default=None)
+
+    return parser.parse_args()
+
+
+def write_files(source_dir, num_files, file_size_bytes):
+    random_state = np.random.RandomState(RANDOM_STATE)
+    for file_index in range(num_files):
+        with open(os.path.join(source_dir, f"file-{file_index:05d}.bin"), "wb") as file:
+            file.write(random_state.bytes(file_size_bytes))
+
+
+def get_result(stats):
+    return {
+        "files_copied": stats.files_copied,
+        "files_skipped": stats.files_skipped,
+        "bytes_copied": stats.bytes_copied,
+        "seconds": stats.elapsed_seconds,
+        "bytes_per_second": stats.bytes_per_second,
+        "files_per_second": stats.files_per_second,
+    }
+
+
+def run(args):
+    source_dir = args.source_dir
+    if not source_dir:
+        source_dir = tempfile.mkdtemp()
+        write_files(source_dir, args.num_files, int(args.file_size_mb * 1024 ** 2))
+
+    results = []
+    for num_workers in [int(value) for value in args.num_workers.split(",")]:
+        destination_dir = os.path.join(
+            args.destination_dir or tempfile.mkdtemp(), f"workers_{num_workers}"
+        )
+        if tf_io.gfile.exists(destination_dir):
+            tf_io.gfile.rmtree(destination_dir)
+        result = {
+            "num_workers": num_workers,
+            "copy": get_result(
+                utils.upload_directory(source_dir, destination_dir, num_workers)
+            ),
+            # Every file is checked and skipped, as when a transfer resumes.
+            "resume": get_result(
+                utils.upload_directory(source_dir, destination_dir, num_workers)
+            ),
+        }
+        tf_io.gfile.rmtree(destination_dir)
+        logging.info(
+            f"num_workers={num_workers}: "
+            f"{result['copy']['bytes_per_second'] / 1e6:.1f} MB/s, "
+            f"{result['copy']['files_per_second']:.1f} files/s, resumed in "
+            f"{result['resume']['seconds']:.2f}s"
+        )
+        results.append(result)
+
+    if not args.source_dir:
+        tf_io.gfile.rmtree(source_dir)
+    if args.output_file:
+        with tf_io.gfile.GFile(args.output_file, "w") as file:
+            json.dump(results, file, indent=2)
+        logging.info(f"Benchmark results are written to {args.output_file}.")
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Python Version = {sys.version}")
+    run(get_args())
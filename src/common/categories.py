@@ -0,0 +1,120 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Categorify vocabulary files utils.
+
+A fitted Categorify op stores the vocabulary of each column in
+categories/unique.<column>.parquet under the workflow directory. Row i of the
+file holds the raw value encoded as i, and row 0 holds null, to which unknown
+values are encoded. With a frequency threshold, incremental runs keep the
+counts of the values not added yet in categories/pending.<column>.parquet.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow.io as tf_io
+
+from src.common import utils
+
+CATEGORIES_DIR = "categories"
+
+
+def get_categories_file(workflow_dir, column):
+    return os.path.join(workflow_dir, CATEGORIES_DIR, f"unique.{column}.parquet")
+
+
+def read_categories(workflow_dir, column):
+
+    with utils.open_arrow_file(get_categories_file(workflow_dir, column)) as file:
+        table = pq.read_table(file, columns=[column])
+    return table.column(column).to_pandas().values
+
+
+def write_categories(workflow_dir, column, values):
+
+    categories_file = get_categories_file(workflow_dir, column)
+    tf_io.gfile.makedirs(os.path.dirname(categories_file))
+    # Row 0 is null, to which unknown values are encoded.
+    column_values = pa.concat_arrays(
+        [pa.nulls(1, type=pa.array(values).type), pa.array(values)]
+    )
+    with utils.open_arrow_file(categories_file, "wb") as file:
+        pq.write_table(pa.Table.from_arrays([column_values], names=[column]), file)
+
+
+def extend_categories(workflow_dir, column, values):
+    # Appends the unseen values at the end of the vocabulary, so the existing
+    # values keep their encoding.
+    categories_file = get_categories_file(workflow_dir, column)
+    with utils.open_arrow_file(categories_file) as file:
+        table = pq.read_table(file)
+
+    existing_values = table.column(column).to_pandas().values[1:]
+    new_values = np.setdiff1d(np.unique(values), existing_values.astype(values.dtype))
+    if not len(new_values):
+        return 0
+
+    # Any other column of the file (e.g. value counts) is padded with nulls.
+    extended_columns = []
+    for field in table.schema:
+        if field.name == column:
+            new_chunk = pa.array(new_values, type=field.type)
+        else:
+            new_chunk = pa.nulls(len(new_values), type=field.type)
+        extended_columns.append(
+            pa.concat_arrays(table.column(field.name).chunks + [new_chunk])
+        )
+
+    with utils.open_arrow_file(categories_file, "wb") as file:
+        pq.write_table(pa.Table.from_arrays(extended_columns, schema=table.schema), file)
+    return len(new_values)
+
+
+def get_pending_counts_file(workflow_dir, column):
+    return os.path.join(workflow_dir, CATEGORIES_DIR, f"pending.{column}.parquet")
+
+
+def select_frequent(workflow_dir, column, values, freq_threshold):
+    # Returns the new values seen at least freq_threshold times, counting
+    # their occurrences in the previous incremental runs too. The counts of
+    # the other new values are kept for the next runs, so rare values are
+    # never added, as in the full run. Values that the full run left out
+    # start from a count of 0.
+    existing_values = read_categories(workflow_dir, column)[1:]
+    counts = pd.Series(values).value_counts()
+    counts = counts[~counts.index.isin(existing_values.astype(counts.index.dtype))]
+
+    pending_counts_file = get_pending_counts_file(workflow_dir, column)
+    if tf_io.gfile.exists(pending_counts_file):
+        with utils.open_arrow_file(pending_counts_file) as file:
+            pending = pq.read_table(file).to_pandas()
+        counts = counts.add(
+            pd.Series(pending["count"].values, index=pending[column].values),
+            fill_value=0,
+        )
+
+    is_frequent = counts >= freq_threshold
+    pending = counts[~is_frequent]
+    with utils.open_arrow_file(pending_counts_file, "wb") as file:
+        pq.write_table(
+            pa.Table.from_arrays(
+                [pa.array(pending.index.values), pa.array(pending.values, pa.int64())],
+                names=[column, "count"],
+            ),
+            file,
+        )
+    return counts.index.values[is_frequent.values]
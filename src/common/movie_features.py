@@ -0,0 +1,97 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Movie features table keyed by encoded movie id."""
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import tensorflow.io as tf_io
+
+from src.common import categories, multihot
+
+MOVIE_FEATURES_FILE = "movie_features.npz"
+
+
+class MovieFeatureTable:
+    # Holds the encoded genres of every movie in CSR layout, where row i is the
+    # movie encoded as i. Row 0, the unknown movie, has no genres. Fetching the
+    # genres of a batch of movies is then an array gather instead of a join.
+
+    def __init__(self, genre_values, genre_offsets):
+        self.genre_values = genre_values
+        self.genre_offsets = genre_offsets
+
+    @property
+    def num_movies(self):
+        return len(self.genre_offsets) - 1
+
+    @classmethod
+    def build(cls, movies_dataframe, movie_vocabulary, genre_vocabulary):
+        if hasattr(movies_dataframe, "to_pandas"):
+            movies_dataframe = movies_dataframe.to_pandas()
+        genre_values, genre_offsets = multihot.encode_multivalue(
+            movies_dataframe["genres"], genre_vocabulary
+        )
+
+        # Movies that are not in the vocabulary are encoded as 0 and dropped,
+        # so their ratings get no genres. The JoinExternal of the NVTabular
+        # workflow that Triton runs joins the genres on the raw movie id
+        # instead, and keeps them.
+        movie_positions = pd.Index(movie_vocabulary).get_indexer(
+            movies_dataframe["movieId"].values
+        )
+        table_rows = np.full(len(movie_vocabulary) + 1, -1, dtype=np.int64)
+        is_known = movie_positions >= 0
+        table_rows[movie_positions[is_known] + 1] = np.flatnonzero(is_known)
+
+        values, nnzs = multihot.gather_rows(genre_values, genre_offsets, table_rows)
+        return cls(values, multihot.lengths_to_offsets(nnzs))
+
+    @classmethod
+    def from_workflow_categories(cls, workflow_dir, movies_dataframe):
+        return cls.build(
+            movies_dataframe,
+            categories.read_categories(workflow_dir, "movieId")[1:].astype(np.int64),
+            categories.read_categories(workflow_dir, "genres")[1:],
+        )
+
+    def gather(self, encoded_movie_ids):
+        # Returns the genres__values and genres__nnzs of the given movies.
+        encoded_movie_ids = np.asarray(encoded_movie_ids).reshape(-1)
+        encoded_movie_ids = np.where(
+            encoded_movie_ids < self.num_movies, encoded_movie_ids, 0
+        )
+        return multihot.gather_rows(
+            self.genre_values, self.genre_offsets, encoded_movie_ids
+        )
+
+    def save(self, workflow_dir):
+        buffer = io.BytesIO()
+        np.savez(
+            buffer, genre_values=self.genre_values, genre_offsets=self.genre_offsets
+        )
+        with tf_io.gfile.GFile(
+            os.path.join(workflow_dir, MOVIE_FEATURES_FILE), "wb"
+        ) as file:
+            file.write(buffer.getvalue())
+
+    @classmethod
+    def load(cls, workflow_dir):
+        with tf_io.gfile.GFile(
+            os.path.join(workflow_dir, MOVIE_FEATURES_FILE), "rb"
+        ) as file:
+            arrays = np.load(io.BytesIO(file.read()))
+            return cls(arrays["genre_values"], arrays["genre_offsets"])
@@ -0,0 +1,86 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Multi-hot features in CSR layout.
+
+A multi-hot column of n rows is held as a flat values array and an offsets
+array of n + 1 entries, where the values of row i are
+values[offsets[i]:offsets[i + 1]]. This is the layout of the
+<feature>__values / <feature>__nnzs model inputs and of Arrow list arrays.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+SEPARATOR = "|"
+
+
+def lengths_to_offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def split_multivalue(column, separator=SEPARATOR):
+    # Returns the flat tokens and the offsets of a column of either separated
+    # strings or lists, without creating an object per row.
+    column = pd.Series(column).reset_index(drop=True)
+    values = column.dropna()
+    if len(values.index) and not isinstance(values.iloc[0], str):
+        lengths = column.str.len().fillna(0).astype(np.int64).values
+        tokens = np.concatenate([np.asarray(row, dtype=object) for row in values])
+        return tokens, lengths_to_offsets(lengths)
+
+    column = column.fillna("")
+    tokens = np.array(separator.join(column.values).split(separator), dtype=object)
+    token_rows = np.repeat(
+        np.arange(len(column.index)), column.str.count(f"\\{separator}").values + 1
+    )
+    # Empty strings produce one empty token, which is dropped.
+    is_token = tokens != ""
+    lengths = np.bincount(token_rows[is_token], minlength=len(column.index))
+    return tokens[is_token], lengths_to_offsets(lengths)
+
+
+def encode_tokens(tokens, vocabulary):
+    # Encodes each token to 1 + its position in the vocabulary, and unknown
+    # tokens to 0.
+    positions = pd.Index(vocabulary).get_indexer(tokens)
+    return np.where(positions >= 0, positions + 1, 0).astype(np.int32)
+
+
+def encode_multivalue(column, vocabulary, separator=SEPARATOR):
+    tokens, offsets = split_multivalue(column, separator)
+    return encode_tokens(tokens, vocabulary), offsets
+
+
+def gather_rows(values, offsets, rows):
+    # Gathers the given rows of a CSR column, e.g. the genres of the movie of each
+    # rating. Rows equal to -1 get no values. Returns the values and the nnzs.
+    rows = np.asarray(rows)
+    starts = offsets[rows]
+    nnzs = offsets[rows + 1] - starts
+    nnzs[rows < 0] = 0
+
+    row_offsets = lengths_to_offsets(nnzs)
+    positions = (
+        np.arange(row_offsets[-1])
+        - np.repeat(row_offsets[:-1], nnzs)
+        + np.repeat(starts, nnzs)
+    )
+    return values[positions], nnzs
+
+
+def to_list_array(values, offsets):
+    return pa.ListArray.from_arrays(pa.array(offsets.astype(np.int32)), pa.array(values))
@@ -14,51 +14,216 @@
 """Common utilities."""
 
 import os
+import time
+import base64
+import hashlib
+import logging
+import functools
+import contextlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import tensorflow.io as tf_io
 
+NUM_TRANSFER_WORKERS = 16
+MAX_TRANSFER_ATTEMPTS = 3
+CHECKSUM_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class TransferStats(
+    namedtuple(
+        "TransferStats",
+        ["files_copied", "files_skipped", "bytes_copied", "elapsed_seconds"],
+    )
+):
+    @property
+    def bytes_per_second(self):
+        return self.bytes_copied / max(self.elapsed_seconds, 1e-9)
+
+    @property
+    def files_per_second(self):
+        return self.files_copied / max(self.elapsed_seconds, 1e-9)
 
-def upload_directory(source_dir, destination_dir):
 
-    stack = [source_dir]
-    while stack:
-        current = stack.pop()
-        if tf_io.gfile.isdir(current):
-            for next_item in tf_io.gfile.listdir(current):
-                stack.append(os.path.join(current, next_item))
-        else:
-            x = current.replace(source_dir + "/", "")
-            dist = os.path.join(destination_dir, x)
-            tf_io.gfile.copy(current, dist, overwrite=True)
+@functools.lru_cache(maxsize=None)
+def _get_storage_client():
+    from google.cloud import storage
 
+    return storage.Client()
 
-def download_directory(source_dir, destination_dir):
 
-    source_stack = [source_dir]
-    destination_stack = [destination_dir]
+def _file_checksum(path):
+    # The md5 of the stored object for GCS files, as a hex string, which costs
+    # one metadata request. Composite objects have no md5, so they are read
+    # like local files.
+    if path.startswith("gs://"):
+        bucket_name, _, blob_name = path[len("gs://") :].partition("/")
+        blob = _get_storage_client().bucket(bucket_name).get_blob(blob_name)
+        if blob is not None and blob.md5_hash:
+            return base64.b64decode(blob.md5_hash).hex()
+    digest = hashlib.md5()
+    with tf_io.gfile.GFile(path, "rb") as file:
+        while True:
+            block = file.read(CHECKSUM_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
 
-    while source_stack:
 
-        source = source_stack.pop()
-        if source[-1] == "/":
-            source = source[:-1]
+def _is_same_file(source, destination, source_size, verify_checksum):
+    # A different size rules a match out without reading anything. Files of the
+    # same size only match with the same checksum, unless verify_checksum is
+    # turned off.
+    if not tf_io.gfile.exists(destination):
+        return False
+    if tf_io.gfile.stat(destination).length != source_size:
+        return False
+    if verify_checksum:
+        return _file_checksum(source) == _file_checksum(destination)
+    return True
 
-        destination = destination_stack.pop()
-        base_name = os.path.basename(source)
-        destination = os.path.join(destination, base_name)
 
-        if tf_io.gfile.isdir(source):
-            tf_io.gfile.mkdir(destination)
-            for next_item in tf_io.gfile.listdir(source):
-                destination_stack.append(destination)
-                source_stack.append(os.path.join(source, next_item))
-        else:
+def transfer_file(source, destination, verify_checksum=True, force=False):
+    # With force, the destination is always replaced, e.g. by freshly written
+    # output, which must not be skipped for a stale file that matches it.
+    source_size = tf_io.gfile.stat(source).length
+    if not force and _is_same_file(
+        source, destination, source_size, verify_checksum
+    ):
+        return False, 0
+
+    for attempt in range(1, MAX_TRANSFER_ATTEMPTS + 1):
+        try:
             tf_io.gfile.copy(source, destination, overwrite=True)
+            return True, source_size
+        except Exception as error:
+            if attempt == MAX_TRANSFER_ATTEMPTS:
+                raise
+            logging.warning(
+                f"Copying {source} failed (attempt {attempt}): {error}. Retrying..."
+            )
+
+
+def list_files(source_dir):
+    # Lists the whole tree once and returns paths relative to source_dir.
+    source_dir = source_dir.rstrip("/")
+    relative_paths = []
+    for dir_name, _, file_names in tf_io.gfile.walk(source_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_name, file_name)
+            relative_paths.append(path[len(source_dir) :].lstrip("/"))
+    return sorted(relative_paths)
 
 
-def copy_files(file_pattern, destination_dir):
+def transfer_files(
+    file_pairs, num_workers=NUM_TRANSFER_WORKERS, verify_checksum=True
+):
+    # Files already present at the destination with the same size and md5 are
+    # skipped, so rerunning a partially failed transfer resumes it. The md5 is
+    # read from the metadata of GCS files and computed for the others.
+    start_time = time.time()
 
-    for file_path in tf_io.gfile.glob(file_pattern):
-        file_name = os.path.basename(file_path)
-        tf_io.gfile.copy(
-            file_path, os.path.join(destination_dir, file_name), overwrite=True
+    destination_dirs = {os.path.dirname(destination) for _, destination in file_pairs}
+    for destination_dir in sorted(destination_dirs):
+        if destination_dir and not tf_io.gfile.exists(destination_dir):
+            tf_io.gfile.makedirs(destination_dir)
+
+    files_copied, files_skipped, bytes_copied = 0, 0, 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {
+            executor.submit(transfer_file, source, destination, verify_checksum): source
+            for source, destination in file_pairs
+        }
+        for future in as_completed(futures):
+            try:
+                copied, num_bytes = future.result()
+            except Exception as error:
+                failures.append((futures[future], error))
+                continue
+            if copied:
+                files_copied += 1
+                bytes_copied += num_bytes
+            else:
+                files_skipped += 1
+
+    stats = TransferStats(
+        files_copied, files_skipped, bytes_copied, time.time() - start_time
+    )
+    logging.info(
+        f"Transferred {stats.files_copied} files ({stats.bytes_copied} bytes), "
+        f"skipped {stats.files_skipped} unchanged files in {stats.elapsed_seconds:.2f}s "
+        f"({stats.bytes_per_second / 1e6:.2f} MB/s, {stats.files_per_second:.2f} files/s)."
+    )
+
+    if failures:
+        raise RuntimeError(
+            f"{len(failures)} file(s) failed to transfer, rerun to resume. "
+            f"First failure: {failures[0][0]}: {failures[0][1]}"
         )
+    return stats
+
+
+def upload_directory(
+    source_dir,
+    destination_dir,
+    num_workers=NUM_TRANSFER_WORKERS,
+    verify_checksum=True,
+):
+
+    file_pairs = [
+        (os.path.join(source_dir, path), os.path.join(destination_dir, path))
+        for path in list_files(source_dir)
+    ]
+    return transfer_files(file_pairs, num_workers, verify_checksum)
+
+
+def download_directory(
+    source_dir,
+    destination_dir,
+    num_workers=NUM_TRANSFER_WORKERS,
+    verify_checksum=True,
+):
+
+    source_dir = source_dir.rstrip("/")
+    destination_dir = os.path.join(destination_dir, os.path.basename(source_dir))
+    tf_io.gfile.makedirs(destination_dir)
+    return upload_directory(source_dir, destination_dir, num_workers, verify_checksum)
+
+
+def copy_files(
+    file_pattern,
+    destination_dir,
+    num_workers=NUM_TRANSFER_WORKERS,
+    verify_checksum=True,
+):
+
+    file_pairs = [
+        (file_path, os.path.join(destination_dir, os.path.basename(file_path)))
+        for file_path in tf_io.gfile.glob(file_pattern)
+    ]
+    return transfer_files(file_pairs, num_workers, verify_checksum)
+
+
+class ArrowFile:
+    # A GFile that pyarrow can read and write. pyarrow checks the closed
+    # attribute of Python files, which the GFile of TensorFlow 2.4 lacks.
+
+    def __init__(self, file):
+        self._file = file
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self._file.close()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+@contextlib.contextmanager
+def open_arrow_file(path, mode="rb"):
+    # Opens a local or GCS file for pyarrow, and pandas parquet I/O.
+    with tf_io.gfile.GFile(path, mode) as file:
+        yield ArrowFile(file)
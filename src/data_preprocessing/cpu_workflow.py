@@ -0,0 +1,324 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""NumPy/pandas implementation of the NVTabular workflow for CPU-only machines.
+
+It applies the same transformations as etl.create_workflow: categories are
+encoded by descending frequency starting from 1 (0 is for unknown values), the
+genres of each movie are joined by movieId, and the rating is binarised. The
+vocabularies are written in the same categories files as NVTabular and the
+transformed data in the same parquet layout, so the training code can use the
+output of either implementation.
+
+The NVTabular ETL also encodes its splits with this workflow, loaded from the
+vocabularies of the fitted NVTabular workflow, so that the genres are gathered
+from the movie features table instead of joined.
+"""
+
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import tensorflow.io as tf_io
+
+from src.common import categories, features, multihot
+from src.common.movie_features import MovieFeatureTable
+from src.data_preprocessing import etl
+from src.data_preprocessing.profiler import NullProfiler
+
+WORKFLOW_METADATA_FILE = "cpu_workflow.json"
+
+
+def get_embedding_size(cardinality):
+    # Same rule as nvt.ops.get_embedding_sizes.
+    return cardinality, int(min(16, round(1.6 * cardinality ** 0.56)))
+
+
+def frequency_vocabulary(counts, freq_threshold=0):
+    # Most frequent first, ties broken by value so that the result is stable.
+    # Values counted fewer than freq_threshold times are left out, so they are
+    # encoded as unknown values.
+    counts = counts[(counts > 0) & (counts >= freq_threshold)]
+    order = np.lexsort((counts.index.values, -counts.values))
+    return counts.index.values[order]
+
+
+def is_cpu_workflow(workflow_dir):
+    return tf_io.gfile.exists(os.path.join(workflow_dir, WORKFLOW_METADATA_FILE))
+
+
+def load_workflow(workflow_dir):
+    if is_cpu_workflow(workflow_dir):
+        return CpuWorkflow.load(workflow_dir)
+    import nvtabular as nvt
+
+    return nvt.Workflow.load(workflow_dir)
+
+
+class CpuWorkflow:
+    def __init__(
+        self,
+        movies_dataframe=None,
+        vocabularies=None,
+        movie_features=None,
+        freq_threshold=0,
+    ):
+        # The movies table is only needed for fitting; a loaded workflow joins
+        # the genres from its movie features table.
+        self.movies_dataframe = movies_dataframe
+        if movies_dataframe is not None:
+            self.movies_dataframe = movies_dataframe[
+                ["movieId", "genres"]
+            ].reset_index(drop=True)
+        self.vocabularies = vocabularies or {}
+        self.movie_features = movie_features
+        self.freq_threshold = freq_threshold
+        self._counts = {}
+        if self.vocabularies:
+            self._build_lookups()
+
+    def partial_fit(self, ratings_dataframe):
+        for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+            counts = ratings_dataframe[feature_name].value_counts()
+            if feature_name in self._counts:
+                counts = self._counts[feature_name].add(counts, fill_value=0)
+            self._counts[feature_name] = counts
+
+    def fit(self, ratings_blocks):
+        if isinstance(ratings_blocks, pd.DataFrame):
+            ratings_blocks = [ratings_blocks]
+        for ratings_block in ratings_blocks:
+            self.partial_fit(ratings_block)
+
+        for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+            self.vocabularies[feature_name] = frequency_vocabulary(
+                self._counts[feature_name], self.freq_threshold
+            )
+
+        # Each genre is counted once per rating of a movie that has it, as it
+        # would be after joining the genres to the ratings.
+        genre_tokens, genre_offsets = multihot.split_multivalue(
+            self.movies_dataframe["genres"]
+        )
+        movie_counts = (
+            self._counts["movieId"]
+            .reindex(self.movies_dataframe["movieId"].values)
+            .fillna(0)
+            .values
+        )
+        token_counts = np.repeat(movie_counts, np.diff(genre_offsets))
+        genre_counts = pd.Series(token_counts).groupby(genre_tokens).sum()
+        self.vocabularies["genres"] = frequency_vocabulary(genre_counts)
+
+        self._counts = {}
+        self._build_lookups()
+        return self
+
+    def _build_lookups(self):
+        self._lookups = {
+            feature_name: pd.Index(vocabulary)
+            for feature_name, vocabulary in self.vocabularies.items()
+        }
+        if self.movie_features is None:
+            self.movie_features = MovieFeatureTable.build(
+                self.movies_dataframe,
+                self.vocabularies["movieId"],
+                self.vocabularies["genres"],
+            )
+
+    def encode(self, feature_name, values):
+        positions = self._lookups[feature_name].get_indexer(values)
+        return np.where(positions >= 0, positions + 1, 0).astype(np.int64)
+
+    def transform_arrays(self, ratings_dataframe):
+        # Returns the model inputs as arrays, with the genres as the
+        # genres__values / genres__nnzs pair.
+        transformed = {}
+        for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+            transformed[feature_name] = self.encode(
+                feature_name, ratings_dataframe[feature_name].values
+            )
+
+        # The genres are gathered by encoded movie id, so movies outside the
+        # vocabulary get no genres, unlike with the JoinExternal of the
+        # NVTabular workflow that Triton runs, which joins them on the raw
+        # movie id.
+        transformed["genres__values"], transformed["genres__nnzs"] = (
+            self.movie_features.gather(transformed["movieId"])
+        )
+
+        # NVTabular writes the binarised rating cast to the label dtype.
+        target_feature_name = features.TARGET_FEATURE_NAME[0]
+        transformed[target_feature_name] = (
+            ratings_dataframe[target_feature_name].values > 3
+        ).astype(features.get_dtype_dict()[target_feature_name])
+        return transformed
+
+    def transform(self, ratings_dataframe):
+        transformed = self.transform_arrays(ratings_dataframe)
+        genres = multihot.to_list_array(
+            transformed.pop("genres__values").astype(np.int64),
+            multihot.lengths_to_offsets(transformed.pop("genres__nnzs")),
+        )
+        target_feature_name = features.TARGET_FEATURE_NAME[0]
+        return pa.Table.from_arrays(
+            [
+                pa.array(transformed[feature_name])
+                for feature_name in features.CATEGORICAL_FEATURE_NAMES
+            ]
+            + [genres, pa.array(transformed[target_feature_name])],
+            names=features.CATEGORICAL_FEATURE_NAMES + ["genres", target_feature_name],
+        )
+
+    def get_embedding_sizes(self):
+        embedding_sizes, multihot_embedding_sizes = {}, {}
+        for feature_name, vocabulary in self.vocabularies.items():
+            embedding_size = get_embedding_size(len(vocabulary) + 1)
+            if feature_name in features.MULTIVALUE_FEATURE_NAMES:
+                multihot_embedding_sizes[feature_name] = embedding_size
+            else:
+                embedding_sizes[feature_name] = embedding_size
+        return embedding_sizes, multihot_embedding_sizes
+
+    def save(self, workflow_dir):
+        tf_io.gfile.makedirs(workflow_dir)
+        for feature_name, vocabulary in self.vocabularies.items():
+            categories.write_categories(workflow_dir, feature_name, vocabulary)
+
+        self.movie_features.save(workflow_dir)
+
+        with tf_io.gfile.GFile(
+            os.path.join(workflow_dir, WORKFLOW_METADATA_FILE), "w"
+        ) as file:
+            json.dump({"features": list(self.vocabularies)}, file)
+
+    @classmethod
+    def load(cls, workflow_dir):
+        with tf_io.gfile.GFile(
+            os.path.join(workflow_dir, WORKFLOW_METADATA_FILE), "r"
+        ) as file:
+            feature_names = json.load(file)["features"]
+        return cls.from_categories(workflow_dir, feature_names)
+
+    @classmethod
+    def from_categories(cls, workflow_dir, feature_names=None):
+        # Also loads a saved NVTabular workflow, which writes the same
+        # categories files, once its movie features table is saved.
+        feature_names = feature_names or features.get_categorical_feature_names()
+        vocabularies = {}
+        for feature_name in feature_names:
+            vocabulary = categories.read_categories(workflow_dir, feature_name)[1:]
+            if feature_name in features.CATEGORICAL_FEATURE_NAMES:
+                vocabulary = vocabulary.astype(np.int64)
+            vocabularies[feature_name] = vocabulary
+        return cls(
+            vocabularies=vocabularies,
+            movie_features=MovieFeatureTable.load(workflow_dir),
+        )
+
+
+def transform_files(transform_workflow, file_paths, profiler, stage_name):
+    for file_path in file_paths:
+        with profiler.stage(stage_name) as counters:
+            transformed = transform_workflow.transform(pd.read_parquet(file_path))
+            counters["rows"] = transformed.num_rows
+        yield transformed
+
+
+def transform_partitions(transform_workflow, dataset, profiler, stage_name):
+    # Same as transform_files, for the partitions of an NVTabular dataset.
+    for partition in dataset.to_ddf().to_delayed():
+        with profiler.stage(stage_name) as counters:
+            dataframe = partition.compute()
+            if hasattr(dataframe, "to_pandas"):
+                dataframe = dataframe.to_pandas()
+            transformed = transform_workflow.transform(dataframe)
+            counters["rows"] = transformed.num_rows
+        yield transformed
+
+
+def run_cpu_etl(
+    movies_csv_data_location,
+    ratings_csv_data_location,
+    writer,
+    workflow_dir,
+    test_size=0.2,
+    split_method="hash",
+    block_size=etl.BLOCK_SIZE,
+    staging_dir=etl.STAGING_DIR,
+    cache_dir=None,
+    profiler=None,
+    freq_threshold=0,
+):
+
+    profiler = profiler or NullProfiler()
+
+    logging.info("Loading movies dataframe...")
+    # The genres strings are kept unsplit; the workflow encodes them directly.
+    with profiler.stage("csv_read"):
+        movies_dataframe = etl.read_raw(
+            movies_csv_data_location, backend="cpu", cache_dir=cache_dir
+        )
+    logging.info(f"Movies data: {movies_dataframe.shape}.")
+
+    ratings_blocks = etl.read_raw(
+        ratings_csv_data_location,
+        backend="cpu",
+        cache_dir=cache_dir,
+        blocks=True,
+        block_size=block_size,
+    )
+    train_files, test_files, num_train_rows, num_test_rows = etl.stage_splits(
+        ratings_blocks, test_size, split_method, staging_dir, profiler
+    )
+
+    logging.info("Fitting workflow to train data split...")
+    with profiler.stage("fit") as counters:
+        transform_workflow = CpuWorkflow(
+            movies_dataframe, freq_threshold=freq_threshold
+        ).fit(
+            pd.read_parquet(file_path) for file_path in train_files
+        )
+        counters["rows"] = num_train_rows
+    logging.info("Transformation workflow is fitted.")
+
+    logging.info("Saving transformation workflow...")
+    with profiler.stage("workflow_save"):
+        transform_workflow.save(workflow_dir)
+    logging.info("Transformation workflow is saved.")
+
+    logging.info(f"Writting transformed data to {writer.output_dir}")
+    writer.write_splits(
+        {
+            "train": (
+                transform_files(
+                    transform_workflow, train_files, profiler, "transform_train"
+                ),
+                True,
+                num_train_rows,
+            ),
+            "test": (
+                transform_files(
+                    transform_workflow, test_files, profiler, "transform_test"
+                ),
+                False,
+                num_test_rows,
+            ),
+        }
+    )
+    logging.info("Transformed data partitions are queued.")
+
+    return transform_workflow
@@ -11,19 +11,69 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Data preprocessing using NVTabular."""
+"""Data preprocessing using NVTabular.
+
+nvtabular is imported by the functions that use it, so that the CPU workflow,
+which shares the split and staging code of this module, runs without it.
+"""
 
 import os
 import logging
 
+import numpy as np
 import tensorflow.io as tf_io
-import cudf
-import nvtabular as nvt
 
-from sklearn.model_selection import train_test_split
-from src.common import features, utils
+try:
+    import cudf
+except ImportError:
+    cudf = None
+
+from src.common import categories, features, utils
+from src.data_preprocessing import raw_cache
+from src.data_preprocessing.profiler import NullProfiler
 
 RANDOM_STATE = 42
+HASH_BUCKETS = 10000
+BLOCK_SIZE = 256 * 1024 ** 2
+STAGING_DIR = "etl_staging"
+SPLIT_METHODS = ["hash", "time"]
+
+
+def get_dataframe_libs(backend):
+    if backend == "gpu":
+        import dask_cudf
+
+        return cudf, dask_cudf
+    if backend == "cpu":
+        import pandas
+        import dask.dataframe
+
+        return pandas, dask.dataframe
+    raise ValueError(f"Invalid backend {backend}.")
+
+
+def read_raw(
+    csv_location, backend="gpu", cache_dir=None, blocks=False, block_size=BLOCK_SIZE
+):
+
+    dataframe_lib, dask_lib = get_dataframe_libs(backend)
+    if cache_dir:
+        return raw_cache.read_csv_cached(
+            csv_location, cache_dir, dataframe_lib, dask_lib, block_size, blocks
+        )
+    if blocks:
+        return dask_lib.read_csv(
+            csv_location, blocksize=block_size, dtype=features.get_dtype_dict()
+        )
+    return dataframe_lib.read_csv(csv_location)
+
+
+def _is_list_column(series):
+    if type(series.dtype).__name__ == "ListDtype":
+        return True
+    # Null rows can come first in either case.
+    values = series.dropna()
+    return len(values.index) > 0 and not isinstance(values.iloc[0], str)
 
 
 def prep_dataframe(dataframe):
@@ -34,34 +84,139 @@ def prep_dataframe(dataframe):
 
     for feature_name in features.MULTIVALUE_FEATURE_NAMES:
         if feature_name in list(dataframe.columns):
-            dataframe[feature_name] = dataframe[feature_name].str.split("|")
+            # Features read from the raw cache are already split.
+            if not _is_list_column(dataframe[feature_name]):
+                dataframe[feature_name] = dataframe[feature_name].str.split("|")
 
     return dataframe
 
 
-def create_workflow(movies_df):
+def _mix_hash(values):
+    # SplitMix64 finalizer. Only uses operators that numpy and cupy arrays share,
+    # so the CPU and GPU backends assign every row to the same split.
+    hashed = values.astype(np.uint64)
+    hashed ^= hashed >> np.uint64(30)
+    hashed *= np.uint64(0xBF58476D1CE4E5B9)
+    hashed ^= hashed >> np.uint64(27)
+    hashed *= np.uint64(0x94D049BB133111EB)
+    hashed ^= hashed >> np.uint64(31)
+    return hashed
+
+
+def get_test_mask(dataframe, test_size, key_columns=("userId", "movieId")):
+
+    hashed = _mix_hash(
+        dataframe[key_columns[0]].values.astype(np.uint64) + np.uint64(RANDOM_STATE)
+    )
+    for key_column in key_columns[1:]:
+        hashed = _mix_hash(hashed ^ dataframe[key_column].values.astype(np.uint64))
+    threshold = np.uint64(int(round(test_size * HASH_BUCKETS)))
+    return (hashed % np.uint64(HASH_BUCKETS)) < threshold
+
+
+def hash_split(dataframe, test_size):
+
+    is_test = get_test_mask(dataframe, test_size)
+    return dataframe[~is_test], dataframe[is_test]
+
+
+def _array_module(values):
+    if isinstance(values, np.ndarray):
+        return np
+    import cupy
+
+    return cupy
+
+
+def time_holdout_split(dataframe, test_size):
+    # Holds out the most recent test_size fraction of each user's ratings. Users
+    # are ranked after one sort instead of a grouped rank, so this runs on both
+    # backends. In chunked mode, a user whose ratings straddle two blocks is held
+    # out per block; ratings.csv is ordered by user, so this affects at most one
+    # user per block.
+    dataframe = dataframe.sort_values(["userId", "timestamp"])
+    user_ids = dataframe["userId"].values
+    xp = _array_module(user_ids)
+
+    group_starts = xp.searchsorted(user_ids, user_ids, side="left")
+    group_ends = xp.searchsorted(user_ids, user_ids, side="right")
+    positions_from_end = group_ends - 1 - xp.arange(len(user_ids))
+    num_test_rows = xp.floor((group_ends - group_starts) * test_size)
+
+    is_test = positions_from_end < num_test_rows
+    return dataframe[~is_test], dataframe[is_test]
+
+
+def split_dataframe(dataframe, test_size, method="hash"):
+
+    if method == "hash":
+        return hash_split(dataframe, test_size)
+    if method == "time":
+        return time_holdout_split(dataframe, test_size)
+    raise ValueError(f"Invalid split method {method}.")
+
+
+def create_workflow(movies_df, freq_threshold=0):
+    import nvtabular as nvt
+
+    # The workflow joins the genres with JoinExternal, because the Triton
+    # ensemble runs it on raw requests. The ETL only fits it: the splits are
+    # encoded with its vocabularies and the genres are gathered from the
+    # movie features table by encoded movie id, without the join (see
+    # cpu_workflow.transform_partitions).
+    # Ids seen fewer than freq_threshold times in the train split are encoded
+    # as 0, like unknown ids, which bounds the userId and movieId vocabularies.
     joined = ["userId", "movieId"] >> nvt.ops.JoinExternal(movies_df, on=["movieId"])
-    cat_features = joined >> nvt.ops.Categorify()
+    cat_features = joined >> nvt.ops.Categorify(
+        freq_threshold={
+            feature_name: freq_threshold
+            for feature_name in features.CATEGORICAL_FEATURE_NAMES
+        }
+    )
     ratings = nvt.ColumnGroup(["rating"]) >> (lambda col: (col > 3).astype("int8"))
     output = cat_features + ratings
     workflow = nvt.Workflow(output)
     return workflow
 
 
-def run_etl(movies_csv_data_location, ratings_csv_data_location, test_size=0.2):
+def run_etl(
+    movies_csv_data_location,
+    ratings_csv_data_location,
+    test_size=0.2,
+    split_method="hash",
+    cache_dir=None,
+    profiler=None,
+    freq_threshold=0,
+    watermark=None,
+):
+    import nvtabular as nvt
+
+    profiler = profiler or NullProfiler()
 
     logging.info("Loading dataframes...")
-    movies_dataframe = prep_dataframe(cudf.read_csv(movies_csv_data_location))
-    ratings_dataframe = prep_dataframe(cudf.read_csv(ratings_csv_data_location))
+    with profiler.stage("csv_read") as counters:
+        movies_dataframe = read_raw(movies_csv_data_location, cache_dir=cache_dir)
+        ratings_dataframe = read_raw(ratings_csv_data_location, cache_dir=cache_dir)
+        counters["rows"] = len(ratings_dataframe.index)
+    with profiler.stage("prep") as counters:
+        movies_dataframe = prep_dataframe(movies_dataframe)
+        counters["rows"] = len(movies_dataframe.index)
     logging.info("Dataframe loaded.")
+    if watermark is not None:
+        watermark.update(ratings_dataframe)
 
     logging.info(f"Movies data: {movies_dataframe.shape}.")
     logging.info(f"Ratings data: {ratings_dataframe.shape}.")
 
     logging.info("Splitting dataset to train and test splits...")
-    train_split, test_split = train_test_split(
-        ratings_dataframe, test_size=test_size, random_state=RANDOM_STATE
-    )
+    with profiler.stage("split") as counters:
+        train_split, test_split = split_dataframe(
+            ratings_dataframe, test_size, method=split_method
+        )
+        counters["rows"] = len(ratings_dataframe.index)
+    with profiler.stage("prep") as counters:
+        train_split, test_split = prep_dataframe(train_split), prep_dataframe(test_split)
+        counters["rows"] = len(ratings_dataframe.index)
     logging.info(f"Train split size: {len(train_split.index)}")
     logging.info(f"Test split size: {len(test_split.index)}")
 
@@ -70,18 +225,305 @@ def run_etl(movies_csv_data_location, ratings_csv_data_location, test_size=0.2):
     test_dataset = nvt.Dataset(test_split)
     logging.info("NVTabular datasets loaded.")
 
+    num_rows = {"train": len(train_split.index), "test": len(test_split.index)}
+    transform_workflow = fit_workflow(
+        movies_dataframe,
+        train_dataset,
+        profiler,
+        num_train_rows=num_rows["train"],
+        freq_threshold=freq_threshold,
+    )
+    return train_dataset, test_dataset, transform_workflow, num_rows
+
+
+def stage_splits(
+    ratings_blocks,
+    test_size,
+    split_method,
+    staging_dir=STAGING_DIR,
+    profiler=None,
+    watermark=None,
+):
+
+    profiler = profiler or NullProfiler()
+    logging.info(
+        f"Splitting {ratings_blocks.npartitions} ratings blocks "
+        f"to train and test splits..."
+    )
+    for split in ["train", "test"]:
+        tf_io.gfile.makedirs(os.path.join(staging_dir, split))
+
+    train_files, test_files = [], []
+    num_train_rows, num_test_rows = 0, 0
+    for block_index in range(ratings_blocks.npartitions):
+        with profiler.stage("csv_read") as counters:
+            ratings_block = ratings_blocks.get_partition(block_index).compute()
+            counters["rows"] = len(ratings_block.index)
+        if watermark is not None:
+            watermark.update(ratings_block)
+        with profiler.stage("split") as counters:
+            train_block, test_block = split_dataframe(
+                ratings_block, test_size, method=split_method
+            )
+            counters["rows"] = len(ratings_block.index)
+        with profiler.stage("prep") as counters:
+            train_block = prep_dataframe(train_block)
+            test_block = prep_dataframe(test_block)
+            counters["rows"] = len(ratings_block.index)
+
+        file_name = f"part_{block_index:05d}.parquet"
+        train_files.append(os.path.join(staging_dir, "train", file_name))
+        test_files.append(os.path.join(staging_dir, "test", file_name))
+        with profiler.stage("staging_write") as counters:
+            train_block.to_parquet(train_files[-1], index=False)
+            test_block.to_parquet(test_files[-1], index=False)
+            counters["rows"] = len(ratings_block.index)
+
+        num_train_rows += len(train_block.index)
+        num_test_rows += len(test_block.index)
+        del ratings_block, train_block, test_block
+    logging.info(f"Train split size: {num_train_rows}")
+    logging.info(f"Test split size: {num_test_rows}")
+
+    return train_files, test_files, num_train_rows, num_test_rows
+
+
+def run_chunked_etl(
+    movies_csv_data_location,
+    ratings_csv_data_location,
+    test_size=0.2,
+    split_method="hash",
+    block_size=BLOCK_SIZE,
+    staging_dir=STAGING_DIR,
+    backend="gpu",
+    cache_dir=None,
+    profiler=None,
+    freq_threshold=0,
+    watermark=None,
+):
+    import nvtabular as nvt
+
+    profiler = profiler or NullProfiler()
+
+    logging.info("Loading movies dataframe...")
+    with profiler.stage("csv_read"):
+        movies_dataframe = read_raw(
+            movies_csv_data_location, backend=backend, cache_dir=cache_dir
+        )
+    with profiler.stage("prep") as counters:
+        movies_dataframe = prep_dataframe(movies_dataframe)
+        counters["rows"] = len(movies_dataframe.index)
+    logging.info(f"Movies data: {movies_dataframe.shape}.")
+
+    # Only one block of ratings is held in memory at a time. Each block is split
+    # and staged as one parquet partition per split for the NVTabular datasets.
+    ratings_blocks = read_raw(
+        ratings_csv_data_location,
+        backend=backend,
+        cache_dir=cache_dir,
+        blocks=True,
+        block_size=block_size,
+    )
+    train_files, test_files, num_train_rows, num_test_rows = stage_splits(
+        ratings_blocks, test_size, split_method, staging_dir, profiler, watermark
+    )
+
+    logging.info("Loading NVTabular datasets...")
+    dataset_kwargs = {"cpu": True} if backend == "cpu" else {}
+    train_dataset = nvt.Dataset(train_files, engine="parquet", **dataset_kwargs)
+    test_dataset = nvt.Dataset(test_files, engine="parquet", **dataset_kwargs)
+    logging.info("NVTabular datasets loaded.")
+
+    transform_workflow = fit_workflow(
+        movies_dataframe,
+        train_dataset,
+        profiler,
+        num_train_rows=num_train_rows,
+        freq_threshold=freq_threshold,
+    )
+    return (
+        train_dataset,
+        test_dataset,
+        transform_workflow,
+        {"train": num_train_rows, "test": num_test_rows},
+    )
+
+
+def _to_numpy(series):
+    # pandas unique() returns an array, cudf unique() a series.
+    if hasattr(series, "to_pandas"):
+        series = series.to_pandas()
+    return np.asarray(series)
+
+
+def _get_keys(ratings_dataframe):
+    return set(
+        zip(
+            _to_numpy(ratings_dataframe["userId"]).tolist(),
+            _to_numpy(ratings_dataframe["movieId"]).tolist(),
+        )
+    )
+
+
+class Watermark:
+    # The latest timestamp of the processed ratings, and the (userId, movieId)
+    # keys of the processed ratings at that second. Ratings that arrive late
+    # with the same second are then still new to the next incremental run,
+    # which reads from the watermark second on and drops only these keys.
+    # Without keys (states saved before they were kept), only ratings after
+    # the watermark second are new.
+
+    def __init__(self, timestamp=None, keys=()):
+        self.timestamp = timestamp
+        self.keys = None if keys is None else set(map(tuple, keys))
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["watermark"], state.get("watermark_keys"))
+
+    def to_state(self):
+        return {
+            "watermark": self.timestamp,
+            "watermark_keys": sorted([list(key) for key in self.keys or ()]),
+        }
+
+    def update(self, ratings_dataframe):
+        if not len(ratings_dataframe.index):
+            return
+        timestamps = ratings_dataframe["timestamp"]
+        timestamp = int(timestamps.max())
+        if self.timestamp is not None and timestamp < self.timestamp:
+            return
+        keys = _get_keys(ratings_dataframe[timestamps == timestamp])
+        if timestamp == self.timestamp and self.keys is not None:
+            keys |= self.keys
+        self.timestamp, self.keys = timestamp, keys
+
+    def filter(self, ratings):
+        # Returns the ratings not processed yet. ratings can be a dask dataframe.
+        if self.timestamp is None:
+            return ratings
+        if self.keys is None:
+            return ratings[ratings["timestamp"] > self.timestamp]
+        return ratings[ratings["timestamp"] >= self.timestamp]
+
+    def drop_processed(self, ratings_dataframe):
+        # Drops the ratings at the watermark second that were processed.
+        if self.timestamp is None or not self.keys:
+            return ratings_dataframe
+        ratings_dataframe = ratings_dataframe.reset_index(drop=True)
+        boundary = ratings_dataframe[ratings_dataframe["timestamp"] == self.timestamp]
+        is_processed = np.array(
+            [
+                key in self.keys
+                for key in zip(
+                    _to_numpy(boundary["userId"]).tolist(),
+                    _to_numpy(boundary["movieId"]).tolist(),
+                )
+            ],
+            dtype=bool,
+        )
+        return ratings_dataframe.drop(index=_to_numpy(boundary.index)[is_processed])
+
+    def __str__(self):
+        return f"{self.timestamp} ({len(self.keys or ())} ratings at that second)"
+
+
+def extend_workflow_categories(
+    workflow_dir, ratings_dataframe, movies_dataframe, freq_threshold=0
+):
+
+    new_values = {
+        "userId": _to_numpy(ratings_dataframe["userId"].unique()),
+        "movieId": _to_numpy(ratings_dataframe["movieId"].unique()),
+        "genres": _to_numpy(movies_dataframe["genres"].explode().dropna().unique()),
+    }
+    if freq_threshold:
+        # Same threshold as create_workflow, applied to the ratings of the
+        # incremental runs, so the vocabularies stay bounded.
+        for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+            new_values[feature_name] = categories.select_frequent(
+                workflow_dir,
+                feature_name,
+                _to_numpy(ratings_dataframe[feature_name]),
+                freq_threshold,
+            )
+    for feature_name in features.get_categorical_feature_names():
+        num_added = categories.extend_categories(
+            workflow_dir, feature_name, new_values[feature_name]
+        )
+        logging.info(f"Added {num_added} new {feature_name} categories.")
+
+
+def run_incremental_etl(
+    movies_csv_data_location,
+    ratings_csv_files,
+    workflow_dir,
+    watermark,
+    test_size=0.2,
+    split_method="hash",
+    backend="gpu",
+    freq_threshold=0,
+):
+    import nvtabular as nvt
+
+    # Splits only the ratings not processed before the watermark, after
+    # extending the vocabularies of the previously fitted workflow with their
+    # new values. The movies table joined by the exported workflow is the one
+    # it was fitted with, but the movie features table the splits are encoded
+    # with is rebuilt from the current movies, so new movies get their genres.
+
+    dataframe_lib, dask_lib = get_dataframe_libs(backend)
+
+    logging.info("Loading movies dataframe...")
+    movies_dataframe = prep_dataframe(dataframe_lib.read_csv(movies_csv_data_location))
+
+    logging.info(f"Loading ratings from watermark {watermark}...")
+    ratings = dask_lib.read_csv(ratings_csv_files, dtype=features.get_dtype_dict())
+    ratings_dataframe = watermark.drop_processed(watermark.filter(ratings).compute())
+    logging.info(f"New ratings data: {ratings_dataframe.shape}.")
+    if not len(ratings_dataframe.index):
+        return None
+    new_watermark = Watermark(watermark.timestamp, watermark.keys)
+    new_watermark.update(ratings_dataframe)
+
+    logging.info("Splitting new ratings to train and test splits...")
+    train_split, test_split = split_dataframe(
+        ratings_dataframe, test_size, method=split_method
+    )
+    train_split, test_split = prep_dataframe(train_split), prep_dataframe(test_split)
+    logging.info(f"Train split size: {len(train_split.index)}")
+    logging.info(f"Test split size: {len(test_split.index)}")
+
+    logging.info("Extending workflow categories...")
+    extend_workflow_categories(
+        workflow_dir, train_split, movies_dataframe, freq_threshold
+    )
+
+    dataset_kwargs = {"cpu": True} if backend == "cpu" else {}
+    return (
+        nvt.Dataset(train_split, **dataset_kwargs),
+        nvt.Dataset(test_split, **dataset_kwargs),
+        new_watermark,
+    )
+
+
+def fit_workflow(
+    movies_dataframe,
+    train_dataset,
+    profiler=None,
+    num_train_rows=None,
+    freq_threshold=0,
+):
+
+    profiler = profiler or NullProfiler()
+
     logging.info("Creating transformation workflow...")
-    transform_workflow = create_workflow(movies_dataframe)
+    transform_workflow = create_workflow(movies_dataframe, freq_threshold)
     logging.info("Fitting workflow to train data split...")
-    transform_workflow.fit(train_dataset)
+    with profiler.stage("fit") as counters:
+        transform_workflow.fit(train_dataset)
+        counters["rows"] = num_train_rows
     logging.info("Transformation workflow is fitted.")
 
-    logging.info("Transforming train dataset...")
-    transformed_train_dataset = transform_workflow.transform(train_dataset)
-    logging.info("Train data is transformed.")
-
-    logging.info(f"Transforming test dataset...")
-    transformed_test_dataset = transform_workflow.transform(test_dataset)
-    logging.info("Test dataset is transformed.")
-
-    return transformed_train_dataset, transformed_test_dataset, transform_workflow
+    return transform_workflow
@@ -0,0 +1,159 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ETL stages profiler."""
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+import contextlib
+from collections import OrderedDict
+
+import tensorflow.io as tf_io
+
+PROFILE_REPORT_FILE = "etl_profile.json"
+SAMPLING_INTERVAL_SECONDS = 0.05
+
+
+def get_host_memory():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak instead of current memory where /proc is not available.
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _get_device_memory_handles():
+    try:
+        import pynvml
+
+        pynvml.nvmlInit()
+        return [
+            pynvml.nvmlDeviceGetHandleByIndex(index)
+            for index in range(pynvml.nvmlDeviceGetCount())
+        ]
+    except Exception:
+        return []
+
+
+def get_device_memory(handles):
+    if not handles:
+        return None
+    import pynvml
+
+    return sum(pynvml.nvmlDeviceGetMemoryInfo(handle).used for handle in handles)
+
+
+class StageProfiler:
+    # Times named stages and samples the host and device memory in the background
+    # to record the peak of each stage. A stage entered several times, e.g. once
+    # per block in the chunked ETL, is accumulated into one entry. Stages can
+    # overlap, e.g. when the splits are transformed in separate threads.
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._start_time = time.time()
+        self._device_handles = _get_device_memory_handles()
+        self._active_peaks = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLING_INTERVAL_SECONDS):
+            self._update_peaks()
+
+    def _update_peaks(self):
+        host_memory = get_host_memory()
+        device_memory = get_device_memory(self._device_handles)
+        with self._lock:
+            for peaks in self._active_peaks.values():
+                peaks["host"] = max(peaks["host"], host_memory)
+                if device_memory is not None:
+                    peaks["device"] = max(peaks["device"] or 0, device_memory)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Yields a dict in which the caller can set the number of "rows" processed.
+        counters = {"rows": None}
+        with self._lock:
+            self._active_peaks[id(counters)] = {"host": 0, "device": None}
+        self._update_peaks()
+        start_time = time.time()
+        try:
+            yield counters
+        finally:
+            elapsed_seconds = time.time() - start_time
+            self._update_peaks()
+            with self._lock:
+                peaks = self._active_peaks.pop(id(counters))
+                self._record(name, elapsed_seconds, counters["rows"], peaks)
+
+    def _record(self, name, elapsed_seconds, rows, peaks):
+        record = self.stages.setdefault(
+            name,
+            {
+                "seconds": 0.0,
+                "calls": 0,
+                "rows": None,
+                "peak_host_memory_bytes": 0,
+                "peak_device_memory_bytes": None,
+            },
+        )
+        record["seconds"] += elapsed_seconds
+        record["calls"] += 1
+        if rows is not None:
+            record["rows"] = (record["rows"] or 0) + int(rows)
+            record["rows_per_second"] = record["rows"] / max(record["seconds"], 1e-9)
+        record["peak_host_memory_bytes"] = max(
+            record["peak_host_memory_bytes"], peaks["host"]
+        )
+        if peaks["device"] is not None:
+            record["peak_device_memory_bytes"] = max(
+                record["peak_device_memory_bytes"] or 0, peaks["device"]
+            )
+        logging.info(
+            f"Stage {name} took {elapsed_seconds:.2f}s"
+            + (f" for {rows} rows." if rows is not None else ".")
+        )
+
+    def report(self):
+        return {
+            "total_seconds": time.time() - self._start_time,
+            "stages": self.stages,
+        }
+
+    def close(self):
+        self._stop.set()
+
+    def write_report(self, output_dir):
+        self.close()
+        report_file = os.path.join(output_dir, PROFILE_REPORT_FILE)
+        tf_io.gfile.makedirs(output_dir)
+        with tf_io.gfile.GFile(report_file, "w") as file:
+            json.dump(self.report(), file, indent=2)
+        logging.info(f"ETL profile is written to {report_file}.")
+        return report_file
+
+
+class NullProfiler:
+    @contextlib.contextmanager
+    def stage(self, name):
+        yield {"rows": None}
@@ -0,0 +1,104 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Columnar cache of the raw CSV files."""
+
+import os
+import json
+import logging
+
+import tensorflow.io as tf_io
+
+from src.common import features
+
+COMPRESSION = "snappy"
+
+
+def get_cache_paths(csv_location, cache_dir):
+    name = os.path.splitext(os.path.basename(csv_location))[0]
+    return os.path.join(cache_dir, name), os.path.join(cache_dir, f"{name}.json")
+
+
+def get_source_signature(csv_location):
+    # Cloud Storage objects get a new modification time whenever they are
+    # rewritten, so size and mtime identify the version of the source file.
+    stat = tf_io.gfile.stat(csv_location)
+    return {
+        "location": csv_location,
+        "size": stat.length,
+        "mtime_nsec": stat.mtime_nsec,
+    }
+
+
+def is_cache_valid(csv_location, cache_dir):
+
+    _, metadata_file = get_cache_paths(csv_location, cache_dir)
+    if not tf_io.gfile.exists(metadata_file):
+        return False
+    with tf_io.gfile.GFile(metadata_file, "r") as file:
+        return json.load(file) == get_source_signature(csv_location)
+
+
+def _prep_block(dataframe):
+
+    dtypes = features.get_dtype_dict()
+    dataframe = dataframe.astype(
+        {name: dtypes[name] for name in dataframe.columns if name in dtypes}
+    )
+    for feature_name in features.MULTIVALUE_FEATURE_NAMES:
+        if feature_name in list(dataframe.columns):
+            dataframe[feature_name] = dataframe[feature_name].str.split("|")
+    return dataframe
+
+
+def convert_csv(csv_location, cache_dir, dask_lib, block_size):
+
+    data_dir, metadata_file = get_cache_paths(csv_location, cache_dir)
+    signature = get_source_signature(csv_location)
+    if tf_io.gfile.exists(data_dir):
+        tf_io.gfile.rmtree(data_dir)
+    tf_io.gfile.makedirs(data_dir)
+
+    # Each CSV block becomes one parquet file, which the chunked ETL then reads
+    # as one partition.
+    logging.info(f"Converting {csv_location} to parquet in {data_dir}...")
+    csv_blocks = dask_lib.read_csv(csv_location, blocksize=block_size)
+    for block_index in range(csv_blocks.npartitions):
+        block = _prep_block(csv_blocks.get_partition(block_index).compute())
+        block.to_parquet(
+            os.path.join(data_dir, f"part_{block_index:05d}.parquet"),
+            index=False,
+            compression=COMPRESSION,
+        )
+
+    # The metadata is written last, so an interrupted conversion is redone.
+    with tf_io.gfile.GFile(metadata_file, "w") as file:
+        json.dump(signature, file)
+    logging.info(f"{csv_location} is converted.")
+
+
+def read_csv_cached(
+    csv_location, cache_dir, dataframe_lib, dask_lib, block_size, blocks=False
+):
+
+    if not is_cache_valid(csv_location, cache_dir):
+        convert_csv(csv_location, cache_dir, dask_lib, block_size)
+    else:
+        logging.info(f"Reading {csv_location} from the cache in {cache_dir}.")
+
+    data_dir, _ = get_cache_paths(csv_location, cache_dir)
+    if blocks:
+        return dask_lib.read_parquet(data_dir)
+    if dataframe_lib.__name__ == "pandas" and "://" not in data_dir:
+        return dataframe_lib.read_parquet(data_dir, memory_map=True)
+    return dataframe_lib.read_parquet(data_dir)
@@ -15,19 +15,28 @@
 
 import os
 import sys
+import json
 from datetime import datetime
 import logging
-import nvtabular as nvt
 import tensorflow as tf
 from tensorflow.python.client import device_lib
 import argparse
 
 # from google.cloud import aiplatform as vertex_ai
 
-from src.data_preprocessing import etl
-from src.common import features, utils
+from src.data_preprocessing import cpu_workflow, etl
+from src.data_preprocessing.profiler import StageProfiler
+from src.data_preprocessing.writer import (
+    COMPRESSION,
+    COMPRESSIONS,
+    ROW_GROUP_SIZE,
+    ParquetShardWriter,
+)
+from src.common import utils
+from src.common.movie_features import MovieFeatureTable
 
 LOCAL_TRANSFORM_DIR = "transform_workflow"
+ETL_STATE_FILE = "etl_state.json"
 
 
 def get_args():
@@ -67,6 +76,93 @@ def get_args():
         default=0.2,
     )
 
+    parser.add_argument(
+        "--split-method",
+        type=str,
+        default="hash",
+        choices=etl.SPLIT_METHODS,
+    )
+
+    parser.add_argument(
+        "--chunked",
+        action="store_true",
+        help="Process the ratings in fixed-size blocks instead of loading them at once.",
+    )
+
+    parser.add_argument(
+        "--block-size-mb",
+        type=int,
+        default=256,
+    )
+
+    parser.add_argument(
+        "--raw-cache-dir",
+        type=str,
+        default=None,
+        help="Where to keep a parquet copy of the raw CSV files across runs.",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process the ratings that arrived since the previous run.",
+    )
+
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="nvtabular",
+        choices=["nvtabular", "numpy"],
+        help="numpy runs the reference NumPy/pandas workflow on CPU.",
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="gpu",
+        choices=["gpu", "cpu"],
+    )
+
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=None,
+        help="Write each split as this many shards of equal row counts.",
+    )
+
+    parser.add_argument(
+        "--global-shuffle",
+        action="store_true",
+        help="Shuffle the training rows across all shards instead of within each.",
+    )
+
+    parser.add_argument(
+        "--shuffle-buckets",
+        type=int,
+        default=None,
+        help="Buckets of the global shuffle. Defaults to one per shard, or 64.",
+    )
+
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=ROW_GROUP_SIZE,
+    )
+
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default=COMPRESSION,
+        choices=COMPRESSIONS,
+    )
+
+    parser.add_argument(
+        "--freq-threshold",
+        type=int,
+        default=0,
+        help="Encode the userId and movieId values seen fewer times as unknown.",
+    )
+
     #     parser.add_argument(
     #         "--project",
     #         type=str
@@ -96,6 +192,136 @@ def get_dataset_gcs_location(dataset_display_name):
     return dataset.gca_resource.metadata["inputConfig"]["gcsSource"]["uri"][0]
 
 
+def load_etl_state(etl_output_dir):
+    state_file = os.path.join(etl_output_dir, ETL_STATE_FILE)
+    if not tf.io.gfile.exists(state_file):
+        return None
+    with tf.io.gfile.GFile(state_file, "r") as file:
+        return json.load(file)
+
+
+def save_etl_state(etl_output_dir, state):
+    with tf.io.gfile.GFile(os.path.join(etl_output_dir, ETL_STATE_FILE), "w") as file:
+        json.dump(state, file)
+
+
+def get_ratings_files(ratings_csv_data_location):
+    return {
+        file_path: tf.io.gfile.stat(file_path).length
+        for file_path in tf.io.gfile.glob(ratings_csv_data_location)
+    }
+
+
+def create_writer(args, file_prefix="", append=False, num_shards=None):
+    return ParquetShardWriter(
+        os.path.join(args.etl_output_dir, "transformed_data"),
+        file_prefix=file_prefix,
+        append=append,
+        num_shards=num_shards,
+        global_shuffle=args.global_shuffle,
+        num_shuffle_buckets=args.shuffle_buckets,
+        row_group_size=args.row_group_size,
+        compression=args.compression,
+    )
+
+
+def save_movie_features(args, workflow_dir):
+    # Saves the genres of each encoded movie id next to the fitted vocabularies,
+    # for the consumers that gather them instead of joining the movies table.
+    movies_dataframe = etl.read_raw(
+        args.movies_csv_data_location, backend="cpu", cache_dir=args.raw_cache_dir
+    )
+    MovieFeatureTable.from_workflow_categories(workflow_dir, movies_dataframe).save(
+        workflow_dir
+    )
+
+
+def run_incremental(args, state, ratings_files, profiler):
+    # Only new files, or files that grew since the previous run, are read, and
+    # only their ratings not processed before the watermark are transformed.
+    changed_files = [
+        file_path
+        for file_path, file_size in ratings_files.items()
+        if state["ratings_files"].get(file_path) != file_size
+    ]
+    if not changed_files:
+        logging.info("No new ratings since the previous run.")
+        return
+    logging.info(f"Changed ratings files: {changed_files}")
+
+    logging.info("Downloading transform workflow...")
+    if tf.io.gfile.exists(LOCAL_TRANSFORM_DIR):
+        tf.io.gfile.rmtree(LOCAL_TRANSFORM_DIR)
+    utils.download_directory(
+        os.path.join(args.etl_output_dir, "transform_workflow"), "."
+    )
+
+    result = etl.run_incremental_etl(
+        args.movies_csv_data_location,
+        changed_files,
+        LOCAL_TRANSFORM_DIR,
+        etl.Watermark.from_state(state),
+        test_size=args.test_size,
+        split_method=args.split_method,
+        backend=args.backend,
+        # The threshold the workflow was fitted with.
+        freq_threshold=state.get("freq_threshold", args.freq_threshold),
+    )
+
+    if result:
+        train_dataset, test_dataset, new_watermark = result
+
+        with profiler.stage("workflow_save"):
+            save_movie_features(args, LOCAL_TRANSFORM_DIR)
+        encoder = cpu_workflow.CpuWorkflow.from_categories(LOCAL_TRANSFORM_DIR)
+
+        # The new shards are added next to the previous ones under a prefix that
+        # is unique per run, so the existing shards are never rewritten. A run
+        # can end at the watermark second of the previous one, but then with
+        # more ratings at that second.
+        logging.info("Writting new data and uploading extended transform workflow...")
+        with profiler.stage("parquet_write"):
+            writer = create_writer(
+                args,
+                file_prefix=(
+                    f"delta-{new_watermark.timestamp}-{len(new_watermark.keys)}-"
+                ),
+                append=True,
+            )
+            writer.upload_directory(
+                LOCAL_TRANSFORM_DIR,
+                os.path.join(args.etl_output_dir, "transform_workflow"),
+            )
+            writer.write_splits(
+                {
+                    "train": (
+                        cpu_workflow.transform_partitions(
+                            encoder, train_dataset, profiler, "transform_train"
+                        ),
+                        True,
+                    ),
+                    "test": (
+                        cpu_workflow.transform_partitions(
+                            encoder, test_dataset, profiler, "transform_test"
+                        ),
+                        False,
+                    ),
+                }
+            )
+        with profiler.stage("upload"):
+            writer.close()
+        state.update(new_watermark.to_state())
+
+    state["ratings_files"] = ratings_files
+    save_etl_state(args.etl_output_dir, state)
+    logging.info(f"ETL state is updated. Watermark: {etl.Watermark.from_state(state)}")
+
+    try:
+        tf.io.gfile.rmtree(LOCAL_TRANSFORM_DIR)
+    except:
+        pass
+
+
 def main():
     args = get_args()
 
@@ -107,56 +333,137 @@ def main():
     #     movies_csv_data_location = get_dataset_gcs_location(movies_dataset_display_name)
     #     ratings_csv_data_location = get_dataset_gcs_location(ratings_dataset_display_name)
 
-    (
-        transformed_train_dataset,
-        transformed_test_dataset,
-        transform_workflow,
-    ) = etl.run_etl(args.movies_csv_data_location, args.ratings_csv_data_location)
+    if args.incremental and args.engine != "nvtabular":
+        raise ValueError("Incremental ETL requires the nvtabular engine.")
 
-    transformed_train_dataset_dir = os.path.join(
-        args.etl_output_dir, "transformed_data/train"
-    )
-    logging.info(
-        f"Writting transformed training data to {transformed_train_dataset_dir}"
-    )
-    transformed_train_dataset.to_parquet(
-        output_path=transformed_train_dataset_dir,
-        shuffle=nvt.io.Shuffle.PER_PARTITION,
-        cats=features.CATEGORICAL_FEATURE_NAMES,
-        labels=features.TARGET_FEATURE_NAME,
-        dtypes=features.get_dtype_dict(),
-    )
-    logging.info("Train data parquet files are written.")
+    profiler = StageProfiler()
 
-    transformed_test_dataset_dir = os.path.join(
-        args.etl_output_dir, "transformed_data/test"
-    )
-    logging.info(
-        f"Writting transformed testing data to {transformed_test_dataset_dir}"
-    )
-    transformed_test_dataset.to_parquet(
-        output_path=transformed_test_dataset_dir,
-        shuffle=False,
-        cats=features.CATEGORICAL_FEATURE_NAMES,
-        labels=features.TARGET_FEATURE_NAME,
-        dtypes=features.get_dtype_dict(),
-    )
-    logging.info("Test data parquet files are written.")
+    ratings_files = get_ratings_files(args.ratings_csv_data_location)
+    state = load_etl_state(args.etl_output_dir) if args.incremental else None
+    if state:
+        run_incremental(args, state, ratings_files, profiler)
+        profiler.write_report(args.etl_output_dir)
+        return
+
+    # The train and test shards are encoded and uploaded while the next
+    # partitions are transformed; close() waits for the pending uploads.
+    writer = create_writer(args, num_shards=args.num_shards)
+    # The incremental runs start from the latest ratings read by this run.
+    watermark = etl.Watermark() if args.incremental else None
+    if args.engine == "numpy":
+        cpu_workflow.run_cpu_etl(
+            args.movies_csv_data_location,
+            args.ratings_csv_data_location,
+            writer,
+            LOCAL_TRANSFORM_DIR,
+            test_size=args.test_size,
+            split_method=args.split_method,
+            block_size=args.block_size_mb * 1024 ** 2,
+            cache_dir=args.raw_cache_dir,
+            profiler=profiler,
+            freq_threshold=args.freq_threshold,
+        )
+        writer.upload_directory(
+            LOCAL_TRANSFORM_DIR, os.path.join(args.etl_output_dir, "transform_workflow")
+        )
+    else:
+        if args.chunked:
+            (
+                train_dataset,
+                test_dataset,
+                transform_workflow,
+                num_rows,
+            ) = etl.run_chunked_etl(
+                args.movies_csv_data_location,
+                args.ratings_csv_data_location,
+                test_size=args.test_size,
+                split_method=args.split_method,
+                block_size=args.block_size_mb * 1024 ** 2,
+                backend=args.backend,
+                cache_dir=args.raw_cache_dir,
+                profiler=profiler,
+                freq_threshold=args.freq_threshold,
+                watermark=watermark,
+            )
+        else:
+            (
+                train_dataset,
+                test_dataset,
+                transform_workflow,
+                num_rows,
+            ) = etl.run_etl(
+                args.movies_csv_data_location,
+                args.ratings_csv_data_location,
+                test_size=args.test_size,
+                split_method=args.split_method,
+                cache_dir=args.raw_cache_dir,
+                profiler=profiler,
+                freq_threshold=args.freq_threshold,
+                watermark=watermark,
+            )
 
-    logging.info("Saving transformation workflow...")
-    transform_workflow.save(LOCAL_TRANSFORM_DIR)
-    logging.info("Transformation workflow is saved.")
+        logging.info("Saving transformation workflow...")
+        with profiler.stage("workflow_save"):
+            transform_workflow.save(LOCAL_TRANSFORM_DIR)
+            save_movie_features(args, LOCAL_TRANSFORM_DIR)
+        logging.info("Transformation workflow is saved.")
+
+        # The splits are encoded with the fitted vocabularies and the movie
+        # features table, without the JoinExternal of the workflow.
+        encoder = cpu_workflow.CpuWorkflow.from_categories(LOCAL_TRANSFORM_DIR)
+
+        transformed_data_dir = os.path.join(args.etl_output_dir, "transformed_data")
+        logging.info(f"Writting transformed data to {transformed_data_dir}")
+        with profiler.stage("parquet_write") as counters:
+            writer.upload_directory(
+                LOCAL_TRANSFORM_DIR,
+                os.path.join(args.etl_output_dir, "transform_workflow"),
+            )
+            writer.write_splits(
+                {
+                    "train": (
+                        cpu_workflow.transform_partitions(
+                            encoder, train_dataset, profiler, "transform_train"
+                        ),
+                        True,
+                        num_rows["train"],
+                    ),
+                    "test": (
+                        cpu_workflow.transform_partitions(
+                            encoder, test_dataset, profiler, "transform_test"
+                        ),
+                        False,
+                        num_rows["test"],
+                    ),
+                }
+            )
+            counters["rows"] = sum(num_rows.values())
+
+    logging.info("Waiting for the uploads to Cloud Storage...")
+    with profiler.stage("upload"):
+        writer.close()
+    logging.info("Transformed data parquet files are written.")
 
-    logging.info("Uploading transform workflow to Cloud Storage...")
-    utils.upload_directory(
-        LOCAL_TRANSFORM_DIR, os.path.join(args.etl_output_dir, "transform_workflow")
-    )
     try:
         tf.io.gfile.rmtree(LOCAL_TRANSFORM_DIR)
         tf.io.gfile.rmtree("categories")
+        if args.chunked or args.engine == "numpy":
+            tf.io.gfile.rmtree(etl.STAGING_DIR)
     except:
         pass
-    logging.info("Transformation uploaded to Cloud Storage.")
+
+    if args.incremental:
+        save_etl_state(
+            args.etl_output_dir,
+            {
+                **watermark.to_state(),
+                "ratings_files": ratings_files,
+                "freq_threshold": args.freq_threshold,
+            },
+        )
+        logging.info(f"ETL state is saved. Watermark: {watermark}")
+
+    profiler.write_report(args.etl_output_dir)
 
 
 if __name__ == "__main__":
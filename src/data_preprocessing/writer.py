@@ -0,0 +1,390 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Pipelined parquet writer for the transformed data.
+
+The transformed partitions of each split are put in a bounded queue, encoded
+to parquet by a pool of encoder threads and uploaded asynchronously, so the
+next partition is transformed while the previous ones are encoded and
+uploaded. With num_shards, the partitions are regrouped into that many shards
+of equal row counts. With global_shuffle, the rows of the shuffled splits are
+first shuffled across the whole split in two passes over local buckets. Each
+split directory gets a manifest of its shards with their row counts, sizes and
+id ranges, which the trainer plans its reads from:
+
+    <output_dir>/<split>/part_<i>.parquet
+    <output_dir>/<split>/_manifest.json
+"""
+
+import os
+import re
+import json
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import tensorflow.io as tf_io
+
+from src.common import features, utils
+
+RANDOM_STATE = 42
+ROW_GROUP_SIZE = 64 * 1024
+COMPRESSION = "snappy"
+COMPRESSIONS = ["snappy", "zstd", "gzip", "none"]
+MAX_QUEUED_PARTITIONS = 4
+NUM_ENCODER_THREADS = 2
+NUM_UPLOAD_THREADS = 4
+MANIFEST_FILE = "_manifest.json"
+LOCAL_OUTPUT_DIR = "transformed_output"
+SHUFFLE_DIR = "shuffle_buckets"
+NUM_SHUFFLE_BUCKETS = 64
+
+
+def read_manifest(split_dir):
+    manifest_file = os.path.join(split_dir, MANIFEST_FILE)
+    if not tf_io.gfile.exists(manifest_file):
+        return None
+    with tf_io.gfile.GFile(manifest_file, "r") as file:
+        return json.load(file)
+
+
+def get_shard_key(file_name):
+    # Orders the shards by prefix, then by index, so part_2 precedes part_10.
+    match = re.match(r"(.*)part_(\d+)\.parquet$", file_name)
+    if not match:
+        return file_name, -1
+    return match.group(1), int(match.group(2))
+
+
+def write_manifest(split_dir, shards, row_group_size, global_shuffle=False):
+    manifest = {
+        "num_rows": sum(shard["rows"] for shard in shards),
+        "row_group_size": row_group_size,
+        "global_shuffle": global_shuffle,
+        "shards": sorted(shards, key=lambda shard: get_shard_key(shard["file"])),
+    }
+    with tf_io.gfile.GFile(os.path.join(split_dir, MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def select_shards(manifest, file_names):
+    # Returns the entries of the manifest for the given shard files only.
+    file_names = set(file_names)
+    return [shard for shard in manifest["shards"] if shard["file"] in file_names]
+
+
+def remove_stale_shards(split_dir, shard_files):
+    # Removes the shards of previous runs that are not in shard_files, so that
+    # readers globbing the split directory only find the current shards.
+    for file_name in tf_io.gfile.listdir(split_dir):
+        if file_name.endswith(".parquet") and file_name not in shard_files:
+            tf_io.gfile.remove(os.path.join(split_dir, file_name))
+
+
+def get_shard_sizes(num_rows, num_shards):
+    # Row counts differ by at most one between shards.
+    return [
+        num_rows // num_shards + (1 if shard_index < num_rows % num_shards else 0)
+        for shard_index in range(num_shards)
+    ]
+
+
+def rebalance(tables, shard_sizes):
+    # Regroups a stream of tables into tables of the given sizes. Only the rows
+    # of the current shard are held. Rows beyond the expected total are
+    # yielded as a last extra shard.
+    shard_sizes = [size for size in shard_sizes if size > 0]
+    pending, num_pending = [], 0
+    for table in tables:
+        pending.append(table)
+        num_pending += table.num_rows
+        while shard_sizes and num_pending >= shard_sizes[0]:
+            combined = pa.concat_tables(pending)
+            yield combined.slice(0, shard_sizes[0])
+            pending = [combined.slice(shard_sizes[0])]
+            num_pending -= shard_sizes.pop(0)
+    if num_pending:
+        logging.warning(
+            f"{num_pending} rows were not expected when sharding, "
+            f"{len(shard_sizes)} shards are short."
+        )
+        yield pa.concat_tables(pending)
+
+
+def bucket_shuffle(tables, num_buckets, scratch_dir, seed=RANDOM_STATE):
+    # Shuffles a stream of tables across all of them with bounded memory. The
+    # first pass scatters the rows of each table to a random bucket on local
+    # disk; the second pass reads one bucket at a time and permutes it. Each
+    # row ends up at a uniformly random position, and only one input table or
+    # one bucket is held in memory.
+    random_state = np.random.RandomState(seed)
+    if tf_io.gfile.exists(scratch_dir):
+        tf_io.gfile.rmtree(scratch_dir)
+    tf_io.gfile.makedirs(scratch_dir)
+    num_pieces = 0
+    for table in tables:
+        buckets = random_state.randint(0, num_buckets, table.num_rows)
+        order = np.argsort(buckets, kind="stable")
+        table = table.take(pa.array(order))
+        offsets = np.zeros(num_buckets + 1, dtype=np.int64)
+        np.cumsum(np.bincount(buckets, minlength=num_buckets), out=offsets[1:])
+        for bucket in np.flatnonzero(np.diff(offsets)):
+            bucket_dir = os.path.join(scratch_dir, f"bucket_{bucket:05d}")
+            tf_io.gfile.makedirs(bucket_dir)
+            feather.write_feather(
+                table.slice(offsets[bucket], offsets[bucket + 1] - offsets[bucket]),
+                os.path.join(bucket_dir, f"piece_{num_pieces:05d}.feather"),
+                compression="uncompressed",
+            )
+        num_pieces += 1
+
+    for bucket in range(num_buckets):
+        bucket_dir = os.path.join(scratch_dir, f"bucket_{bucket:05d}")
+        if not tf_io.gfile.exists(bucket_dir):
+            continue
+        table = pa.concat_tables(
+            feather.read_table(os.path.join(bucket_dir, file_name))
+            for file_name in sorted(tf_io.gfile.listdir(bucket_dir))
+        )
+        tf_io.gfile.rmtree(bucket_dir)
+        yield table.take(pa.array(random_state.permutation(table.num_rows)))
+    tf_io.gfile.rmtree(scratch_dir)
+
+
+def get_id_ranges(table):
+    id_ranges = {}
+    for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+        if feature_name in table.column_names and table.num_rows:
+            min_max = pc.min_max(table[feature_name])
+            id_ranges[feature_name] = [
+                min_max["min"].as_py(),
+                min_max["max"].as_py(),
+            ]
+    return id_ranges
+
+
+class ParquetShardWriter:
+    # put() blocks while the queue is full, which bounds the number of
+    # transformed partitions held in memory. Shards are written to local_dir
+    # and removed once uploaded; a local output_dir is written directly.
+    # Without num_shards, each partition is written as one shard. With
+    # global_shuffle, the shuffled splits go through bucket_shuffle first, in
+    # num_shuffle_buckets buckets or, by default, one bucket per shard.
+
+    def __init__(
+        self,
+        output_dir,
+        file_prefix="",
+        append=False,
+        num_shards=None,
+        global_shuffle=False,
+        num_shuffle_buckets=None,
+        row_group_size=ROW_GROUP_SIZE,
+        compression=COMPRESSION,
+        max_queued_partitions=MAX_QUEUED_PARTITIONS,
+        num_encoder_threads=NUM_ENCODER_THREADS,
+        num_upload_threads=NUM_UPLOAD_THREADS,
+        local_dir=LOCAL_OUTPUT_DIR,
+    ):
+        self.output_dir = output_dir
+        self.file_prefix = file_prefix
+        self.append = append
+        self.num_shards = num_shards
+        self.global_shuffle = global_shuffle
+        self.num_shuffle_buckets = (
+            num_shuffle_buckets or num_shards or NUM_SHUFFLE_BUCKETS
+        )
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.is_remote = "://" in output_dir
+        self.local_dir = local_dir if self.is_remote else output_dir
+
+        self._queue = queue.Queue(maxsize=max_queued_partitions)
+        self._lock = threading.Lock()
+        self._part_indexes = {}
+        self._shards = {}
+        self._globally_shuffled_splits = set()
+        self._errors = []
+        self._uploads = []
+        self._uploader = ThreadPoolExecutor(max_workers=num_upload_threads)
+        self._encoders = [
+            threading.Thread(target=self._encode, daemon=True)
+            for _ in range(num_encoder_threads)
+        ]
+        for encoder in self._encoders:
+            encoder.start()
+
+    def put(self, split, table, shuffle=False):
+        if self._errors:
+            raise RuntimeError(f"Writing the shards failed: {self._errors[0]}")
+        with self._lock:
+            part_index = self._part_indexes.get(split, 0)
+            self._part_indexes[split] = part_index + 1
+        self._queue.put((split, part_index, table, shuffle))
+
+    def write_splits(self, partitions):
+        # Produces the splits at the same time, one thread per split.
+        # partitions maps each split to an iterable of pyarrow tables, whether
+        # to shuffle them and, to write num_shards equal shards, the number of
+        # rows of the split. Returns the number of rows put per split.
+        def produce(split, tables, shuffle, expected_num_rows=None):
+            if shuffle and self.global_shuffle:
+                tables = bucket_shuffle(
+                    tables,
+                    self.num_shuffle_buckets,
+                    os.path.join(SHUFFLE_DIR, split),
+                )
+                self._globally_shuffled_splits.add(split)
+                shuffle = False
+            if self.num_shards and expected_num_rows is not None:
+                tables = rebalance(
+                    tables, get_shard_sizes(expected_num_rows, self.num_shards)
+                )
+            num_rows = 0
+            for table in tables:
+                self.put(split, table, shuffle)
+                num_rows += table.num_rows
+            return num_rows
+
+        with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+            futures = {
+                split: executor.submit(produce, split, *partition)
+                for split, partition in partitions.items()
+            }
+            return {split: future.result() for split, future in futures.items()}
+
+    def upload_directory(self, source_dir, destination_dir):
+        # Uploads e.g. the saved workflow while the shards are being written.
+        self._uploads.append(
+            self._uploader.submit(utils.upload_directory, source_dir, destination_dir)
+        )
+
+    def _encode(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            split, part_index, table, shuffle = item
+            try:
+                self._write_shard(split, part_index, table, shuffle)
+            except Exception as error:
+                logging.error(f"Writing {split} shard {part_index} failed: {error}")
+                with self._lock:
+                    self._errors.append(error)
+
+    def _write_shard(self, split, part_index, table, shuffle):
+        if shuffle:
+            permutation = np.random.RandomState(RANDOM_STATE + part_index).permutation(
+                table.num_rows
+            )
+            table = table.take(pa.array(permutation))
+
+        file_name = f"{self.file_prefix}part_{part_index}.parquet"
+        local_path = os.path.join(self.local_dir, split, file_name)
+        tf_io.gfile.makedirs(os.path.dirname(local_path))
+        with utils.open_arrow_file(local_path, "wb") as file:
+            pq.write_table(
+                table,
+                file,
+                row_group_size=self.row_group_size,
+                compression=self.compression,
+            )
+
+        shard = {
+            "file": file_name,
+            "rows": table.num_rows,
+            "bytes": tf_io.gfile.stat(local_path).length,
+            "memory_bytes": table.nbytes,
+            "ids": get_id_ranges(table),
+        }
+        with self._lock:
+            self._shards.setdefault(split, []).append(shard)
+
+        if self.is_remote:
+            self._uploads.append(
+                self._uploader.submit(
+                    self._upload,
+                    local_path,
+                    os.path.join(self.output_dir, split, file_name),
+                )
+            )
+
+    def _upload(self, local_path, destination):
+        destination_dir = os.path.dirname(destination)
+        if not tf_io.gfile.exists(destination_dir):
+            tf_io.gfile.makedirs(destination_dir)
+        # A shard of a previous run can have the same name and size.
+        utils.transfer_file(local_path, destination, force=True)
+        tf_io.gfile.remove(local_path)
+
+    def close(self):
+        # Waits for the pending shards and uploads, then writes the manifests.
+        # When appending, e.g. in an incremental run, the shards listed in the
+        # existing manifests are kept. Otherwise the shards of previous runs
+        # are removed once the new ones are written. Returns the manifests by
+        # split.
+        for _ in self._encoders:
+            self._queue.put(None)
+        for encoder in self._encoders:
+            encoder.join()
+        for upload in self._uploads:
+            try:
+                upload.result()
+            except Exception as error:
+                self._errors.append(error)
+        self._uploader.shutdown()
+
+        if self._errors:
+            raise RuntimeError(
+                f"{len(self._errors)} shard(s) or file(s) failed to write. "
+                f"First failure: {self._errors[0]}"
+            )
+
+        manifests = {}
+        for split, shards in self._shards.items():
+            split_dir = os.path.join(self.output_dir, split)
+            new_files = {shard["file"] for shard in shards}
+            previous_manifest = (self.append and read_manifest(split_dir)) or {
+                "shards": []
+            }
+            previous_shards = [
+                shard
+                for shard in previous_manifest["shards"]
+                if shard["file"] not in new_files
+            ]
+            # Shards added to previous ones are not shuffled with them.
+            global_shuffle = (
+                split in self._globally_shuffled_splits and not previous_shards
+            )
+            manifests[split] = write_manifest(
+                split_dir, shards + previous_shards, self.row_group_size, global_shuffle
+            )
+            if not self.append:
+                remove_stale_shards(split_dir, new_files)
+            logging.info(
+                f"{split} manifest: {manifests[split]['num_rows']} rows in "
+                f"{len(manifests[split]['shards'])} shards."
+            )
+
+        if self.is_remote and tf_io.gfile.exists(self.local_dir):
+            tf_io.gfile.rmtree(self.local_dir)
+        if self._globally_shuffled_splits and tf_io.gfile.exists(SHUFFLE_DIR):
+            tf_io.gfile.rmtree(SHUFFLE_DIR)
+        return manifests
@@ -61,6 +61,7 @@ def data_etl_op(
     tensorboard_name: str,
     vertex_training_machine_spec: str,
     image_uri: str,
+    incremental_etl_dir: str,
     dataset: Input[Dataset],
     etl_output: Output[Artifact]
 ):
@@ -74,6 +75,11 @@ def data_etl_op(
     movies_csv_dataset_location = dataset.metadata['movies_csv_data_location']
     ratings_csv_dataset_location = dataset.metadata['ratings_csv_data_location']
     etl_output_dir = etl_output.path.replace("/gcs/", "gs://")
+    etl_args = []
+    if incremental_etl_dir:
+        # Incremental runs add to the output of the previous runs.
+        etl_output_dir = incremental_etl_dir
+        etl_args.append('--incremental')
     
     worker_pool_specs =  [
         {
@@ -88,7 +94,7 @@ def data_etl_op(
                     f'--movies-csv-data-location={movies_csv_dataset_location}',
                     f'--ratings-csv-data-location={ratings_csv_dataset_location}',
                     f'--etl-output-dir={etl_output_dir}',
-                ],
+                ] + etl_args,
             },
         }
     ]
@@ -107,9 +113,10 @@ def data_etl_op(
         tensorboard=tensorboard_name
     )
     
-    etl_output.metadata['transformed_train_data_dir'] = os.path.join(etl_output.path, "transformed_data/train")
-    etl_output.metadata['transformed_test_data_dir'] = os.path.join(etl_output.path, "transformed_data/test")
-    etl_output.metadata['transform_workflow_dir'] = os.path.join(etl_output.path, "transform_workflow")
+    etl_output_path = etl_output_dir.replace("gs://", "/gcs/")
+    etl_output.metadata['transformed_train_data_dir'] = os.path.join(etl_output_path, "transformed_data/train")
+    etl_output.metadata['transformed_test_data_dir'] = os.path.join(etl_output_path, "transformed_data/test")
+    etl_output.metadata['transform_workflow_dir'] = os.path.join(etl_output_path, "transform_workflow")
     
     
 @dsl.component(
@@ -127,6 +134,10 @@ def train_op(
     num_epochs: int,
     batch_size: int, 
     learning_rate: float,
+    lr_scaling: str,
+    warmup_steps: int,
+    lr_decay: str,
+    replica_count: int,
     etl_output: Input[Artifact],
     model: Output[Model]
 ):
@@ -143,27 +154,36 @@ def train_op(
     transform_workflow_dir = etl_output.metadata['transform_workflow_dir']
     model_dir = model.path.replace("/gcs/", "gs://")
     
-    worker_pool_specs =  [
-        {
-            "machine_spec": json.loads(vertex_training_machine_spec),
-            "replica_count": 1,
-            "container_spec": {
-                "image_uri": image_uri,
-                "args": [
-                    "python",
-                    "-m",
-                    "src.model_training.task",
-                    f'--model-dir={model_dir}',
-                    f'--train-data-file-pattern={transformed_train_data}',
-                    f'--eval-data-file-pattern={transformed_eval_data}',
-                    f'--nvt-workflow-dir={transform_workflow_dir}',
-                    f'--num-epochs={num_epochs}',
-                    f'--learning-rate={learning_rate}',
-                    f'--batch-size={batch_size}',
-                ],
-            },
-        }
-    ]
+    worker_pool_spec = {
+        "machine_spec": json.loads(vertex_training_machine_spec),
+        "replica_count": 1,
+        "container_spec": {
+            "image_uri": image_uri,
+            "args": [
+                "python",
+                "-m",
+                "src.model_training.task",
+                f'--model-dir={model_dir}',
+                f'--train-data-file-pattern={transformed_train_data}',
+                f'--eval-data-file-pattern={transformed_eval_data}',
+                f'--nvt-workflow-dir={transform_workflow_dir}',
+                f'--num-epochs={num_epochs}',
+                f'--learning-rate={learning_rate}',
+                f'--batch-size={batch_size}',
+                f'--lr-scaling={lr_scaling}',
+                f'--warmup-steps={warmup_steps}',
+                f'--lr-decay={lr_decay}',
+            ],
+        },
+    }
+    
+    # Vertex AI sets TF_CONFIG with the first pool as the chief and the second
+    # one as the other workers.
+    worker_pool_specs = [worker_pool_spec]
+    if replica_count > 1:
+        worker_pool_specs.append(
+            dict(worker_pool_spec, replica_count=replica_count - 1)
+        )
     
     job_name = "movielens-tf-training-{}".format(time.strftime("%Y%m%d_%H%M%S"))
 
@@ -24,7 +24,12 @@ from src.kfp_pipelines import components
 def movielens_training(
     num_epochs: int=1,
     learning_rate: float=0.001,
-    batch_size: int=10240
+    batch_size: int=10240,
+    lr_scaling: str="none",
+    warmup_steps: int=0,
+    lr_decay: str="none",
+    replica_count: int=1,
+    incremental_etl_dir: str=""
 ):
     
     get_data = components.get_data_op(
@@ -42,6 +47,7 @@ def movielens_training(
         tensorboard_name=config.TENSORBOARD_RESOURCE_NAME,
         vertex_training_machine_spec=json.dumps(config.VERTEX_TRAINING_MACHINE_SPEC),
         image_uri=config.NVT_IMAGE_URI,
+        incremental_etl_dir=incremental_etl_dir,
         dataset=get_data.outputs['dataset']
     )
     
@@ -56,6 +62,10 @@ def movielens_training(
         num_epochs=num_epochs,
         batch_size=batch_size, 
         learning_rate=learning_rate,
+        lr_scaling=lr_scaling,
+        warmup_steps=warmup_steps,
+        lr_decay=lr_decay,
+        replica_count=replica_count,
         etl_output=prep_data.outputs['etl_output']
     )
     
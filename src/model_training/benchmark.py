@@ -0,0 +1,681 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Input pipeline benchmark for the training data loader.
+
+Iterates the training loader alone, with the settings of trainer.train, and
+then times fit steps on the same data, to tell whether training is limited by
+the input pipeline or by compute. With --compare-training-modes, it also
+compares the step time and evaluation metrics of the mixed precision and XLA
+training modes with the default one. For example:
+
+    python -m src.model_training.benchmark --loader cpu \
+        --batch-sizes 8192,32768 --buffer-sizes 0.03,0.06
+
+With --compare-user-embeddings, it compares the evaluation metrics and the
+embedding memory of the full, hashed and quotient-remainder userId tables.
+
+With --compare-embedding-lookups, it instead times the forward and backward
+pass of the feature column model and of the native lookup model, with the
+same weights, on synthetic batches.
+
+With --compare-optimizers, it instead compares the slot memory and step time
+of the embedding optimizers on synthetic lookups, for each vocabulary size:
+
+    python -m src.model_training.benchmark --compare-optimizers \
+        --batch-sizes 1024,8192 --vocabulary-sizes 100000,1000000
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import tensorflow as tf
+
+from src.common import multihot
+from src.data_preprocessing import cpu_workflow
+from src.data_preprocessing.profiler import StageProfiler
+from src.data_preprocessing.writer import ParquetShardWriter
+from src.model_training import dataloader, embeddings, model, optimizers, trainer
+
+SYNTHETIC_NUM_ROWS = 1000000
+SYNTHETIC_NUM_USERS = 100000
+SYNTHETIC_NUM_MOVIES = 20000
+SYNTHETIC_NUM_GENRES = 20
+SYNTHETIC_NUM_SHARDS = 8
+SYNTHETIC_PARTITION_ROWS = 250000
+MAX_BATCHES = 200
+FIT_STEPS = 50
+WARMUP_STEPS = 5
+EVAL_STEPS = 20
+RANDOM_STATE = 42
+VOCABULARY_SIZES = "100000,1000000"
+OPTIMIZER_EMBEDDING_DIM = 64
+OPTIMIZER_STEPS = 50
+
+TRAINING_MODES = {
+    "default": {},
+    "mixed_precision": {"mixed_precision": True},
+    "jit_compile": {"jit_compile": True},
+    "mixed_precision_jit_compile": {"mixed_precision": True, "jit_compile": True},
+}
+
+USER_EMBEDDING_MODES = {
+    "full": {"user_embedding": "full"},
+    "hash": {"user_embedding": "hash"},
+    "qr": {"user_embedding": "qr"},
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--data-file-pattern",
+        type=str,
+        default=None,
+        help="Transformed parquet files. A synthetic dataset is used by default.",
+    )
+
+    parser.add_argument(
+        "--transform-workflow-dir",
+        type=str,
+        default=None,
+        help="Workflow of the data files, for the embedding sizes of the model.",
+    )
+
+    parser.add_argument("--synthetic-rows", type=int, default=SYNTHETIC_NUM_ROWS)
+
+    parser.add_argument(
+        "--batch-sizes", type=str, default=str(trainer.BATCH_SIZE)
+    )
+
+    parser.add_argument(
+        "--buffer-sizes", type=str, default=str(dataloader.BUFFER_SIZE)
+    )
+
+    parser.add_argument(
+        "--loader",
+        type=str,
+        default="auto",
+        choices=["auto", "gpu", "cpu"],
+    )
+
+    parser.add_argument("--max-batches", type=int, default=MAX_BATCHES)
+
+    parser.add_argument(
+        "--fit-steps",
+        type=int,
+        default=FIT_STEPS,
+        help="Fit steps timed per batch size, 0 to only benchmark the loader.",
+    )
+
+    parser.add_argument(
+        "--compare-training-modes",
+        action="store_true",
+        help="Compare mixed precision and XLA with the default training mode. "
+        "The metrics are only meaningful on real data.",
+    )
+
+    parser.add_argument(
+        "--eval-data-file-pattern",
+        type=str,
+        default=None,
+        help="Held-out files, e.g. the test split, to evaluate the compared "
+        "modes on. Needed with --data-file-pattern.",
+    )
+
+    parser.add_argument(
+        "--compare-user-embeddings",
+        action="store_true",
+        help="Compare the compact userId embeddings with the full table.",
+    )
+
+    parser.add_argument(
+        "--user-embedding-buckets", type=int, default=embeddings.NUM_BUCKETS
+    )
+
+    parser.add_argument("--eval-steps", type=int, default=EVAL_STEPS)
+
+    parser.add_argument(
+        "--compare-optimizers",
+        action="store_true",
+        help="Compare the embedding optimizers on synthetic lookups.",
+    )
+
+    parser.add_argument("--vocabulary-sizes", type=str, default=VOCABULARY_SIZES)
+
+    parser.add_argument(
+        "--compare-embedding-lookups",
+        action="store_true",
+        help="Compare the native embedding lookups with the feature columns.",
+    )
+
+    parser.add_argument("--output-file", type=str, default=None)
+
+    return parser.parse_args()
+
+
+def write_synthetic_dataset(
+    output_dir,
+    num_rows=SYNTHETIC_NUM_ROWS,
+    num_users=SYNTHETIC_NUM_USERS,
+    num_movies=SYNTHETIC_NUM_MOVIES,
+    num_genres=SYNTHETIC_NUM_GENRES,
+):
+    # Writes transformed-like train and test splits, with popularity-skewed ids
+    # and one to three genres per row, and returns their file patterns and the
+    # embedding shapes.
+    writer = ParquetShardWriter(output_dir, num_shards=SYNTHETIC_NUM_SHARDS)
+    num_test_rows = max(1, num_rows // 10)
+
+    def generate_partitions(num_rows, seed):
+        # The splits are written by concurrent threads, each with its own
+        # random state.
+        random_state = np.random.RandomState(seed)
+        for start in range(0, num_rows, SYNTHETIC_PARTITION_ROWS):
+            size = min(SYNTHETIC_PARTITION_ROWS, num_rows - start)
+            nnzs = random_state.randint(1, 4, size)
+            genre_values = random_state.randint(1, num_genres + 1, nnzs.sum())
+            yield pa.Table.from_arrays(
+                [
+                    pa.array(np.minimum(random_state.zipf(1.2, size), num_users)),
+                    pa.array(np.minimum(random_state.zipf(1.2, size), num_movies)),
+                    multihot.to_list_array(
+                        genre_values.astype(np.int64),
+                        multihot.lengths_to_offsets(nnzs),
+                    ),
+                    pa.array(random_state.randint(0, 2, size).astype(np.float32)),
+                ],
+                names=["userId", "movieId", "genres", "rating"],
+            )
+
+    writer.write_splits(
+        {
+            "train": (generate_partitions(num_rows, RANDOM_STATE), False, num_rows),
+            "test": (
+                generate_partitions(num_test_rows, RANDOM_STATE + 1),
+                False,
+                num_test_rows,
+            ),
+        }
+    )
+    writer.close()
+
+    embedding_shapes = {
+        "userId": cpu_workflow.get_embedding_size(num_users + 1),
+        "movieId": cpu_workflow.get_embedding_size(num_movies + 1),
+        "genres": cpu_workflow.get_embedding_size(num_genres + 1),
+    }
+    return (
+        os.path.join(output_dir, "train", "*.parquet"),
+        os.path.join(output_dir, "test", "*.parquet"),
+        embedding_shapes,
+    )
+
+
+def get_batch_size(labels):
+    return int(labels.shape[0])
+
+
+def benchmark_loader(data_plan, batch_size, buffer_size, cpu, max_batches):
+    profiler = StageProfiler()
+    with profiler.stage("loader") as counters:
+        start_time = time.time()
+        loader = dataloader.create_loader(
+            data_plan.data_files,
+            batch_size,
+            shuffle=True,
+            part_size=data_plan.part_size,
+            cpu=cpu,
+            buffer_size=buffer_size,
+        )
+        first_batch_seconds, first_batch_rows = None, 0
+        num_batches, num_rows = 0, 0
+        for _, labels in loader:
+            if first_batch_seconds is None:
+                first_batch_seconds = time.time() - start_time
+                first_batch_rows = get_batch_size(labels)
+            num_batches += 1
+            num_rows += get_batch_size(labels)
+            if num_batches >= max_batches:
+                break
+        counters["rows"] = num_rows
+    if hasattr(loader, "stop"):
+        loader.stop()
+    profiler.close()
+
+    # The rates exclude the first batch, whose time is reported on its own.
+    stage = profiler.stages["loader"]
+    steady_seconds = max(stage["seconds"] - (first_batch_seconds or 0), 1e-9)
+    return {
+        "batch_size": batch_size,
+        "buffer_size": None if cpu else buffer_size,
+        "batches": num_batches,
+        "time_to_first_batch_seconds": first_batch_seconds,
+        "batches_per_second": (num_batches - 1) / steady_seconds,
+        "rows_per_second": (num_rows - first_batch_rows) / steady_seconds,
+        "peak_host_memory_bytes": stage["peak_host_memory_bytes"],
+        "peak_device_memory_bytes": stage["peak_device_memory_bytes"],
+    }
+
+
+def get_embedding_bytes(recommendation_model):
+    return sum(
+        variable.shape.num_elements() * variable.dtype.size
+        for variable in recommendation_model.trainable_variables
+        if optimizers.is_embedding_variable(variable)
+    )
+
+
+def benchmark_fit(
+    data_plan,
+    embedding_shapes,
+    batch_size,
+    cpu,
+    fit_steps,
+    training_mode=None,
+    eval_steps=0,
+    eval_data_plan=None,
+):
+    hyperparams = trainer.update_hyperparams(
+        {"batch_size": batch_size, **(training_mode or {})}
+    )
+    recommendation_model = trainer.create_model(embedding_shapes, hyperparams)
+    loader = dataloader.create_loader(
+        data_plan.data_files,
+        batch_size,
+        shuffle=True,
+        part_size=data_plan.part_size,
+        cpu=cpu,
+    )
+
+    # The first steps trace the train function and are not timed.
+    recommendation_model.fit(loader, steps_per_epoch=WARMUP_STEPS, verbose=0)
+    start_time = time.time()
+    recommendation_model.fit(loader, steps_per_epoch=fit_steps, verbose=0)
+    seconds = time.time() - start_time
+    if hasattr(loader, "stop"):
+        loader.stop()
+
+    result = {
+        "batch_size": batch_size,
+        "embedding_bytes": get_embedding_bytes(recommendation_model),
+        "steps": fit_steps,
+        "steps_per_second": fit_steps / seconds,
+        "rows_per_second": fit_steps * batch_size / seconds,
+    }
+    if eval_steps:
+        # Held-out rows, so that a larger table cannot score better by
+        # memorising the rows it was trained on.
+        eval_loader = dataloader.create_loader(
+            eval_data_plan.data_files,
+            batch_size,
+            shuffle=False,
+            part_size=eval_data_plan.part_size,
+            cpu=cpu,
+        )
+        result["eval_loss"], result["eval_mae"] = recommendation_model.evaluate(
+            eval_loader, steps=eval_steps, verbose=0
+        )
+        if hasattr(eval_loader, "stop"):
+            eval_loader.stop()
+    return result
+
+
+def compare_training_modes(
+    data_plan,
+    eval_data_plan,
+    embedding_shapes,
+    batch_size,
+    cpu,
+    args,
+    training_modes=TRAINING_MODES,
+    baseline="default",
+):
+    results = {}
+    for mode_name, training_mode in training_modes.items():
+        results[mode_name] = benchmark_fit(
+            data_plan,
+            embedding_shapes,
+            batch_size,
+            cpu,
+            args.fit_steps or FIT_STEPS,
+            training_mode,
+            args.eval_steps or EVAL_STEPS,
+            eval_data_plan,
+        )
+    default = results[baseline]
+    for mode_name, result in results.items():
+        result["speedup"] = result["steps_per_second"] / default["steps_per_second"]
+        result["eval_loss_delta"] = result["eval_loss"] - default["eval_loss"]
+        result["embedding_bytes_ratio"] = (
+            result["embedding_bytes"] / default["embedding_bytes"]
+        )
+        logging.info(
+            f"{mode_name} batch_size={batch_size}: "
+            f"{1000 / result['steps_per_second']:.1f} ms/step "
+            f"({result['speedup']:.2f}x), eval loss {result['eval_loss']:.4f}, "
+            f"eval MAE {result['eval_mae']:.4f}, "
+            f"{result['embedding_bytes'] / 2 ** 20:.1f} MiB of embeddings"
+        )
+    trainer.set_precision_policy(False)
+    return results
+
+
+def benchmark_optimizer(
+    embedding_optimizer,
+    vocabulary_size,
+    batch_size,
+    embedding_dim=OPTIMIZER_EMBEDDING_DIM,
+    steps=OPTIMIZER_STEPS,
+):
+    # Times train steps of one embedding table with a dense layer on top, with
+    # popularity-skewed ids like the userId and movieId columns.
+    random_state = np.random.RandomState(RANDOM_STATE)
+    ids = tf.constant(
+        np.minimum(random_state.zipf(1.2, (steps, batch_size)), vocabulary_size)
+        - 1
+    )
+    embeddings = tf.Variable(
+        tf.random.uniform([vocabulary_size, embedding_dim], -0.05, 0.05),
+        name="embeddings",
+    )
+    dense = tf.keras.layers.Dense(1)
+    optimizer = optimizers.create_optimizer(trainer.LEARNING_RATE, embedding_optimizer)
+
+    @tf.function
+    def train_step(batch_ids):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(
+                tf.square(dense(tf.gather(embeddings, batch_ids)) - 1.0)
+            )
+        variables = [embeddings] + dense.trainable_variables
+        optimizer.apply_gradients(zip(tape.gradient(loss, variables), variables))
+        return loss
+
+    # The first step creates the slots and traces the function.
+    train_step(ids[0]).numpy()
+    start_time = time.time()
+    for step in range(1, steps):
+        loss = train_step(ids[step])
+    loss.numpy()
+    seconds = time.time() - start_time
+
+    embedding_bytes, dense_bytes = optimizers.get_slot_bytes(
+        optimizer, [embeddings] + dense.trainable_variables
+    )
+    return {
+        "embedding_optimizer": embedding_optimizer,
+        "vocabulary_size": vocabulary_size,
+        "batch_size": batch_size,
+        "ms_per_step": 1000 * seconds / (steps - 1),
+        "embedding_slot_bytes": embedding_bytes,
+        "dense_slot_bytes": dense_bytes,
+    }
+
+
+def compare_optimizers(batch_sizes, vocabulary_sizes):
+    results = []
+    for vocabulary_size in vocabulary_sizes:
+        for batch_size in batch_sizes:
+            adam = None
+            for embedding_optimizer in optimizers.EMBEDDING_OPTIMIZERS:
+                result = benchmark_optimizer(
+                    embedding_optimizer, vocabulary_size, batch_size
+                )
+                adam = adam or result
+                result["embedding_slot_ratio"] = (
+                    result["embedding_slot_bytes"] / adam["embedding_slot_bytes"]
+                )
+                logging.info(
+                    f"{embedding_optimizer} vocabulary_size={vocabulary_size} "
+                    f"batch_size={batch_size}: {result['ms_per_step']:.2f} ms/step, "
+                    f"{result['embedding_slot_bytes'] / 2 ** 20:.1f} MiB of "
+                    f"embedding slots ({result['embedding_slot_ratio']:.3f}x)"
+                )
+                results.append(result)
+    return results
+
+
+def create_synthetic_batch(batch_size, random_state):
+    # A batch like the ones of the loaders, with one to three genres per row.
+    nnzs = random_state.randint(1, 4, (batch_size, 1))
+    inputs = {
+        "userId": np.minimum(
+            random_state.zipf(1.2, (batch_size, 1)), SYNTHETIC_NUM_USERS
+        ).astype(np.int32),
+        "movieId": np.minimum(
+            random_state.zipf(1.2, (batch_size, 1)), SYNTHETIC_NUM_MOVIES
+        ).astype(np.int32),
+        "genres": (
+            random_state.randint(1, SYNTHETIC_NUM_GENRES + 1, (nnzs.sum(), 1)),
+            nnzs.astype(np.int64),
+        ),
+    }
+    labels = random_state.randint(0, 2, (batch_size, 1)).astype(np.float32)
+    return tf.nest.map_structure(tf.constant, inputs), tf.constant(labels)
+
+
+def benchmark_model_step(recommendation_model, inputs, labels, steps):
+    loss_fn = tf.keras.losses.BinaryCrossentropy()
+
+    @tf.function
+    def step():
+        with tf.GradientTape() as tape:
+            loss = loss_fn(labels, recommendation_model(inputs, training=True))
+        gradients = tape.gradient(loss, recommendation_model.trainable_variables)
+        return tf.linalg.global_norm(gradients)
+
+    # The first step traces the function.
+    step().numpy()
+    start_time = time.time()
+    for _ in range(steps):
+        gradient_norm = step()
+    gradient_norm.numpy()
+    return 1000 * (time.time() - start_time) / steps
+
+
+def compare_embedding_lookups(batch_sizes, steps=OPTIMIZER_STEPS):
+    random_state = np.random.RandomState(RANDOM_STATE)
+    embedding_shapes = {
+        "userId": cpu_workflow.get_embedding_size(SYNTHETIC_NUM_USERS + 1),
+        "movieId": cpu_workflow.get_embedding_size(SYNTHETIC_NUM_MOVIES + 1),
+        "genres": cpu_workflow.get_embedding_size(SYNTHETIC_NUM_GENRES + 1),
+    }
+    feature_column_model = model.create(embedding_shapes, trainer.HIDDEN_UNITS)
+    native_model = model.create(
+        embedding_shapes, trainer.HIDDEN_UNITS, embedding_lookup="native"
+    )
+    model.transfer_weights(feature_column_model, native_model)
+
+    results = []
+    for batch_size in batch_sizes:
+        inputs, labels = create_synthetic_batch(batch_size, random_state)
+        # With the same weights, both models must predict the same.
+        max_difference = float(
+            tf.reduce_max(
+                tf.abs(feature_column_model(inputs) - native_model(inputs))
+            )
+        )
+        result = {"batch_size": batch_size, "max_prediction_difference": max_difference}
+        for name, recommendation_model in [
+            ("feature_column", feature_column_model),
+            ("native", native_model),
+        ]:
+            result[f"{name}_ms_per_step"] = benchmark_model_step(
+                recommendation_model, inputs, labels, steps
+            )
+        result["speedup"] = result["feature_column_ms_per_step"] / result[
+            "native_ms_per_step"
+        ]
+        logging.info(
+            f"batch_size={batch_size}: feature columns "
+            f"{result['feature_column_ms_per_step']:.2f} ms/step, native "
+            f"{result['native_ms_per_step']:.2f} ms/step "
+            f"({result['speedup']:.2f}x), max prediction difference "
+            f"{max_difference:.2e}"
+        )
+        results.append(result)
+    return results
+
+
+def compare(loader_result, fit_result):
+    # Training is input bound when the loader alone is barely faster than the
+    # loader and the train step together.
+    headroom = loader_result["rows_per_second"] / fit_result["rows_per_second"]
+    return {"loader_headroom": headroom, "input_bound": headroom < 1.2}
+
+
+def write_results(results, output_file):
+    with tf.io.gfile.GFile(output_file, "w") as file:
+        json.dump(results, file, indent=2)
+    logging.info(f"Benchmark results are written to {output_file}.")
+
+
+def run(args):
+
+    if args.compare_optimizers or args.compare_embedding_lookups:
+        batch_sizes = [int(value) for value in args.batch_sizes.split(",")]
+        results = {}
+        if args.compare_optimizers:
+            results["optimizers"] = compare_optimizers(
+                batch_sizes, [int(value) for value in args.vocabulary_sizes.split(",")]
+            )
+        if args.compare_embedding_lookups:
+            results["embedding_lookups"] = compare_embedding_lookups(batch_sizes)
+        if args.output_file:
+            write_results(results, args.output_file)
+        return results
+
+    cpu = {"auto": None, "gpu": False, "cpu": True}[args.loader]
+    if cpu is None:
+        cpu = not tf.config.list_physical_devices("GPU")
+
+    synthetic_dir = None
+    is_comparing = args.compare_training_modes or args.compare_user_embeddings
+    if args.data_file_pattern:
+        if not args.transform_workflow_dir and args.fit_steps:
+            raise ValueError("--transform-workflow-dir is needed to fit on real data.")
+        if is_comparing and not args.eval_data_file_pattern:
+            raise ValueError("--eval-data-file-pattern is needed to compare modes.")
+        data_file_pattern = args.data_file_pattern
+        eval_data_file_pattern = args.eval_data_file_pattern
+        embedding_shapes = None
+        if args.transform_workflow_dir:
+            embedding_shapes = trainer.get_embedding_shapes(
+                cpu_workflow.load_workflow(args.transform_workflow_dir)
+            )
+    else:
+        synthetic_dir = tempfile.mkdtemp()
+        logging.info(f"Writing {args.synthetic_rows} synthetic rows...")
+        data_file_pattern, eval_data_file_pattern, embedding_shapes = (
+            write_synthetic_dataset(synthetic_dir, args.synthetic_rows)
+        )
+
+    data_plan = dataloader.create_data_plan(data_file_pattern)
+    eval_data_plan = None
+    if is_comparing:
+        eval_data_plan = dataloader.create_data_plan(eval_data_file_pattern)
+    batch_sizes = [int(value) for value in args.batch_sizes.split(",")]
+    buffer_sizes = [float(value) for value in args.buffer_sizes.split(",")]
+    if cpu:
+        # The CPU loader reads one file at a time and has no buffer to tune.
+        buffer_sizes = buffer_sizes[:1]
+
+    results = []
+    for batch_size in batch_sizes:
+        fit_result = None
+        if args.fit_steps:
+            fit_result = benchmark_fit(
+                data_plan, embedding_shapes, batch_size, cpu, args.fit_steps
+            )
+            logging.info(
+                f"fit batch_size={batch_size}: "
+                f"{fit_result['rows_per_second']:.0f} rows/s"
+            )
+        for buffer_size in buffer_sizes:
+            result = {
+                "loader": "cpu" if cpu else "gpu",
+                **benchmark_loader(
+                    data_plan, batch_size, buffer_size, cpu, args.max_batches
+                ),
+            }
+            if fit_result:
+                result["fit"] = fit_result
+                result.update(compare(result, fit_result))
+            logging.info(
+                f"loader batch_size={batch_size} buffer_size={result['buffer_size']}: "
+                f"{result['batches_per_second']:.1f} batches/s, "
+                f"{result['rows_per_second']:.0f} rows/s, first batch in "
+                f"{result['time_to_first_batch_seconds']:.2f}s"
+            )
+            results.append(result)
+
+        if args.compare_training_modes:
+            results.append(
+                {
+                    "batch_size": batch_size,
+                    "training_modes": compare_training_modes(
+                        data_plan,
+                        eval_data_plan,
+                        embedding_shapes,
+                        batch_size,
+                        cpu,
+                        args,
+                    ),
+                }
+            )
+
+        if args.compare_user_embeddings:
+            user_embedding_modes = {
+                mode_name: dict(
+                    training_mode, user_embedding_buckets=args.user_embedding_buckets
+                )
+                for mode_name, training_mode in USER_EMBEDDING_MODES.items()
+            }
+            results.append(
+                {
+                    "batch_size": batch_size,
+                    "user_embeddings": compare_training_modes(
+                        data_plan,
+                        eval_data_plan,
+                        embedding_shapes,
+                        batch_size,
+                        cpu,
+                        args,
+                        user_embedding_modes,
+                        baseline="full",
+                    ),
+                }
+            )
+
+    if args.output_file:
+        write_results(results, args.output_file)
+    if synthetic_dir:
+        tf.io.gfile.rmtree(synthetic_dir)
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Python Version = {sys.version}")
+    logging.info(f"TensorFlow Version = {tf.__version__}")
+    logging.info(f"DEVICES = {tf.config.list_physical_devices()}")
+    run(get_args())
@@ -0,0 +1,145 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Training checkpoints and early stopping callbacks."""
+
+import os
+import logging
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+CHECKPOINT_DIR = "checkpoints"
+CHECKPOINT_STEPS = 1000
+MAX_TO_KEEP = 2
+# save_weights writes its own checkpoint state file, so the best weights have
+# a directory of their own next to the training checkpoints.
+BEST_WEIGHTS_DIR = "best_weights"
+
+
+class EarlyStopping(keras.callbacks.Callback):
+    # Stops training when the monitored validation metric has not improved for
+    # patience epochs, and restores the weights of the best epoch, like
+    # restore_best_weights. Unlike keras.callbacks.EarlyStopping, its state is
+    # kept across fit calls, e.g. one per epoch, and in the training
+    # checkpoints. The best weights are saved under best_weights_dir, so they
+    # survive a restart, or else kept in memory.
+
+    def __init__(
+        self, monitor="val_loss", patience=1, min_delta=0.0, best_weights_dir=None
+    ):
+        super().__init__()
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best = tf.Variable(np.inf, trainable=False, dtype=tf.float64)
+        self.wait = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.best_weights_path = None
+        if best_weights_dir:
+            self.best_weights_path = os.path.join(
+                best_weights_dir, BEST_WEIGHTS_DIR, "weights"
+            )
+        self._best_weights = None
+
+    @property
+    def stopped(self):
+        return int(self.wait.numpy()) >= self.patience
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if value is None:
+            logging.warning(f"Early stopping metric {self.monitor} is not available.")
+            return
+        if value < self.best.numpy() - self.min_delta:
+            self.best.assign(value)
+            self.wait.assign(0)
+            self._save_best_weights()
+        else:
+            self.wait.assign_add(1)
+        if self.stopped:
+            logging.info(
+                f"{self.monitor} has not improved on {self.best.numpy():.5f} for "
+                f"{self.patience} epochs. Stopping after epoch {epoch + 1} with "
+                "the weights of the best epoch."
+            )
+            self.model.stop_training = True
+            self._restore_best_weights()
+
+    def _save_best_weights(self):
+        if self.best_weights_path:
+            self.model.save_weights(self.best_weights_path)
+        else:
+            self._best_weights = self.model.get_weights()
+
+    def _restore_best_weights(self):
+        if self.best_weights_path:
+            if tf.io.gfile.glob(self.best_weights_path + ".index"):
+                self.model.load_weights(self.best_weights_path).expect_partial()
+        elif self._best_weights is not None:
+            self.model.set_weights(self._best_weights)
+
+
+class TrainingCheckpoint(keras.callbacks.Callback):
+    # Saves the model, the optimizer state, the early stopping state and the
+    # position in training every save_steps batches and after every epoch.
+    # step_offset is the number of batches of the epoch trained before the
+    # current fit call, when an interrupted epoch is resumed.
+
+    def __init__(
+        self,
+        checkpoint_dir,
+        recommendation_model,
+        save_steps=CHECKPOINT_STEPS,
+        early_stopping=None,
+        max_to_keep=MAX_TO_KEEP,
+    ):
+        super().__init__()
+        self.epoch = tf.Variable(0, trainable=False, dtype=tf.int64)
+        self.step = tf.Variable(0, trainable=False, dtype=tf.int64)
+        tracked = {
+            "model": recommendation_model,
+            "optimizer": recommendation_model.optimizer,
+            "epoch": self.epoch,
+            "step": self.step,
+        }
+        if early_stopping:
+            tracked.update(best=early_stopping.best, wait=early_stopping.wait)
+        self.checkpoint = tf.train.Checkpoint(**tracked)
+        self.manager = tf.train.CheckpointManager(
+            self.checkpoint, checkpoint_dir, max_to_keep=max_to_keep
+        )
+        self.save_steps = save_steps
+        self.step_offset = 0
+
+    def restore(self):
+        # Returns the epoch to resume and the number of its batches already
+        # trained on. The optimizer slots are restored when they are created.
+        if self.manager.latest_checkpoint:
+            self.checkpoint.restore(self.manager.latest_checkpoint)
+            logging.info(
+                f"Restored {self.manager.latest_checkpoint}: epoch "
+                f"{int(self.epoch.numpy()) + 1}, step {int(self.step.numpy())}."
+            )
+        return int(self.epoch.numpy()), int(self.step.numpy())
+
+    def on_train_batch_end(self, batch, logs=None):
+        step = self.step_offset + batch + 1
+        if self.save_steps and step % self.save_steps == 0:
+            self.step.assign(step)
+            self.manager.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch.assign(epoch + 1)
+        self.step.assign(0)
+        self.manager.save()
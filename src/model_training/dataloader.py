@@ -0,0 +1,762 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Data loaders for training and evaluation."""
+
+import os
+import math
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+import tensorflow.io as tf_io
+
+from src.common import features, multihot, utils
+from src.data_preprocessing import writer
+
+BUFFER_SIZE = 0.06
+# Globally shuffled data only needs its shards and the rows within each chunk
+# reordered every epoch.
+SHUFFLED_BUFFER_SIZE = 0.01
+PARTS_PER_CHUNK = 1
+
+CACHE_DIR = "data_cache"
+MAX_CACHE_BYTES = 50 * 1024 ** 3
+NUM_PREFETCH_WORKERS = 4
+# Shards read by each KerasSequenceLoader of the cached GPU path.
+SHARD_GROUP_SIZE = 4
+
+# Headroom over the in-memory size of the largest shard, so that each shard is
+# read as exactly one partition.
+PART_SIZE_MARGIN = 1.25
+
+RANDOM_STATE = 42
+
+
+def create_loader(
+    data_files,
+    batch_size,
+    shuffle,
+    part_size=None,
+    global_size=None,
+    global_rank=None,
+    cpu=None,
+    buffer_size=BUFFER_SIZE,
+    parts_per_chunk=PARTS_PER_CHUNK,
+    shard_cache=None,
+):
+
+    # Hosts without a GPU, e.g. local CPU workers, read with pyarrow instead.
+    if cpu is None:
+        cpu = not tf.config.list_physical_devices("GPU")
+    if cpu:
+        # The CPU loader opens one shard at a time, so it only waits for the
+        # shard it reads next.
+        return CpuParquetLoader(
+            data_files,
+            batch_size,
+            shuffle,
+            global_size,
+            global_rank,
+            shard_cache=shard_cache,
+        )
+    if shard_cache:
+        # KerasSequenceLoader opens all its shards when it is created, so the
+        # cached shards are read by one loader per group of shards.
+        return ShardGroupLoader(
+            data_files,
+            batch_size,
+            shuffle,
+            shard_cache,
+            part_size=part_size,
+            global_size=global_size,
+            global_rank=global_rank,
+            buffer_size=buffer_size,
+            parts_per_chunk=parts_per_chunk,
+        )
+    return create_gpu_loader(
+        data_files,
+        batch_size,
+        shuffle,
+        part_size,
+        global_size,
+        global_rank,
+        buffer_size,
+        parts_per_chunk,
+    )
+
+
+def create_gpu_loader(
+    data_files,
+    batch_size,
+    shuffle,
+    part_size=None,
+    global_size=None,
+    global_rank=None,
+    buffer_size=BUFFER_SIZE,
+    parts_per_chunk=PARTS_PER_CHUNK,
+):
+    # nvtabular needs a GPU, so it is only imported for the GPU loader.
+    import nvtabular as nvt
+    from nvtabular.loader.tensorflow import KerasSequenceLoader
+
+    if part_size:
+        # Each partition, and so each chunk, is one shard instead of a fraction
+        # of the device memory.
+        data_files = nvt.Dataset(data_files, engine="parquet", part_size=part_size)
+
+    return KerasSequenceLoader(
+        data_files,
+        batch_size=batch_size,
+        label_names=features.TARGET_FEATURE_NAME,
+        cat_names=features.get_categorical_feature_names(),
+        cont_names=features.NUMERICAL_FEATURE_NAMES,
+        engine="parquet",
+        shuffle=shuffle,
+        buffer_size=buffer_size,  # how many batches to load at once
+        parts_per_chunk=parts_per_chunk,
+        global_size=global_size,
+        global_rank=global_rank,
+    )
+
+
+def count_rows(data_files):
+    # Reads the row counts from the parquet footers.
+    num_rows = []
+    for file_path in data_files:
+        with utils.open_arrow_file(file_path) as file:
+            num_rows.append(pq.ParquetFile(file).metadata.num_rows)
+    return num_rows
+
+
+def split_files(data_files, global_size=None, global_rank=None):
+    # Assigns every file to exactly one of global_size processes, by stride.
+    if isinstance(data_files, str):
+        data_files = sorted(tf_io.gfile.glob(data_files))
+    data_files = list(data_files)
+    if not global_size:
+        return data_files
+    if len(data_files) < global_size:
+        raise ValueError(
+            f"{len(data_files)} files cannot be split between "
+            f"{global_size} processes; write at least one shard per process."
+        )
+    return data_files[global_rank::global_size]
+
+
+def get_file_order(num_files, shuffle, seed, epoch):
+    # The order in which the files are read in an epoch.
+    if not shuffle:
+        return np.arange(num_files)
+    return np.random.RandomState([seed, epoch]).permutation(num_files)
+
+
+class CpuParquetLoader(tf.keras.utils.Sequence):
+    # Returns the batches of the transformed parquet files in the structure of
+    # KerasSequenceLoader, with the genres as a (values, nnzs) pair. One file
+    # is held in memory at a time. Like KerasSequenceLoader, the files are
+    # split between global_size processes. The file order and the row order
+    # of each file only depend on the seed and the epoch, so any batch can be
+    # read by its index, and a pass can start at any batch.
+
+    def __init__(
+        self,
+        data_files,
+        batch_size,
+        shuffle,
+        global_size=None,
+        global_rank=None,
+        seed=RANDOM_STATE,
+        shard_cache=None,
+    ):
+        self.data_files = split_files(data_files, global_size, global_rank)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # Downloads the files ahead of the reader, in the order they are read.
+        self.shard_cache = shard_cache
+        self.num_rows = count_rows(self.data_files)
+        self.epoch = 0
+        self._seed = seed
+        self._start_batch = 0
+        self._order = None
+        self._current_file = None
+
+    def __len__(self):
+        return (
+            sum(math.ceil(num_rows / self.batch_size) for num_rows in self.num_rows)
+            - self._start_batch
+        )
+
+    def seek(self, epoch, num_batches=0):
+        # Starts the epoch at the given batch, which is then index 0. The files
+        # before it are skipped by their row counts, without reading them.
+        self.epoch = epoch
+        self._start_batch = num_batches
+        self._order = None
+        return num_batches
+
+    def _get_order(self):
+        # The files of the epoch in read order, and the index of their first
+        # batch.
+        if self._order is None:
+            file_indices = get_file_order(
+                len(self.data_files), self.shuffle, self._seed, self.epoch
+            )
+            num_batches = [
+                math.ceil(self.num_rows[file_index] / self.batch_size)
+                for file_index in file_indices
+            ]
+            batch_offsets = multihot.lengths_to_offsets(num_batches)
+            self._order = file_indices, batch_offsets
+            if self.shard_cache:
+                first_position = (
+                    np.searchsorted(batch_offsets, self._start_batch, side="right") - 1
+                )
+                self.shard_cache.plan(
+                    [
+                        self.data_files[file_index]
+                        for file_index in file_indices[first_position:]
+                    ]
+                )
+        return self._order
+
+    def __getitem__(self, index):
+        file_indices, batch_offsets = self._get_order()
+        index += self._start_batch
+        if not 0 <= index < batch_offsets[-1]:
+            raise IndexError(f"Batch {index} is out of range.")
+        position = np.searchsorted(batch_offsets, index, side="right") - 1
+        columns, rows = self._load(file_indices[position])
+        start = (index - batch_offsets[position]) * self.batch_size
+        return self._get_batch(columns, rows[start : start + self.batch_size])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._start_batch = 0
+        self._order = None
+
+    def _load(self, file_index):
+        # The columns of a file and its row order in the epoch, kept until
+        # another file is read.
+        key = (self.epoch, file_index)
+        if self._current_file is None or self._current_file[0] != key:
+            num_rows = self.num_rows[file_index]
+            rows = (
+                np.random.RandomState([self._seed, self.epoch, file_index]).permutation(
+                    num_rows
+                )
+                if self.shuffle
+                else np.arange(num_rows)
+            )
+            self._current_file = key, self._read(self.data_files[file_index]), rows
+        return self._current_file[1:]
+
+    def _read(self, file_path):
+        local_file = file_path
+        if self.shard_cache:
+            local_file = self.shard_cache.local_file(file_path)
+        with utils.open_arrow_file(local_file) as file:
+            table = pq.read_table(file)
+        if self.shard_cache:
+            self.shard_cache.release([file_path])
+        columns = {
+            feature_name: table[feature_name].to_pandas().values
+            for feature_name in features.CATEGORICAL_FEATURE_NAMES
+            + features.TARGET_FEATURE_NAME
+        }
+        for feature_name in features.MULTIVALUE_FEATURE_NAMES:
+            list_array = pa.concat_arrays(table[feature_name].chunks)
+            columns[feature_name] = (
+                list_array.values.to_numpy(),
+                list_array.offsets.to_numpy(),
+            )
+        return columns
+
+    def _get_batch(self, columns, rows):
+        batch = {
+            feature_name: columns[feature_name][rows].reshape(-1, 1)
+            for feature_name in features.CATEGORICAL_FEATURE_NAMES
+        }
+        for feature_name in features.MULTIVALUE_FEATURE_NAMES:
+            values, nnzs = multihot.gather_rows(*columns[feature_name], rows)
+            batch[feature_name] = (
+                values.astype(np.int64).reshape(-1, 1),
+                nnzs.astype(np.int64).reshape(-1, 1),
+            )
+        labels = columns[features.TARGET_FEATURE_NAME[0]][rows].reshape(-1, 1)
+        return batch, labels
+
+
+class ShardGroupLoader(tf.keras.utils.Sequence):
+    # Reads the shards of a ShardCache with one KerasSequenceLoader per group of
+    # shards, each created once the shards of its group are cached, so that
+    # training starts when the first group has arrived. The groups are read in
+    # the file order of the epoch, like the CPU loader, and KerasSequenceLoader
+    # shuffles the rows of each group. Like KerasSequenceLoader, the batches
+    # are returned in order whatever the requested index, except that a
+    # repeated request returns the last batch again, so that the peek of Keras
+    # at the first batch does not use it up.
+
+    def __init__(
+        self,
+        data_files,
+        batch_size,
+        shuffle,
+        shard_cache,
+        part_size=None,
+        global_size=None,
+        global_rank=None,
+        buffer_size=BUFFER_SIZE,
+        parts_per_chunk=PARTS_PER_CHUNK,
+        group_size=SHARD_GROUP_SIZE,
+        seed=RANDOM_STATE,
+    ):
+        self.data_files = split_files(data_files, global_size, global_rank)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shard_cache = shard_cache
+        # A chunk of KerasSequenceLoader is parts_per_chunk shards.
+        self.group_size = max(group_size, parts_per_chunk)
+        self._loader_kwargs = {
+            "part_size": part_size,
+            "buffer_size": buffer_size,
+            "parts_per_chunk": parts_per_chunk,
+        }
+        self.num_rows = count_rows(self.data_files)
+        self._file_rows = dict(zip(self.data_files, self.num_rows))
+        self.epoch = 0
+        self._seed = seed
+        self._start_group = 0
+        self._groups = None
+        self._loader = None
+        self._reset()
+
+    def _get_groups(self):
+        if self._groups is None:
+            file_indices = get_file_order(
+                len(self.data_files), self.shuffle, self._seed, self.epoch
+            )
+            data_files = [self.data_files[file_index] for file_index in file_indices]
+            self._groups = [
+                data_files[start : start + self.group_size]
+                for start in range(0, len(data_files), self.group_size)
+            ]
+        return self._groups
+
+    def _get_num_batches(self, group):
+        num_rows = sum(self._file_rows[file_path] for file_path in group)
+        return math.ceil(num_rows / self.batch_size)
+
+    def __len__(self):
+        return sum(
+            self._get_num_batches(group)
+            for group in self._get_groups()[self._start_group :]
+        )
+
+    def seek(self, epoch, num_batches=0):
+        # Starts the epoch at the group of the given batch. The rows of a group
+        # are shuffled by KerasSequenceLoader, so the batches of that group
+        # are taken from a new shuffle of all its rows. Returns the first batch
+        # of the group.
+        self.stop()
+        self.epoch = epoch
+        self._groups = None
+        self._start_group, start_batch = 0, 0
+        for group in self._get_groups():
+            group_batches = self._get_num_batches(group)
+            if start_batch + group_batches > num_batches:
+                break
+            start_batch += group_batches
+            self._start_group += 1
+        self._reset()
+        return start_batch
+
+    def __getitem__(self, index):
+        if index == self._position - 1:
+            return self._last_batch
+        self._last_batch = self._next_batch()
+        self._position += 1
+        return self._last_batch
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def _next_batch(self):
+        groups = self._get_groups()
+        if not self._is_planned:
+            # The cache downloads the shards in the order they are read.
+            self.shard_cache.plan(
+                [
+                    file_path
+                    for group in groups[self._group_index :]
+                    for file_path in group
+                ]
+            )
+            self._is_planned = True
+        while True:
+            if self._loader is None:
+                if self._group_index >= len(groups):
+                    raise IndexError("All the batches of the epoch are read.")
+                self._loader_files = groups[self._group_index]
+                self._loader = create_gpu_loader(
+                    self.shard_cache.resolve(self._loader_files),
+                    self.batch_size,
+                    self.shuffle,
+                    **self._loader_kwargs,
+                )
+                self._batches = iter(self._loader)
+            try:
+                return next(self._batches)
+            except StopIteration:
+                self.stop()
+                self._group_index += 1
+
+    def _reset(self):
+        self.stop()
+        self._group_index = self._start_group
+        self._position = 0
+        self._last_batch = None
+        self._is_planned = False
+
+    def stop(self):
+        if self._loader is not None:
+            self._loader.stop()
+            self.shard_cache.release(self._loader_files)
+        self._loader = None
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self._start_group = 0
+        self._groups = None
+        self._reset()
+
+
+def to_tf_dataset(loader):
+    # Wraps a loader in a tf.data dataset, with the tensor specs of its first
+    # batch, so that a distribution strategy can feed it to its replicas.
+    first_batch = next(iter(loader))
+    output_signature = tf.nest.map_structure(
+        lambda tensor: tf.TensorSpec(
+            (None,) + tuple(tensor.shape[1:]), tf.as_dtype(tensor.dtype)
+        ),
+        first_batch,
+    )
+
+    def generate():
+        yield from loader
+        # Keras calls on_epoch_end of the loaders it iterates itself.
+        if isinstance(loader, (CpuParquetLoader, ShardGroupLoader)):
+            loader.on_epoch_end()
+
+    return tf.data.Dataset.from_generator(generate, output_signature=output_signature)
+
+
+def is_remote(file_pattern):
+    return "://" in file_pattern
+
+
+def read_manifest(file_pattern):
+    # The manifest written by the ETL next to the shards, if any. Only a pattern
+    # of all the shards of a split is planned from it.
+    if not isinstance(file_pattern, str):
+        return None
+    if os.path.basename(file_pattern) != "*.parquet":
+        return None
+    return writer.read_manifest(os.path.dirname(file_pattern))
+
+
+def plan_shards(manifest, num_workers=1):
+    # Assigns the shards to the workers so that their row counts are as even as
+    # possible: largest shards first, each to the worker with the fewest rows.
+    assignments = [[] for _ in range(num_workers)]
+    worker_rows = [0] * num_workers
+    for shard in sorted(manifest["shards"], key=lambda shard: -shard["rows"]):
+        worker_index = worker_rows.index(min(worker_rows))
+        assignments[worker_index].append(shard)
+        worker_rows[worker_index] += shard["rows"]
+    return [
+        sorted(shards, key=lambda shard: writer.get_shard_key(shard["file"]))
+        for shards in assignments
+    ]
+
+
+def create_distributed_dataset(
+    strategy, file_pattern, global_batch_size, shuffle, num_workers
+):
+    # Returns the dataset distributed by the strategy and the steps per epoch.
+    # Each worker reads its own shards: from the manifest plan when there is
+    # one, else from the loader's global_size/global_rank split. The steps are
+    # the same on every worker, so none of them blocks the others in the
+    # collective ops, and the datasets repeat so none of them runs out early.
+    per_worker_batch_size = global_batch_size // num_workers
+    manifest = read_manifest(file_pattern)
+    if manifest:
+        worker_rows = [
+            sum(shard["rows"] for shard in shards)
+            for shards in plan_shards(manifest, num_workers)
+        ]
+        steps = min(worker_rows) // per_worker_batch_size
+    else:
+        steps = sum(count_rows(tf_io.gfile.glob(file_pattern))) // global_batch_size
+
+    def dataset_fn(input_context):
+        data_plan = create_data_plan(
+            file_pattern,
+            input_context.num_input_pipelines,
+            input_context.input_pipeline_id,
+        )
+        global_size, global_rank = None, None
+        if data_plan.num_rows is None:
+            global_size = input_context.num_input_pipelines
+            global_rank = input_context.input_pipeline_id
+        loader = create_loader(
+            data_plan.data_files,
+            input_context.get_per_replica_batch_size(global_batch_size),
+            shuffle,
+            part_size=data_plan.part_size,
+            global_size=global_size,
+            global_rank=global_rank,
+        )
+        return to_tf_dataset(loader).repeat()
+
+    logging.info(f"Each worker runs {steps} steps of {per_worker_batch_size} rows.")
+    return strategy.distribute_datasets_from_function(dataset_fn), max(steps, 1)
+
+
+def sample_files(data_files, fraction, seed=RANDOM_STATE):
+    # Returns a fixed random subset of the files, at least one. The shards of
+    # the ETL have the same number of rows, so it is a sample of the rows too.
+    if isinstance(data_files, str):
+        data_files = sorted(tf_io.gfile.glob(data_files))
+    num_files = min(max(1, int(round(len(data_files) * fraction))), len(data_files))
+    indices = np.random.RandomState(seed).choice(
+        len(data_files), num_files, replace=False
+    )
+    return [data_files[index] for index in sorted(indices)]
+
+
+def seek(loader, epoch, num_batches=0):
+    # Positions a loader at a batch of an epoch, to resume it. Returns the batch
+    # it resumes at and the number of batches left in the epoch. The CPU loader
+    # skips whole files by their row counts. The cached GPU loader skips whole
+    # groups of shards.
+    # KerasSequenceLoader shuffles with its own random state, so the rest of an
+    # interrupted epoch is taken from a new shuffle of all the files. Neither
+    # reads the skipped batches.
+    if isinstance(loader, (CpuParquetLoader, ShardGroupLoader)):
+        start_batch = loader.seek(epoch, num_batches)
+        return start_batch, len(loader)
+    return num_batches, len(loader) - num_batches
+
+
+class DataPlan:
+    # The files, partition size and rows a worker reads. Without a manifest the
+    # files are listed with the pattern and partitioned by the loader.
+    # is_shuffled is set when the ETL shuffled the rows across all shards.
+
+    def __init__(self, data_files, part_size=None, num_rows=None, is_shuffled=False):
+        self.data_files = data_files
+        self.part_size = part_size
+        self.num_rows = num_rows
+        self.is_shuffled = is_shuffled
+
+
+def create_data_plan(file_pattern, num_workers=1, worker_index=0):
+
+    manifest = read_manifest(file_pattern)
+    if manifest is None:
+        return DataPlan(file_pattern)
+
+    split_dir = os.path.dirname(file_pattern)
+    shards = plan_shards(manifest, num_workers)[worker_index]
+    part_size = int(
+        max(shard.get("memory_bytes", shard["bytes"]) for shard in manifest["shards"])
+        * PART_SIZE_MARGIN
+    )
+    num_rows = sum(shard["rows"] for shard in shards)
+    logging.info(
+        f"Worker {worker_index} reads {len(shards)}/{len(manifest['shards'])} shards "
+        f"with {num_rows} rows in partitions of {part_size} bytes."
+    )
+    return DataPlan(
+        [os.path.join(split_dir, shard["file"]) for shard in shards],
+        part_size,
+        num_rows,
+        manifest.get("global_shuffle", False),
+    )
+
+
+class ShardCache:
+    # Downloads parquet shards from object storage to a bounded local cache,
+    # several at a time and in the order the loader plans to read them, so the
+    # reader finds the next shards already there. Each shard is downloaded
+    # once while it stays cached. When the shards do not fit, the least
+    # recently read shards that are not about to be read are evicted, and the
+    # prefetch stops at the cache size; the evicted shards are downloaded
+    # again in a later epoch. A shard is kept while it is read, from
+    # local_file or resolve until release.
+
+    def __init__(
+        self,
+        data_files,
+        cache_dir=CACHE_DIR,
+        max_cache_bytes=MAX_CACHE_BYTES,
+        num_prefetch_workers=NUM_PREFETCH_WORKERS,
+    ):
+        # data_files is either a file pattern or the list of files to cache.
+        if isinstance(data_files, str):
+            self.remote_files = sorted(tf_io.gfile.glob(data_files))
+        else:
+            self.remote_files = sorted(data_files)
+        if not self.remote_files:
+            raise ValueError(f"No files match {data_files}.")
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.sizes = {
+            remote_file: tf_io.gfile.stat(remote_file).length
+            for remote_file in self.remote_files
+        }
+        self._indices = {
+            remote_file: index for index, remote_file in enumerate(self.remote_files)
+        }
+        self._lock = threading.Lock()
+        # Downloaded shards, least recently read first.
+        self._cached = OrderedDict()
+        self._futures = {}
+        self._num_readers = {}
+        self._cached_bytes = 0
+        self._plan = []
+        self._executor = ThreadPoolExecutor(max_workers=num_prefetch_workers)
+
+    def start(self):
+        logging.info(
+            f"Prefetching {len(self.remote_files)} shards to {self.cache_dir}..."
+        )
+        tf_io.gfile.makedirs(self.cache_dir)
+        self.plan(self.remote_files)
+        return self
+
+    def plan(self, remote_files):
+        # Sets the order in which the shards are read next, and prefetches the
+        # first ones that fit in the cache.
+        with self._lock:
+            self._plan = list(remote_files)
+            self._prefetch()
+
+    def _prefetch(self):
+        planned_bytes = 0
+        for position, remote_file in enumerate(self._plan):
+            planned_bytes += self.sizes[remote_file]
+            if planned_bytes > self.max_cache_bytes:
+                break
+            if remote_file in self._cached or remote_file in self._futures:
+                continue
+            if not self._make_room(self.sizes[remote_file], self._plan[:position]):
+                break
+            self._submit(remote_file)
+
+    def _make_room(self, num_bytes, keep_files):
+        # Evicts the least recently read shards, except the ones being read and
+        # keep_files, until num_bytes more fit. Returns whether they fit.
+        keep_files = set(keep_files)
+        for remote_file in list(self._cached):
+            if self._cached_bytes + num_bytes <= self.max_cache_bytes:
+                break
+            if remote_file in keep_files or self._num_readers.get(remote_file):
+                continue
+            tf_io.gfile.remove(self._cached.pop(remote_file))
+            self._cached_bytes -= self.sizes[remote_file]
+        return self._cached_bytes + num_bytes <= self.max_cache_bytes
+
+    def _submit(self, remote_file):
+        self._cached_bytes += self.sizes[remote_file]
+        self._futures[remote_file] = self._executor.submit(self._fetch, remote_file)
+
+    def _fetch(self, remote_file):
+        local_file = os.path.join(
+            self.cache_dir,
+            f"{self._indices[remote_file]:05d}-{os.path.basename(remote_file)}",
+        )
+        # Only completely downloaded shards are read.
+        tf_io.gfile.copy(remote_file, local_file + ".tmp", overwrite=True)
+        tf_io.gfile.rename(local_file + ".tmp", local_file, overwrite=True)
+        with self._lock:
+            self._futures.pop(remote_file, None)
+            self._cached[remote_file] = local_file
+        return local_file
+
+    def local_file(self, remote_file):
+        # Waits for the local copy of a shard, downloading it now if it was not
+        # prefetched, and keeps it until it is released. A shard that failed to
+        # download is read from object storage instead.
+        with self._lock:
+            self._num_readers[remote_file] = self._num_readers.get(remote_file, 0) + 1
+            if remote_file in self._cached:
+                self._cached.move_to_end(remote_file)
+                local_file = self._cached[remote_file]
+            else:
+                if remote_file not in self._futures:
+                    self._make_room(self.sizes[remote_file], [])
+                    self._submit(remote_file)
+                future = self._futures[remote_file]
+                local_file = None
+        if local_file is None:
+            try:
+                local_file = future.result()
+            except Exception as error:
+                logging.warning(f"Caching {remote_file} failed: {error}")
+                with self._lock:
+                    if self._futures.pop(remote_file, None):
+                        self._cached_bytes -= self.sizes[remote_file]
+                local_file = remote_file
+        with self._lock:
+            # The shards planned up to this one are being read or were skipped.
+            if remote_file in self._plan:
+                del self._plan[: self._plan.index(remote_file) + 1]
+            self._prefetch()
+        return local_file
+
+    def resolve(self, remote_files):
+        # Waits for the local copies of the shards, and returns all of them, or
+        # the remote URIs of all of them if any is not cached. The NVTabular
+        # loaders read a file list through one fsspec filesystem.
+        resolved = [self.local_file(remote_file) for remote_file in remote_files]
+        if any(is_remote(path) for path in resolved):
+            return list(remote_files)
+        return resolved
+
+    def release(self, remote_files):
+        # The shards are read, so they can be evicted.
+        with self._lock:
+            for remote_file in remote_files:
+                self._num_readers[remote_file] -= 1
+            self._prefetch()
+
+    def close(self):
+        with self._lock:
+            futures = list(self._futures.values())
+        for future in futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        if tf_io.gfile.exists(self.cache_dir):
+            tf_io.gfile.rmtree(self.cache_dir)
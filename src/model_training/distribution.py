@@ -0,0 +1,139 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Distributed training setup from TF_CONFIG.
+
+To run several CPU workers on one host, e.g. to test the distributed mode:
+
+    python -m src.model_training.distribution --num-workers 2 -- \
+        python -m src.model_training.task --distribution multi_worker ...
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import subprocess
+
+import tensorflow as tf
+
+STRATEGIES = ["auto", "none", "mirrored", "multi_worker"]
+BASE_PORT = 12345
+
+
+def get_tf_config():
+    return json.loads(os.environ.get("TF_CONFIG", "{}"))
+
+
+def get_worker_info(tf_config=None):
+    # Returns the number of workers and the index of this one. Vertex AI names
+    # the replica of the first worker pool "chief" and the others "worker", so
+    # the chief is worker 0.
+    tf_config = get_tf_config() if tf_config is None else tf_config
+    cluster = tf_config.get("cluster", {})
+    task = tf_config.get("task", {})
+    num_chiefs = len(cluster.get("chief", []))
+    num_workers = num_chiefs + len(cluster.get("worker", []))
+    if not num_workers:
+        return 1, 0
+    worker_index = task.get("index", 0)
+    if task.get("type") == "worker":
+        worker_index += num_chiefs
+    return num_workers, worker_index
+
+
+def is_chief(tf_config=None):
+    return get_worker_info(tf_config)[1] == 0
+
+
+def create_strategy(name="auto"):
+    # Returns None when training on a single device. The multi-worker strategy
+    # has to be created before any other TensorFlow op runs.
+    if name == "none":
+        return None
+    num_workers, worker_index = get_worker_info()
+    if name == "auto":
+        if num_workers > 1:
+            name = "multi_worker"
+        elif len(tf.config.list_physical_devices("GPU")) > 1:
+            name = "mirrored"
+        else:
+            return None
+
+    if name == "multi_worker":
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    elif name == "mirrored":
+        strategy = tf.distribute.MirroredStrategy()
+    else:
+        raise ValueError(f"Invalid distribution strategy {name}.")
+    logging.info(
+        f"Using {name} strategy: worker {worker_index}/{num_workers}, "
+        f"{strategy.num_replicas_in_sync} replicas in sync."
+    )
+    return strategy
+
+
+def create_local_tf_config(num_workers, worker_index, base_port=BASE_PORT):
+    return {
+        "cluster": {
+            "worker": [f"localhost:{base_port + index}" for index in range(num_workers)]
+        },
+        "task": {"type": "worker", "index": worker_index},
+    }
+
+
+def launch_local_workers(command, num_workers, base_port=BASE_PORT, cpu_only=True):
+    # Runs the command once per worker on this host, each with its TF_CONFIG,
+    # and returns the highest exit code.
+    processes = []
+    for worker_index in range(num_workers):
+        env = dict(
+            os.environ,
+            TF_CONFIG=json.dumps(
+                create_local_tf_config(num_workers, worker_index, base_port)
+            ),
+        )
+        if cpu_only:
+            env["CUDA_VISIBLE_DEVICES"] = ""
+        processes.append(subprocess.Popen(command, env=env))
+    return max(process.wait() for process in processes)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--num-workers", default=2, type=int)
+
+    parser.add_argument("--base-port", default=BASE_PORT, type=int)
+
+    parser.add_argument(
+        "--gpu",
+        action="store_true",
+        help="Let the workers see the GPUs of the host.",
+    )
+
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    args = get_args()
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    sys.exit(
+        launch_local_workers(
+            command, args.num_workers, args.base_port, cpu_only=not args.gpu
+        )
+    )
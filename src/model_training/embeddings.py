@@ -0,0 +1,156 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Embedding layers for the native lookups of the model.
+
+MultiHotEmbedding combines the rows of the multi-hot values of each example.
+CompactEmbedding has tables whose size does not grow with the vocabulary:
+
+hash: the ids are hashed to num_buckets rows, so different ids can share one.
+qr: quotient-remainder embedding; the embedding of an id is the product of the
+    rows id // num_buckets and id % num_buckets of two tables, which is unique
+    for every id, with vocabulary_size / num_buckets + num_buckets rows.
+"""
+
+import math
+
+import tensorflow as tf
+
+EMBEDDING_MODES = ["full", "hash", "qr"]
+NUM_BUCKETS = 2 ** 15
+# Knuth's multiplicative hash: the low 32 bits of id * HASH_MULTIPLIER, whose
+# high bits select the bucket. The low bits alone would only permute
+# id % num_buckets.
+HASH_MULTIPLIER = 2654435761
+HASH_BITS = 32
+
+
+def hash_buckets(ids, num_buckets):
+    # Multiply-shift of the 32-bit hash to [0, num_buckets), which keeps its
+    # high bits for any number of buckets.
+    hashes = tf.math.floormod(ids * HASH_MULTIPLIER, 2 ** HASH_BITS)
+    return (hashes * num_buckets) // 2 ** HASH_BITS
+
+
+def get_num_rows(vocabulary_size, mode, num_buckets=NUM_BUCKETS):
+    if mode == "full":
+        return vocabulary_size
+    if mode == "hash":
+        return min(num_buckets, vocabulary_size)
+    if mode == "qr":
+        return math.ceil(vocabulary_size / num_buckets) + num_buckets
+    raise ValueError(f"Invalid embedding mode {mode}.")
+
+
+def get_initializer(dimension):
+    # The initializer of tf.feature_column.embedding_column.
+    return tf.keras.initializers.TruncatedNormal(stddev=1 / math.sqrt(dimension))
+
+
+class MultiHotEmbedding(tf.keras.layers.Layer):
+    # Takes the values / nnzs pair of the NVTabular loader and returns the
+    # mean of the rows of each example, zeros for examples without values,
+    # like the mean combiner of the embedding columns.
+
+    def __init__(self, vocabulary_size, dimension, **kwargs):
+        super().__init__(**kwargs)
+        self.vocabulary_size = vocabulary_size
+        self.dimension = dimension
+
+    def build(self, input_shape):
+        self.table = self.add_weight(
+            "embedding_weights",
+            shape=[self.vocabulary_size, self.dimension],
+            initializer=get_initializer(self.dimension),
+        )
+        super().build(input_shape)
+
+    def call(self, inputs):
+        values, nnzs = inputs
+        values = tf.reshape(values, [-1])
+        nnzs = tf.reshape(tf.cast(nnzs, tf.int32), [-1])
+        num_rows = tf.shape(nnzs)[0]
+        segment_ids = tf.repeat(tf.range(num_rows), nnzs)
+        sums = tf.math.unsorted_segment_sum(
+            tf.gather(self.table, values), segment_ids, num_rows
+        )
+        counts = tf.cast(tf.maximum(nnzs, 1), sums.dtype)
+        return sums / counts[:, tf.newaxis]
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(
+            {"vocabulary_size": self.vocabulary_size, "dimension": self.dimension}
+        )
+        return config
+
+
+class CompactEmbedding(tf.keras.layers.Layer):
+    def __init__(
+        self, vocabulary_size, dimension, mode="hash", num_buckets=NUM_BUCKETS, **kwargs
+    ):
+        if mode not in ["hash", "qr"]:
+            raise ValueError(f"Invalid compact embedding mode {mode}.")
+        super().__init__(**kwargs)
+        self.vocabulary_size = vocabulary_size
+        self.dimension = dimension
+        self.mode = mode
+        self.num_buckets = min(num_buckets, vocabulary_size)
+
+    def build(self, input_shape):
+        # The tables are named like the feature column tables, so the embedding
+        # optimizers tell them from the dense variables.
+        initializer = get_initializer(self.dimension)
+        if self.mode == "hash":
+            self.table = self.add_weight(
+                "embedding_weights",
+                shape=[self.num_buckets, self.dimension],
+                initializer=initializer,
+            )
+        else:
+            # Products of two tables start with about the same scale as one table
+            # when both are centred on one.
+            self.quotient_table = self.add_weight(
+                "quotient_embedding_weights",
+                shape=[
+                    math.ceil(self.vocabulary_size / self.num_buckets),
+                    self.dimension,
+                ],
+                initializer=tf.keras.initializers.RandomNormal(1.0, 0.1),
+            )
+            self.remainder_table = self.add_weight(
+                "remainder_embedding_weights",
+                shape=[self.num_buckets, self.dimension],
+                initializer=initializer,
+            )
+        super().build(input_shape)
+
+    def call(self, inputs):
+        ids = tf.reshape(tf.cast(inputs, tf.int64), [-1])
+        if self.mode == "hash":
+            return tf.gather(self.table, hash_buckets(ids, self.num_buckets))
+        return tf.gather(self.quotient_table, ids // self.num_buckets) * tf.gather(
+            self.remainder_table, tf.math.floormod(ids, self.num_buckets)
+        )
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(
+            {
+                "vocabulary_size": self.vocabulary_size,
+                "dimension": self.dimension,
+                "mode": self.mode,
+                "num_buckets": self.num_buckets,
+            }
+        )
+        return config
@@ -0,0 +1,466 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Offline ranking evaluation of a trained model on the test split.
+
+Streams the test shards in batches on CPU and computes:
+  - HR@K and NDCG@K: every positive test rating is ranked against sampled
+    negative movies, or all the movies, scored for the same user. The
+    metrics are filtered: the other movies the user rated in the test split,
+    and in the train split when given, are not candidates.
+  - AUC and calibration of the predictions for the test rows.
+The metrics are running sums over fixed-size histograms. The rated
+(user, movie) keys for the filtering are read for one block of users at a
+time, at most --max-rated-keys of them, and the test split is read once per
+block. For example:
+
+    python -m src.model_training.evaluation --model-dir model \
+        --transform-workflow-dir transform_workflow \
+        --test-data-file-pattern 'data/test/*.parquet' \
+        --train-data-file-pattern 'data/train/*.parquet'
+"""
+
+import sys
+import json
+import logging
+import argparse
+
+import numpy as np
+import pyarrow.parquet as pq
+import tensorflow as tf
+
+from src.common import utils
+from src.common.movie_features import MovieFeatureTable
+from src.model_training import dataloader, embeddings
+
+CANDIDATES = ["sampled", "full"]
+NUM_NEGATIVES = 99
+TOP_K = 10
+NUM_BINS = 1000
+# The calibration error is computed over coarser bins, each merging
+# NUM_BINS / CALIBRATION_BINS histogram bins, so that its bins are not noise.
+CALIBRATION_BINS = 10
+BATCH_SIZE = 8192
+SCORE_BATCH_SIZE = 1024 * 64
+# About 512 MB of keys, before the copy of np.unique.
+MAX_RATED_KEYS = 1024 * 1024 * 64
+RANDOM_STATE = 42
+
+
+class RankingMetrics:
+    # Running sums of the ranks of the positives and of the predictions and
+    # labels of the test rows, binned by predicted probability.
+
+    def __init__(self, top_k=TOP_K, num_bins=NUM_BINS):
+        self.top_k = top_k
+        self.num_bins = num_bins
+        self.num_ranked = 0
+        self.hits = 0.0
+        self.ndcg = 0.0
+        self.bin_counts = np.zeros(num_bins, dtype=np.int64)
+        self.bin_positives = np.zeros(num_bins, dtype=np.int64)
+        self.bin_predictions = np.zeros(num_bins, dtype=np.float64)
+
+    def update_ranks(self, ranks):
+        # ranks are the numbers of candidates scored above each positive.
+        is_hit = ranks < self.top_k
+        self.num_ranked += len(ranks)
+        self.hits += is_hit.sum()
+        self.ndcg += (1 / np.log2(ranks[is_hit] + 2)).sum()
+
+    def update_predictions(self, predictions, labels):
+        bins = np.clip(
+            (predictions * self.num_bins).astype(np.int64), 0, self.num_bins - 1
+        )
+        self.bin_counts += np.bincount(bins, minlength=self.num_bins)
+        self.bin_positives += np.bincount(
+            bins, weights=labels, minlength=self.num_bins
+        ).astype(np.int64)
+        self.bin_predictions += np.bincount(
+            bins, weights=predictions, minlength=self.num_bins
+        )
+
+    def auc(self):
+        # Trapezoidal ROC AUC, with the bin edges as thresholds from high to low.
+        positives = self.bin_positives[::-1].cumsum()
+        negatives = (self.bin_counts - self.bin_positives)[::-1].cumsum()
+        if not positives[-1] or not negatives[-1]:
+            return None
+        tpr = np.concatenate([[0.0], positives / positives[-1]])
+        fpr = np.concatenate([[0.0], negatives / negatives[-1]])
+        return float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2))
+
+    def result(self):
+        num_rows = int(self.bin_counts.sum())
+        num_positives = int(self.bin_positives.sum())
+        # Expected calibration error: the mean gap between the predicted and the
+        # observed rate of each bin, weighted by its rows.
+        calibration_error = None
+        if num_rows:
+            calibration_error = float(
+                np.abs(
+                    np.add.reduceat(
+                        self.bin_predictions - self.bin_positives,
+                        np.linspace(0, self.num_bins, CALIBRATION_BINS, endpoint=False)
+                        .astype(np.int64),
+                    )
+                ).sum()
+                / num_rows
+            )
+        return {
+            f"hr@{self.top_k}": (
+                float(self.hits / self.num_ranked) if self.num_ranked else None
+            ),
+            f"ndcg@{self.top_k}": (
+                float(self.ndcg / self.num_ranked) if self.num_ranked else None
+            ),
+            "auc": self.auc(),
+            "expected_calibration_error": calibration_error,
+            "calibration_ratio": (
+                float(self.bin_predictions.sum() / num_positives)
+                if num_positives
+                else None
+            ),
+            "ranked_positives": self.num_ranked,
+            "rows": num_rows,
+        }
+
+
+def predict(recommendation_model, user_ids, movie_ids, movie_features):
+    genre_values, genre_nnzs = movie_features.gather(movie_ids)
+    inputs = {
+        "userId": user_ids.reshape(-1, 1).astype(np.int32),
+        "movieId": movie_ids.reshape(-1, 1).astype(np.int32),
+        "genres": (
+            genre_values.astype(np.int64).reshape(-1, 1),
+            genre_nnzs.astype(np.int64).reshape(-1, 1),
+        ),
+    }
+    return recommendation_model(inputs, training=False).numpy().reshape(-1)
+
+
+def list_files(data_files):
+    if isinstance(data_files, str):
+        return sorted(tf.io.gfile.glob(data_files))
+    return list(data_files or [])
+
+
+def get_num_blocks(data_files, max_keys=MAX_RATED_KEYS):
+    # The number of blocks of users whose rated keys are read at a time, so
+    # that a block holds about max_keys keys at most.
+    num_rows = sum(dataloader.count_rows(data_files))
+    return max(1, -(-num_rows // max_keys))
+
+
+def is_in_block(user_ids, num_blocks, block):
+    return user_ids.astype(np.int64) % num_blocks == block
+
+
+class RatedItems:
+    # The encoded (userId, movieId) pairs of the given files, as sorted keys
+    # userId * key_base + movieId, so that the movies a user rated are one
+    # contiguous range. Only the pairs of the users of one block,
+    # userId % num_blocks == block, are kept.
+
+    def __init__(self, keys, key_base):
+        self.keys = keys
+        self.key_base = key_base
+
+    @classmethod
+    def from_files(cls, data_files, key_base, num_blocks=1, block=0):
+        keys = [np.zeros(0, dtype=np.int64)]
+        for file_path in list_files(data_files):
+            with utils.open_arrow_file(file_path) as file:
+                table = pq.read_table(file, columns=["userId", "movieId"])
+            user_ids = table["userId"].to_pandas().values.astype(np.int64)
+            movie_ids = table["movieId"].to_pandas().values.astype(np.int64)
+            in_block = is_in_block(user_ids, num_blocks, block)
+            keys.append(user_ids[in_block] * key_base + movie_ids[in_block])
+        return cls(np.unique(np.concatenate(keys)), key_base)
+
+    def contains(self, user_ids, movie_ids):
+        keys = user_ids.astype(np.int64) * self.key_base + movie_ids
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[positions] == keys
+
+    def movies(self, user_id):
+        start, end = np.searchsorted(
+            self.keys, [user_id * self.key_base, (user_id + 1) * self.key_base]
+        )
+        return self.keys[start:end] - user_id * self.key_base
+
+
+def sample_candidates(positive_movie_ids, num_movies, num_negatives, random_state):
+    # Uniform negatives over the encoded movies 1..num_movies, none of them the
+    # positive itself.
+    negatives = random_state.randint(
+        1, num_movies, (len(positive_movie_ids), num_negatives)
+    )
+    return negatives + (negatives >= positive_movie_ids[:, np.newaxis])
+
+
+def rank_positives(
+    recommendation_model,
+    user_ids,
+    positive_movie_ids,
+    positive_scores,
+    movie_features,
+    candidates,
+    num_negatives,
+    score_batch_size,
+    random_state,
+    rated_items=None,
+):
+    # Returns the number of candidates scored above each positive, without
+    # the movies in rated_items. Row 0 of the movie features is the unknown
+    # movie, so the known ones are encoded as 1..num_movies.
+    num_movies = movie_features.num_movies - 1
+    if candidates == "full":
+        return rank_positives_full(
+            recommendation_model,
+            user_ids,
+            positive_scores,
+            movie_features,
+            num_movies,
+            score_batch_size,
+            rated_items,
+        )
+
+    # Every positive is ranked against its own sampled negatives, and the
+    # negatives of a chunk of positives are scored together. Sampled negatives
+    # that the user rated are not counted, so a few positives are ranked
+    # against slightly fewer negatives.
+    chunk_size = max(1, score_batch_size // num_negatives)
+    ranks = []
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        candidate_ids = sample_candidates(
+            positive_movie_ids[chunk], num_movies, num_negatives, random_state
+        )
+        candidate_user_ids = np.repeat(user_ids[chunk], num_negatives)
+        scores = predict(
+            recommendation_model,
+            candidate_user_ids,
+            candidate_ids.reshape(-1),
+            movie_features,
+        ).reshape(candidate_ids.shape)
+        is_above = scores > positive_scores[chunk, np.newaxis]
+        if rated_items is not None:
+            is_above &= ~rated_items.contains(
+                candidate_user_ids, candidate_ids.reshape(-1)
+            ).reshape(candidate_ids.shape)
+        ranks.append(is_above.sum(axis=1))
+    return np.concatenate(ranks) if ranks else np.zeros(0, dtype=np.int64)
+
+
+def rank_positives_full(
+    recommendation_model,
+    user_ids,
+    positive_scores,
+    movie_features,
+    num_movies,
+    score_batch_size,
+    rated_items=None,
+):
+    # Scores the catalogue once per user, in batches of about score_batch_size
+    # rows, and ranks all the positives of the user against it.
+    ranks = np.zeros(len(user_ids), dtype=np.int64)
+    unique_user_ids, user_indices = np.unique(user_ids, return_inverse=True)
+    # The positives of user i are order[user_offsets[i]:user_offsets[i + 1]].
+    order = np.argsort(user_indices, kind="stable")
+    user_offsets = np.searchsorted(
+        user_indices[order], np.arange(len(unique_user_ids) + 1)
+    )
+    users_per_chunk = max(1, score_batch_size // num_movies)
+    movie_ids = np.arange(1, num_movies + 1)
+    for start in range(0, len(unique_user_ids), users_per_chunk):
+        chunk_user_ids = unique_user_ids[start : start + users_per_chunk]
+        scores = predict(
+            recommendation_model,
+            np.repeat(chunk_user_ids, num_movies),
+            np.tile(movie_ids, len(chunk_user_ids)),
+            movie_features,
+        ).reshape(len(chunk_user_ids), num_movies)
+        if rated_items is not None:
+            for row, user_id in enumerate(chunk_user_ids):
+                rated = rated_items.movies(user_id)
+                scores[row, rated[(rated >= 1) & (rated <= num_movies)] - 1] = -np.inf
+        for row in range(len(chunk_user_ids)):
+            positive_indices = order[
+                user_offsets[start + row] : user_offsets[start + row + 1]
+            ]
+            # Sorting the scores of the user once ranks all their positives.
+            sorted_scores = np.sort(scores[row])
+            ranks[positive_indices] = num_movies - np.searchsorted(
+                sorted_scores, positive_scores[positive_indices], side="right"
+            )
+    return ranks
+
+
+def evaluate_ranking(
+    recommendation_model,
+    data_files,
+    movie_features,
+    candidates="sampled",
+    num_negatives=NUM_NEGATIVES,
+    top_k=TOP_K,
+    batch_size=BATCH_SIZE,
+    score_batch_size=SCORE_BATCH_SIZE,
+    max_batches=None,
+    train_data_files=None,
+    max_rated_keys=MAX_RATED_KEYS,
+):
+    if candidates not in CANDIDATES:
+        raise ValueError(f"Invalid candidates {candidates}.")
+    random_state = np.random.RandomState(RANDOM_STATE)
+    metrics = RankingMetrics(top_k)
+    data_files = list_files(data_files)
+    rated_files = data_files + list_files(train_data_files)
+    num_blocks = get_num_blocks(rated_files, max_rated_keys)
+    for block in range(num_blocks):
+        logging.info(
+            f"Reading the rated movies of the users of block {block + 1} of "
+            f"{num_blocks}..."
+        )
+        rated_items = RatedItems.from_files(
+            rated_files, movie_features.num_movies + 1, num_blocks, block
+        )
+        loader = dataloader.create_loader(
+            data_files, batch_size, shuffle=False, cpu=True
+        )
+        for index, (batch, labels) in enumerate(loader):
+            if max_batches and index >= max_batches:
+                break
+            user_ids = batch["userId"].reshape(-1)
+            in_block = is_in_block(user_ids, num_blocks, block)
+            if not in_block.any():
+                continue
+            user_ids = user_ids[in_block]
+            movie_ids = batch["movieId"].reshape(-1)[in_block]
+            labels = labels.reshape(-1)[in_block].astype(np.float64)
+            scores = predict(recommendation_model, user_ids, movie_ids, movie_features)
+            metrics.update_predictions(scores, labels)
+
+            # The positive ratings of known movies are the held-out items.
+            is_positive = (labels > 0) & (movie_ids > 0)
+            metrics.update_ranks(
+                rank_positives(
+                    recommendation_model,
+                    user_ids[is_positive],
+                    movie_ids[is_positive],
+                    scores[is_positive],
+                    movie_features,
+                    candidates,
+                    num_negatives,
+                    score_batch_size,
+                    random_state,
+                    rated_items,
+                )
+            )
+    result = metrics.result()
+    result["candidates"] = candidates
+    logging.info(f"Ranking metrics: {result}")
+    return result
+
+
+def load_model(model_dir):
+    return tf.keras.models.load_model(
+        model_dir,
+        custom_objects={
+            "CompactEmbedding": embeddings.CompactEmbedding,
+            "MultiHotEmbedding": embeddings.MultiHotEmbedding,
+        },
+        compile=False,
+    )
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--model-dir", required=True, type=str)
+
+    parser.add_argument("--transform-workflow-dir", required=True, type=str)
+
+    parser.add_argument("--test-data-file-pattern", required=True, type=str)
+
+    parser.add_argument(
+        "--train-data-file-pattern",
+        default=None,
+        type=str,
+        help="Also exclude the movies each user rated in these files from the "
+        "candidates of their positives.",
+    )
+
+    parser.add_argument("--candidates", default="sampled", choices=CANDIDATES)
+
+    parser.add_argument("--num-negatives", default=NUM_NEGATIVES, type=int)
+
+    parser.add_argument("--top-k", default=TOP_K, type=int)
+
+    parser.add_argument("--batch-size", default=BATCH_SIZE, type=int)
+
+    parser.add_argument("--score-batch-size", default=SCORE_BATCH_SIZE, type=int)
+
+    parser.add_argument(
+        "--max-batches",
+        default=None,
+        type=int,
+        help="Only evaluate the first test batches.",
+    )
+
+    parser.add_argument(
+        "--max-rated-keys",
+        default=MAX_RATED_KEYS,
+        type=int,
+        help="The rated movies are held in memory for blocks of users of at "
+        "most this many ratings; the test split is read once per block.",
+    )
+
+    parser.add_argument("--output-file", default=None, type=str)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    recommendation_model = load_model(args.model_dir)
+    result = evaluate_ranking(
+        recommendation_model,
+        dataloader.create_data_plan(args.test_data_file_pattern).data_files,
+        MovieFeatureTable.load(args.transform_workflow_dir),
+        candidates=args.candidates,
+        num_negatives=args.num_negatives,
+        top_k=args.top_k,
+        batch_size=args.batch_size,
+        score_batch_size=args.score_batch_size,
+        max_batches=args.max_batches,
+        max_rated_keys=args.max_rated_keys,
+        train_data_files=(
+            dataloader.create_data_plan(args.train_data_file_pattern).data_files
+            if args.train_data_file_pattern
+            else None
+        ),
+    )
+    if args.output_file:
+        with tf.io.gfile.GFile(args.output_file, "w") as file:
+            json.dump(result, file, indent=2)
+        logging.info(f"Ranking metrics are written to {args.output_file}.")
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Python Version = {sys.version}")
+    logging.info(f"TensorFlow Version = {tf.__version__}")
+    main()
@@ -11,15 +11,17 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""A DNN Keras regression model."""
+"""A DNN Keras regression model.
+
+nvtabular is only imported for the feature column lookup, whose DenseFeatures
+layer reads the multi-hot inputs, so the native lookup runs without it.
+"""
 
 
-import nvtabular as nvt
 import tensorflow as tf
-from nvtabular.loader.tensorflow import KerasSequenceLoader, KerasSequenceValidater
-from nvtabular.framework_utils.tensorflow import layers
 
 from src.common import features
+from src.model_training import embeddings
 
 
 def create_inputs():
@@ -38,10 +40,12 @@ def create_inputs():
     return inputs
 
 
-def create_embedding_layers(embedding_shapes):
+def create_embedding_layers(embedding_shapes, exclude=()):
 
     embedding_layers = []
     for feature_name in features.get_categorical_feature_names():
+        if feature_name in exclude:
+            continue
         embedding_layers.append(
             tf.feature_column.embedding_column(
                 tf.feature_column.categorical_column_with_identity(
@@ -53,16 +57,121 @@ def create_embedding_layers(embedding_shapes):
     return embedding_layers
 
 
-def create(embedding_shapes, hidden_units):
+EMBEDDING_LOOKUPS = ["feature_column", "native"]
 
-    inputs = create_inputs()
-    embedding_layers = create_embedding_layers(embedding_shapes)
 
-    x = layers.DenseFeatures(embedding_layers)(inputs)
+def create_native_embeddings(inputs, embedding_shapes, exclude=()):
+    # Gathers the rows of the tables directly, in the order of the DenseFeatures
+    # output, which concatenates the columns sorted by name.
+    outputs = []
+    for feature_name in sorted(features.get_categorical_feature_names()):
+        if feature_name in exclude:
+            continue
+        vocabulary_size, dimension = embedding_shapes[feature_name]
+        if feature_name in features.MULTIVALUE_FEATURE_NAMES:
+            outputs.append(
+                embeddings.MultiHotEmbedding(
+                    vocabulary_size, dimension, name=f"{feature_name}_embedding"
+                )(inputs[feature_name])
+            )
+        else:
+            embedded = tf.keras.layers.Embedding(
+                vocabulary_size,
+                dimension,
+                embeddings_initializer=embeddings.get_initializer(dimension),
+                name=f"{feature_name}_embedding",
+            )(inputs[feature_name])
+            outputs.append(tf.keras.layers.Flatten()(embedded))
+    return outputs
+
+
+def create(
+    embedding_shapes,
+    hidden_units,
+    user_embedding="full",
+    user_embedding_buckets=embeddings.NUM_BUCKETS,
+    embedding_lookup="feature_column",
+):
+
+    inputs = create_inputs()
+    # The userId table can be replaced with a compact one, whose size is set by
+    # the number of buckets instead of the number of users.
+    compact = user_embedding != "full"
+    exclude = ["userId"] if compact else []
+
+    if embedding_lookup == "native":
+        embedding_outputs = create_native_embeddings(inputs, embedding_shapes, exclude)
+    elif embedding_lookup == "feature_column":
+        from nvtabular.framework_utils.tensorflow import layers
+
+        embedding_layers = create_embedding_layers(embedding_shapes, exclude)
+        embedding_outputs = [layers.DenseFeatures(embedding_layers)(inputs)]
+    else:
+        raise ValueError(f"Invalid embedding lookup {embedding_lookup}.")
+
+    if compact:
+        embedding_outputs.append(
+            embeddings.CompactEmbedding(
+                *embedding_shapes["userId"],
+                mode=user_embedding,
+                num_buckets=user_embedding_buckets,
+                name="userId_embedding",
+            )(inputs["userId"])
+        )
+    if len(embedding_outputs) > 1:
+        x = tf.keras.layers.Concatenate()(embedding_outputs)
+    else:
+        x = embedding_outputs[0]
     for units in hidden_units:
         x = tf.keras.layers.Dense(units, activation="relu")(x)
 
-    logits = tf.keras.layers.Dense(1, activation="sigmoid", name="logits")(x)
+    # The output stays in float32 under a mixed precision policy.
+    logits = tf.keras.layers.Dense(
+        1, activation="sigmoid", name="logits", dtype="float32"
+    )(x)
     model = tf.keras.Model(inputs=inputs, outputs=logits)
 
     return model
+
+
+def get_embedding_tables(recommendation_model):
+    # Maps <feature>_embedding/<table> to the table variables of either model.
+    # The tables of Keras Embedding layers are named embeddings instead of
+    # embedding_weights.
+    tables = {}
+    for variable in recommendation_model.weights:
+        name = variable.name.split(":")[0]
+        for feature_name in features.get_categorical_feature_names():
+            prefix = f"{feature_name}_embedding/"
+            if prefix in name:
+                table_name = name[name.index(prefix) + len(prefix) :]
+                if table_name == "embeddings":
+                    table_name = "embedding_weights"
+                tables[prefix + table_name] = variable
+    return tables
+
+
+def transfer_weights(source_model, target_model):
+    # Copies the weights of a model to one with the other embedding lookup,
+    # e.g. to fine-tune or export a trained feature column model as a native
+    # one. Both must have the same embedding shapes and hidden units.
+    source_tables = get_embedding_tables(source_model)
+    target_tables = get_embedding_tables(target_model)
+    if set(source_tables) != set(target_tables):
+        raise ValueError(
+            f"The embedding tables {sorted(source_tables)} do not match "
+            f"{sorted(target_tables)}."
+        )
+    for name, variable in target_tables.items():
+        variable.assign(source_tables[name])
+
+    source_dense = [
+        layer for layer in source_model.layers if isinstance(layer, tf.keras.layers.Dense)
+    ]
+    target_dense = [
+        layer for layer in target_model.layers if isinstance(layer, tf.keras.layers.Dense)
+    ]
+    if len(source_dense) != len(target_dense):
+        raise ValueError("The models have different hidden units.")
+    for source_layer, target_layer in zip(source_dense, target_dense):
+        target_layer.set_weights(source_layer.get_weights())
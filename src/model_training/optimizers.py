@@ -0,0 +1,169 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Sparse optimizers for the embedding tables."""
+
+import tensorflow as tf
+from tensorflow import keras
+
+EMBEDDING_OPTIMIZERS = ["adam", "lazy_adam", "rowwise_adagrad"]
+INITIAL_ACCUMULATOR_VALUE = 0.1
+
+
+def is_embedding_variable(variable):
+    # Feature column tables are named embedding_weights, Keras layer tables
+    # embeddings.
+    name = variable.name.split(":")[0]
+    return name.endswith("embedding_weights") or name.endswith("embeddings")
+
+
+class EmbeddingAdam(keras.optimizers.Adam):
+    # Adam for the dense variables, with a sparse update for the embedding
+    # tables, which only touches the rows looked up in the batch:
+    #   lazy_adam: Adam with the moments of the other rows left as they are.
+    #   rowwise_adagrad: Adagrad with one accumulator per row, the mean of the
+    #       squared gradients of the row, instead of the two moments of Adam.
+
+    def __init__(
+        self,
+        learning_rate=0.001,
+        embedding_optimizer="rowwise_adagrad",
+        initial_accumulator_value=INITIAL_ACCUMULATOR_VALUE,
+        name="EmbeddingAdam",
+        **kwargs,
+    ):
+        if embedding_optimizer not in EMBEDDING_OPTIMIZERS:
+            raise ValueError(f"Invalid embedding optimizer {embedding_optimizer}.")
+        super().__init__(learning_rate=learning_rate, name=name, **kwargs)
+        self.embedding_optimizer = embedding_optimizer
+        self.initial_accumulator_value = initial_accumulator_value
+
+    def _is_rowwise(self, var):
+        return self.embedding_optimizer == "rowwise_adagrad" and is_embedding_variable(
+            var
+        )
+
+    def _create_slots(self, var_list):
+        super()._create_slots([var for var in var_list if not self._is_rowwise(var)])
+        for var in var_list:
+            if self._is_rowwise(var):
+                self.add_slot(var, "accumulator", self._row_initializer(var))
+
+    def _row_initializer(self, var):
+        # add_slot of TF 2.4 has no shape argument and initializes slots with
+        # the shape of their variable, which this initializer ignores to
+        # return one accumulator per row.
+        row_shape = [var.shape[0], 1]
+
+        def initializer(shape, dtype):
+            return tf.fill(row_shape, tf.cast(self.initial_accumulator_value, dtype))
+
+        return initializer
+
+    def _rowwise_adagrad_step(self, grad, accumulator, apply_state, var):
+        var_device, var_dtype = var.device, var.dtype.base_dtype
+        coefficients = (apply_state or {}).get(
+            (var_device, var_dtype)
+        ) or self._fallback_apply_state(var_device, var_dtype)
+        return coefficients["lr_t"] * grad / (
+            tf.sqrt(accumulator) + coefficients["epsilon"]
+        )
+
+    def _resource_apply_dense(self, grad, var, apply_state=None):
+        if not self._is_rowwise(var):
+            return super()._resource_apply_dense(grad, var, apply_state)
+        accumulator = self.get_slot(var, "accumulator")
+        accumulator_t = accumulator.assign_add(
+            tf.reduce_mean(tf.square(grad), axis=1, keepdims=True),
+            use_locking=self._use_locking,
+        )
+        return var.assign_sub(
+            self._rowwise_adagrad_step(grad, accumulator_t, apply_state, var),
+            use_locking=self._use_locking,
+        )
+
+    def _resource_apply_sparse(self, grad, var, indices, apply_state=None):
+        # The indices are unique: the gradients of repeated rows are summed first.
+        if self._is_rowwise(var):
+            accumulator = self.get_slot(var, "accumulator")
+            accumulator_t = tf.gather(
+                self._resource_scatter_add(
+                    accumulator,
+                    indices,
+                    tf.reduce_mean(tf.square(grad), axis=1, keepdims=True),
+                ),
+                indices,
+            )
+            step = self._rowwise_adagrad_step(grad, accumulator_t, apply_state, var)
+            return tf.group(self._resource_scatter_add(var, indices, -step))
+
+        if self.embedding_optimizer != "lazy_adam" or not is_embedding_variable(var):
+            return super()._resource_apply_sparse(grad, var, indices, apply_state)
+
+        var_device, var_dtype = var.device, var.dtype.base_dtype
+        coefficients = (apply_state or {}).get(
+            (var_device, var_dtype)
+        ) or self._fallback_apply_state(var_device, var_dtype)
+        m = self.get_slot(var, "m")
+        v = self.get_slot(var, "v")
+        m_t = (
+            coefficients["beta_1_t"] * tf.gather(m, indices)
+            + coefficients["one_minus_beta_1_t"] * grad
+        )
+        v_t = coefficients["beta_2_t"] * tf.gather(v, indices) + coefficients[
+            "one_minus_beta_2_t"
+        ] * tf.square(grad)
+        m_update = self._resource_scatter_update(m, indices, m_t)
+        v_update = self._resource_scatter_update(v, indices, v_t)
+        var_update = self._resource_scatter_add(
+            var,
+            indices,
+            -coefficients["lr"] * m_t / (tf.sqrt(v_t) + coefficients["epsilon"]),
+        )
+        return tf.group(var_update, m_update, v_update)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update(
+            {
+                "embedding_optimizer": self.embedding_optimizer,
+                "initial_accumulator_value": self.initial_accumulator_value,
+            }
+        )
+        return config
+
+
+def create_optimizer(learning_rate, embedding_optimizer="adam"):
+    if embedding_optimizer == "adam":
+        return keras.optimizers.Adam(learning_rate=learning_rate)
+    return EmbeddingAdam(
+        learning_rate=learning_rate, embedding_optimizer=embedding_optimizer
+    )
+
+
+def get_slot_bytes(optimizer, variables):
+    # Returns the bytes of the optimizer slots of the embedding tables and of
+    # the other variables.
+    embedding_bytes, dense_bytes = 0, 0
+    for var in variables:
+        for slot_name in optimizer.get_slot_names():
+            try:
+                slot = optimizer.get_slot(var, slot_name)
+            except KeyError:
+                continue
+            num_bytes = slot.shape.num_elements() * slot.dtype.size
+            if is_embedding_variable(var):
+                embedding_bytes += num_bytes
+            else:
+                dense_bytes += num_bytes
+    return embedding_bytes, dense_bytes
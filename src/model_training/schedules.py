@@ -0,0 +1,77 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Learning rate scaling and schedules for large-batch training."""
+
+import math
+
+import tensorflow as tf
+from tensorflow import keras
+
+LR_SCALINGS = ["none", "linear", "sqrt"]
+LR_DECAYS = ["none", "linear", "cosine"]
+
+
+def scale_learning_rate(learning_rate, batch_size, base_batch_size, scaling):
+    # Scales a learning rate tuned for base_batch_size to batch_size.
+    ratio = batch_size / base_batch_size
+    if scaling == "linear":
+        return learning_rate * ratio
+    if scaling == "sqrt":
+        return learning_rate * math.sqrt(ratio)
+    if scaling == "none":
+        return learning_rate
+    raise ValueError(f"Invalid learning rate scaling {scaling}.")
+
+
+class WarmupDecaySchedule(keras.optimizers.schedules.LearningRateSchedule):
+    # Ramps the learning rate linearly from 0 to its peak over warmup_steps,
+    # then decays it linearly or along a cosine to 0 at decay_steps, counted
+    # from the end of the warmup.
+
+    def __init__(self, learning_rate, warmup_steps=0, decay="none", decay_steps=None):
+        if decay not in LR_DECAYS:
+            raise ValueError(f"Invalid learning rate decay {decay}.")
+        if decay != "none" and not decay_steps:
+            raise ValueError(f"The {decay} decay needs the number of decay steps.")
+        self.learning_rate = learning_rate
+        self.warmup_steps = warmup_steps
+        self.decay = decay
+        self.decay_steps = decay_steps
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        learning_rate = tf.constant(self.learning_rate, tf.float32)
+        if self.warmup_steps:
+            warmup = tf.minimum((step + 1) / self.warmup_steps, 1.0)
+        else:
+            warmup = 1.0
+
+        if self.decay == "none":
+            return learning_rate * warmup
+        progress = tf.clip_by_value(
+            (step - self.warmup_steps) / self.decay_steps, 0.0, 1.0
+        )
+        if self.decay == "linear":
+            decay = 1.0 - progress
+        else:
+            decay = 0.5 * (1.0 + tf.cos(math.pi * progress))
+        return learning_rate * warmup * decay
+
+    def get_config(self):
+        return {
+            "learning_rate": self.learning_rate,
+            "warmup_steps": self.warmup_steps,
+            "decay": self.decay,
+            "decay_steps": self.decay_steps,
+        }
@@ -20,19 +20,31 @@ os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"]='python'
 os.environ["TF_MEMORY_ALLOCATION"]='0.7'
 
 import sys
+import tempfile
 from datetime import datetime
 import logging
 import tensorflow as tf
 from tensorflow.python.client import device_lib
 import argparse
 
-import nvtabular as nvt
 
 # from google.cloud import aiplatform as vertex_ai
 from google.protobuf.internal import api_implementation
 
-from src.model_training import trainer
+from src.data_preprocessing import cpu_workflow, writer
+from src.model_training import (
+    checkpoints,
+    dataloader,
+    distribution,
+    embeddings,
+    evaluation,
+    model,
+    optimizers,
+    schedules,
+    trainer,
+)
 from src.common import utils
+from src.common.movie_features import MovieFeatureTable
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -67,14 +79,133 @@ def get_args():
         type=str,
     )
 
-    parser.add_argument("--learning-rate", default=0.001, type=float)
+    parser.add_argument("--learning-rate", default=trainer.LEARNING_RATE, type=float)
 
-    parser.add_argument("--batch-size", default=2048, type=float)
+    parser.add_argument("--batch-size", default=trainer.BATCH_SIZE, type=int)
+
+    parser.add_argument(
+        "--lr-scaling",
+        default="none",
+        choices=schedules.LR_SCALINGS,
+        help="Scale the learning rate by batch size / base batch size.",
+    )
+
+    parser.add_argument("--base-batch-size", default=trainer.BASE_BATCH_SIZE, type=int)
+
+    parser.add_argument("--warmup-steps", default=0, type=int)
+
+    parser.add_argument("--lr-decay", default="none", choices=schedules.LR_DECAYS)
+
+    parser.add_argument(
+        "--decay-steps",
+        default=None,
+        type=int,
+        help="Defaults to the remaining training steps after the warmup.",
+    )
 
     parser.add_argument("--hidden-units", default="128,128", type=str)
 
     parser.add_argument("--num-epochs", default=1, type=int)
 
+    parser.add_argument(
+        "--embedding-optimizer",
+        default="adam",
+        choices=optimizers.EMBEDDING_OPTIMIZERS,
+        help="lazy_adam and rowwise_adagrad only update the rows of the batch.",
+    )
+
+    parser.add_argument(
+        "--embedding-lookup",
+        default="feature_column",
+        choices=model.EMBEDDING_LOOKUPS,
+        help="native gathers the embeddings without the feature columns.",
+    )
+
+    parser.add_argument(
+        "--user-embedding",
+        default="full",
+        choices=embeddings.EMBEDDING_MODES,
+        help="hash and qr bound the size of the userId table by the buckets.",
+    )
+
+    parser.add_argument(
+        "--user-embedding-buckets", default=embeddings.NUM_BUCKETS, type=int
+    )
+
+    parser.add_argument(
+        "--mixed-precision",
+        action="store_true",
+        help="Compute in float16 (bfloat16 on CPU) with float32 variables and logits.",
+    )
+
+    parser.add_argument(
+        "--jit-compile",
+        action="store_true",
+        help="Compile the train step with XLA.",
+    )
+
+    parser.add_argument(
+        "--checkpoint-steps",
+        default=checkpoints.CHECKPOINT_STEPS,
+        type=int,
+        help="Batches between checkpoints, besides the one after every epoch.",
+    )
+
+    parser.add_argument(
+        "--early-stopping-patience",
+        default=0,
+        type=int,
+        help="Epochs without improvement of the validation loss before stopping. "
+        "0 trains for all the epochs.",
+    )
+
+    parser.add_argument(
+        "--validation-fraction",
+        default=trainer.VALIDATION_FRACTION,
+        type=float,
+        help="Fraction of the test shards used for early stopping.",
+    )
+
+    parser.add_argument(
+        "--ranking-metrics",
+        action="store_true",
+        help="Also compute HR@K, NDCG@K, AUC and calibration on the test split.",
+    )
+
+    parser.add_argument(
+        "--retrieval-dir",
+        default=None,
+        type=str,
+        help="Where to export the movie embeddings for top-K retrieval.",
+    )
+
+    parser.add_argument(
+        "--retrieval-ivf-lists",
+        default=0,
+        type=int,
+        help="Also export an int8 IVF index with this many clusters.",
+    )
+
+    parser.add_argument(
+        "--online-transform-dir",
+        default=None,
+        type=str,
+        help="Where to export the NumPy lookups that transform raw requests.",
+    )
+
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Read the data files from their location instead of copying them first.",
+    )
+
+    parser.add_argument(
+        "--distribution",
+        default="auto",
+        choices=distribution.STRATEGIES,
+        help="auto uses TF_CONFIG for several workers and mirrors several GPUs.",
+    )
+
     #     parser.add_argument("--project", type=str)
     #     parser.add_argument("--region", type=str)
     #     parser.add_argument("--staging-bucket", type=str)
@@ -84,8 +215,31 @@ def get_args():
     return parser.parse_args()
 
 
+def copy_manifest(file_pattern, data_dir):
+    # Writes the manifest of the shards that the pattern matches to data_dir,
+    # so that a pattern of only some of the shards of a split is planned from
+    # their entries. Nothing is written when the ETL wrote no manifest.
+    manifest = writer.read_manifest(os.path.dirname(file_pattern))
+    if manifest is None:
+        return
+    file_names = [
+        os.path.basename(file_path) for file_path in tf.io.gfile.glob(file_pattern)
+    ]
+    shards = writer.select_shards(manifest, file_names)
+    if len(shards) < len(file_names):
+        logging.info(f"Files of {file_pattern} are missing from the manifest.")
+        return
+    writer.write_manifest(
+        data_dir,
+        shards,
+        manifest["row_group_size"],
+        manifest.get("global_shuffle", False),
+    )
+
+
 def main():
     args = get_args()
+    strategy = distribution.create_strategy(args.distribution)
 
     experiment_params = vars(args)
     experiment_params = trainer.update_hyperparams(experiment_params)
@@ -110,42 +264,91 @@ def main():
     #     if args.experiment_name:
     #         vertex_ai.log_params(experiment_params)
 
+    if args.streaming:
+        train_data_file_pattern = args.train_data_file_pattern
+        test_data_file_pattern = args.test_data_file_pattern
+    else:
+        train_data_file_pattern = "data/train/*.parquet"
+        test_data_file_pattern = "data/test/*.parquet"
+
     logging.info("Downloading data and transform workflow...")
     if tf.io.gfile.exists("data"):
         tf.io.gfile.rmtree("data")
     if tf.io.gfile.exists("transform_workflow"):
         tf.io.gfile.rmtree("transform_workflow")
 
-    tf.io.gfile.mkdir("data")
-    tf.io.gfile.mkdir("data/train")
-    tf.io.gfile.mkdir("data/test")
+    if not args.streaming:
+        tf.io.gfile.mkdir("data")
+        tf.io.gfile.mkdir("data/train")
+        tf.io.gfile.mkdir("data/test")
 
-    utils.copy_files(args.train_data_file_pattern, "data/train")
-    utils.copy_files(args.test_data_file_pattern, "data/test")
+        utils.copy_files(args.train_data_file_pattern, "data/train")
+        utils.copy_files(args.test_data_file_pattern, "data/test")
+        # The shard manifests, when the ETL wrote them, plan the reads.
+        copy_manifest(args.train_data_file_pattern, "data/train")
+        copy_manifest(args.test_data_file_pattern, "data/test")
     utils.download_directory(args.transform_workflow_dir, ".")
     logging.info("Data and workflow are downloaded.")
 
     logging.info(f"Loading nvt workflow...")
-    nvt_workflow = nvt.Workflow.load("transform_workflow")
+    nvt_workflow = cpu_workflow.load_workflow("transform_workflow")
     logging.info(f"nvt workflow loaded.")
 
+    # Checkpoints are written to the model dir, so that a restarted job resumes
+    # from them, and removed once the model is exported.
+    checkpoint_dir = os.path.join(args.model_dir, checkpoints.CHECKPOINT_DIR)
     recommendation_model = trainer.train(
-        train_data_file_pattern="data/train/*.parquet",
+        train_data_file_pattern=train_data_file_pattern,
         nvt_workflow=nvt_workflow,
         hyperparams=experiment_params,
         log_dir=args.log_dir,
+        streaming=args.streaming,
+        strategy=strategy,
+        checkpoint_dir=checkpoint_dir,
+        validation_data_file_pattern=test_data_file_pattern,
     )
 
     val_loss, val_mae = trainer.evaluate(
         recommendation_model,
-        eval_data_file_pattern="data/test/*.parquet",
+        eval_data_file_pattern=test_data_file_pattern,
         hyperparams=experiment_params,
+        strategy=strategy,
     )
 
+    if args.ranking_metrics and distribution.is_chief():
+        evaluation.evaluate_ranking(
+            recommendation_model,
+            dataloader.create_data_plan(test_data_file_pattern).data_files,
+            MovieFeatureTable.load("transform_workflow"),
+            train_data_files=dataloader.create_data_plan(
+                train_data_file_pattern
+            ).data_files,
+        )
+
 #    if args.experiment_name:
 #        vertex_ai.log_metrics({"val_loss": val_loss, "val_accuracy": val_accuracy})
 
-    trainer.export(recommendation_model, nvt_workflow, model_name, args.model_dir)
+    # Every worker saves the model, as saving a distributed model needs all of
+    # them, but only the chief's copy is kept.
+    model_dir = args.model_dir
+    if not distribution.is_chief():
+        model_dir = tempfile.mkdtemp()
+    trainer.export(
+        recommendation_model,
+        nvt_workflow,
+        model_name,
+        model_dir,
+        retrieval_dir=args.retrieval_dir if distribution.is_chief() else None,
+        workflow_dir="transform_workflow",
+        ivf_lists=args.retrieval_ivf_lists,
+        online_transform_dir=(
+            args.online_transform_dir if distribution.is_chief() else None
+        ),
+    )
+    if not distribution.is_chief():
+        tf.io.gfile.rmtree(model_dir)
+    elif tf.io.gfile.exists(checkpoint_dir):
+        tf.io.gfile.rmtree(checkpoint_dir)
 
 
 if __name__ == "__main__":
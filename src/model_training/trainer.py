@@ -11,23 +11,56 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Train and evaluate the model."""
+"""Train and evaluate the model.
+
+nvtabular is imported by the functions that use it, so that models trained on
+the NumPy workflow and the CPU loader run without it.
+"""
 
 import os
+import inspect
 import logging
 import tensorflow as tf
 from tensorflow import keras
-import nvtabular as nvt
-from nvtabular.loader.tensorflow import KerasSequenceLoader, KerasSequenceValidater
-from nvtabular.inference.triton import export_tensorflow_ensemble
 
 from src.common import features, utils
-from src.model_training import model
+from src.data_preprocessing import cpu_workflow
+from src.retrieval import artifact as retrieval_artifact
+from src.serving.online_transform import OnlineTransform
+from src.model_training import (
+    checkpoints,
+    dataloader,
+    distribution,
+    embeddings,
+    model,
+    optimizers,
+    schedules,
+)
 
 HIDDEN_UNITS = [128, 128]
 LEARNING_RATE = 0.001
 BATCH_SIZE = 1024 * 32
 NUM_EPOCHS = 1
+# The fraction of the test shards used to validate each epoch.
+VALIDATION_FRACTION = 0.1
+# The batch size LEARNING_RATE is tuned for, when it is scaled.
+BASE_BATCH_SIZE = 2048
+
+
+def validate_batch_size(batch_size):
+    # Integral floats, e.g. from JSON hyperparameters, are accepted as integers.
+    try:
+        value = float(batch_size)
+    except (TypeError, ValueError):
+        value = None
+    if (
+        isinstance(batch_size, bool)
+        or value is None
+        or not value.is_integer()
+        or value <= 0
+    ):
+        raise ValueError(f"Batch size must be a positive integer, got {batch_size!r}.")
+    return int(value)
 
 
 def update_hyperparams(hyperparams: dict) -> dict:
@@ -42,72 +75,355 @@ def update_hyperparams(hyperparams: dict) -> dict:
         hyperparams["learning_rate"] = LEARNING_RATE
     if "batch_size" not in hyperparams:
         hyperparams["batch_size"] = BATCH_SIZE
+    hyperparams["batch_size"] = validate_batch_size(hyperparams["batch_size"])
     if "num_epochs" not in hyperparams:
         hyperparams["num_epochs"] = NUM_EPOCHS
+    if "mixed_precision" not in hyperparams:
+        hyperparams["mixed_precision"] = False
+    if "jit_compile" not in hyperparams:
+        hyperparams["jit_compile"] = False
+    if "lr_scaling" not in hyperparams:
+        hyperparams["lr_scaling"] = "none"
+    if "base_batch_size" not in hyperparams:
+        hyperparams["base_batch_size"] = BASE_BATCH_SIZE
+    hyperparams["base_batch_size"] = validate_batch_size(hyperparams["base_batch_size"])
+    if "warmup_steps" not in hyperparams:
+        hyperparams["warmup_steps"] = 0
+    if "lr_decay" not in hyperparams:
+        hyperparams["lr_decay"] = "none"
+    if "decay_steps" not in hyperparams:
+        hyperparams["decay_steps"] = None
+    if "embedding_optimizer" not in hyperparams:
+        hyperparams["embedding_optimizer"] = "adam"
+    if "user_embedding" not in hyperparams:
+        hyperparams["user_embedding"] = "full"
+    if "user_embedding_buckets" not in hyperparams:
+        hyperparams["user_embedding_buckets"] = embeddings.NUM_BUCKETS
+    if "embedding_lookup" not in hyperparams:
+        hyperparams["embedding_lookup"] = "feature_column"
+    if "checkpoint_steps" not in hyperparams:
+        hyperparams["checkpoint_steps"] = checkpoints.CHECKPOINT_STEPS
+    if "early_stopping_patience" not in hyperparams:
+        hyperparams["early_stopping_patience"] = 0
+    if "validation_fraction" not in hyperparams:
+        hyperparams["validation_fraction"] = VALIDATION_FRACTION
     return hyperparams
 
 
-def train(train_data_file_pattern, nvt_workflow, hyperparams, log_dir=None):
-
-    hyperparams = update_hyperparams(hyperparams)
-    logging.info("Hyperparameter:")
-    logging.info(hyperparams)
-    logging.info("")
-
-    logging.info("Preparing train dataset loader...")
-    train_dataset = KerasSequenceLoader(
-        train_data_file_pattern,
-        batch_size=hyperparams["batch_size"],
-        label_names=features.TARGET_FEATURE_NAME,
-        cat_names=features.get_categorical_feature_names(),
-        cont_names=features.NUMERICAL_FEATURE_NAMES,
-        engine="parquet",
-        shuffle=True,
-        buffer_size=0.06,  # how many batches to load at once
-        parts_per_chunk=1,
+def create_learning_rate(hyperparams, steps_per_epoch=None):
+    # Returns a constant learning rate unless a warmup or a decay is set. The
+    # decay runs to the end of training when decay_steps is not given.
+    learning_rate = schedules.scale_learning_rate(
+        hyperparams["learning_rate"],
+        hyperparams["batch_size"],
+        hyperparams["base_batch_size"],
+        hyperparams["lr_scaling"],
     )
+    logging.info(f"Learning rate: {learning_rate}")
+    if not hyperparams["warmup_steps"] and hyperparams["lr_decay"] == "none":
+        return learning_rate
 
-    embedding_shapes, embedding_shapes_multihot = nvt.ops.get_embedding_sizes(
-        nvt_workflow
+    decay_steps = hyperparams["decay_steps"]
+    if hyperparams["lr_decay"] != "none" and not decay_steps:
+        if not steps_per_epoch:
+            raise ValueError(
+                "decay_steps must be set when the number of steps is unknown."
+            )
+        decay_steps = max(
+            steps_per_epoch * hyperparams["num_epochs"] - hyperparams["warmup_steps"],
+            1,
+        )
+    return schedules.WarmupDecaySchedule(
+        learning_rate,
+        warmup_steps=hyperparams["warmup_steps"],
+        decay=hyperparams["lr_decay"],
+        decay_steps=decay_steps,
     )
+
+
+def set_precision_policy(mixed_precision):
+    # Float16 is only fast on GPUs; CPUs compute in bfloat16 instead. The
+    # policy applies to the layers created after it is set.
+    if not mixed_precision:
+        policy = "float32"
+    elif tf.config.list_physical_devices("GPU"):
+        policy = "mixed_float16"
+    else:
+        policy = "mixed_bfloat16"
+    keras.mixed_precision.set_global_policy(policy)
+    logging.info(f"Precision policy: {policy}")
+
+
+def get_embedding_shapes(nvt_workflow):
+
+    # The NumPy reference workflow computes the sizes from its own vocabularies.
+    if hasattr(nvt_workflow, "get_embedding_sizes"):
+        embedding_shapes, embedding_shapes_multihot = nvt_workflow.get_embedding_sizes()
+    else:
+        import nvtabular as nvt
+
+        embedding_shapes, embedding_shapes_multihot = nvt.ops.get_embedding_sizes(
+            nvt_workflow
+        )
     embedding_shapes.update(embedding_shapes_multihot)
-    logging.info(f"Embedding shapes: {embedding_shapes}")
+    return embedding_shapes
 
-    hidden_units = hyperparams["hidden_units"]
 
-    recommendation_model = model.create(embedding_shapes, hidden_units)
+def create_model(embedding_shapes, hyperparams, steps_per_epoch=None):
 
-    optimizer = keras.optimizers.Adam(learning_rate=hyperparams["learning_rate"])
+    # With mixed precision, compile wraps the optimizer to scale the loss.
+    set_precision_policy(hyperparams["mixed_precision"])
+    recommendation_model = model.create(
+        embedding_shapes,
+        hyperparams["hidden_units"],
+        hyperparams["user_embedding"],
+        hyperparams["user_embedding_buckets"],
+        hyperparams["embedding_lookup"],
+    )
+
+    # The embedding tables can have sparse updates while the tower uses Adam.
+    optimizer = optimizers.create_optimizer(
+        create_learning_rate(hyperparams, steps_per_epoch),
+        hyperparams["embedding_optimizer"],
+    )
     loss = keras.losses.BinaryCrossentropy(from_logits=True)
     metrics = [keras.metrics.MeanAbsoluteError(name="mae")]
 
+    compile_kwargs = {}
+    if "jit_compile" in inspect.signature(keras.Model.compile).parameters:
+        compile_kwargs["jit_compile"] = hyperparams["jit_compile"]
+    else:
+        # Keras versions without jit_compile can only auto-cluster the graph.
+        tf.config.optimizer.set_jit(hyperparams["jit_compile"])
+
     logging.info("Compiling the model...")
-    recommendation_model.compile(optimizer=optimizer, loss=loss, metrics=metrics)
+    recommendation_model.compile(
+        optimizer=optimizer, loss=loss, metrics=metrics, **compile_kwargs
+    )
+    return recommendation_model
 
-    logging.info("Model fitting started...")
-    history = recommendation_model.fit(
-        train_dataset,
-        epochs=hyperparams["num_epochs"],
-        # callbacks=[evaluation_callback],
+
+def create_validation_loader(validation_data_file_pattern, hyperparams):
+    # Reads a fixed sample of the test shards, in order, so that the validation
+    # metric of every epoch is computed on the same rows.
+    data_plan = dataloader.create_data_plan(validation_data_file_pattern)
+    return dataloader.create_loader(
+        dataloader.sample_files(
+            data_plan.data_files, hyperparams["validation_fraction"]
+        ),
+        hyperparams["batch_size"],
+        shuffle=False,
+        part_size=data_plan.part_size,
     )
+
+
+def train(
+    train_data_file_pattern,
+    nvt_workflow,
+    hyperparams,
+    log_dir=None,
+    streaming=False,
+    strategy=None,
+    checkpoint_dir=None,
+    validation_data_file_pattern=None,
+):
+
+    hyperparams = update_hyperparams(hyperparams)
+    logging.info("Hyperparameter:")
+    logging.info(hyperparams)
+    logging.info("")
+    if hyperparams["early_stopping_patience"] and not validation_data_file_pattern:
+        raise ValueError("Early stopping needs validation data.")
+
+    embedding_shapes = get_embedding_shapes(nvt_workflow)
+    logging.info(f"Embedding shapes: {embedding_shapes}")
+
+    if strategy:
+        # batch_size is the global batch size, split between the replicas.
+        num_workers, _ = distribution.get_worker_info()
+        train_dataset, steps_per_epoch = dataloader.create_distributed_dataset(
+            strategy,
+            train_data_file_pattern,
+            hyperparams["batch_size"],
+            shuffle=True,
+            num_workers=num_workers,
+        )
+    else:
+        # With the manifest written by the ETL, the shards and the number of steps
+        # are known without listing the files or reading their footers.
+        data_plan = dataloader.create_data_plan(train_data_file_pattern)
+        steps_per_epoch = None
+        if data_plan.num_rows:
+            steps_per_epoch = -(-data_plan.num_rows // hyperparams["batch_size"])
+
+    # The variables are mirrored on every replica when a strategy is given.
+    with (strategy or tf.distribute.get_strategy()).scope():
+        recommendation_model = create_model(
+            embedding_shapes, hyperparams, steps_per_epoch
+        )
+
+    early_stopping = None
+    if hyperparams["early_stopping_patience"]:
+        # With a strategy, every worker would save the best weights to the
+        # same path, so they are kept in memory instead.
+        early_stopping = checkpoints.EarlyStopping(
+            patience=hyperparams["early_stopping_patience"],
+            best_weights_dir=None if strategy else checkpoint_dir,
+        )
+
+    if strategy:
+        callbacks = [early_stopping] if early_stopping else []
+        if checkpoint_dir:
+            # Resumes from the last finished epoch. Every worker backs up the
+            # model and the optimizer, the non-chief ones to temporary dirs.
+            callbacks.append(
+                tf.keras.callbacks.experimental.BackupAndRestore(checkpoint_dir)
+            )
+        validation_kwargs = {}
+        if early_stopping:
+            validation_dataset, validation_steps = (
+                dataloader.create_distributed_dataset(
+                    strategy,
+                    validation_data_file_pattern,
+                    hyperparams["batch_size"],
+                    shuffle=False,
+                    num_workers=num_workers,
+                )
+            )
+            validation_kwargs = {
+                "validation_data": validation_dataset,
+                "validation_steps": max(
+                    1, int(validation_steps * hyperparams["validation_fraction"])
+                ),
+            }
+        logging.info("Model fitting started...")
+        recommendation_model.fit(
+            train_dataset,
+            epochs=hyperparams["num_epochs"],
+            steps_per_epoch=steps_per_epoch,
+            callbacks=callbacks,
+            **validation_kwargs,
+        )
+        logging.info("Model fitting finished.")
+        return recommendation_model
+
+    # Globally shuffled shards only need a small shuffle buffer, which still
+    # reorders the shards and the rows within each chunk every epoch.
+    buffer_size = dataloader.BUFFER_SIZE
+    if data_plan.is_shuffled:
+        buffer_size = dataloader.SHUFFLED_BUFFER_SIZE
+
+    validation_loader = None
+    if early_stopping:
+        validation_loader = create_validation_loader(
+            validation_data_file_pattern, hyperparams
+        )
+
+    checkpoint = None
+    initial_epoch, initial_step = 0, 0
+    if checkpoint_dir:
+        checkpoint = checkpoints.TrainingCheckpoint(
+            checkpoint_dir,
+            recommendation_model,
+            hyperparams["checkpoint_steps"],
+            early_stopping,
+        )
+        initial_epoch, initial_step = checkpoint.restore()
+    callbacks = [callback for callback in [early_stopping, checkpoint] if callback]
+
+    def fit(train_dataset, epoch, epochs, skip=0):
+        # Resumes an interrupted epoch after the batches it had trained on, see
+        # dataloader.seek.
+        fit_kwargs = {}
+        start_batch, steps = dataloader.seek(train_dataset, epoch, skip)
+        if skip:
+            fit_kwargs["steps_per_epoch"] = steps
+        if checkpoint:
+            checkpoint.step_offset = start_batch
+        recommendation_model.fit(
+            train_dataset,
+            initial_epoch=epoch,
+            epochs=epochs,
+            validation_data=validation_loader,
+            callbacks=callbacks,
+            **fit_kwargs,
+        )
+        return bool(early_stopping and early_stopping.stopped)
+
+    stopped = bool(early_stopping and early_stopping.stopped)
+    logging.info("Model fitting started...")
+    if streaming and dataloader.is_remote(train_data_file_pattern):
+        # Training starts once the first shards are cached, and the cache
+        # downloads the next ones ahead of the loader. Shards that stay cached
+        # are not downloaded again in later epochs.
+        shard_cache = dataloader.ShardCache(data_plan.data_files).start()
+        try:
+            for epoch in range(initial_epoch, hyperparams["num_epochs"]):
+                if stopped:
+                    break
+                logging.info("Preparing train dataset loader...")
+                train_dataset = dataloader.create_loader(
+                    shard_cache.remote_files,
+                    hyperparams["batch_size"],
+                    shuffle=True,
+                    part_size=data_plan.part_size,
+                    buffer_size=buffer_size,
+                    shard_cache=shard_cache,
+                )
+                stopped = fit(
+                    train_dataset,
+                    epoch,
+                    epoch + 1,
+                    skip=initial_step if epoch == initial_epoch else 0,
+                )
+        finally:
+            shard_cache.close()
+    else:
+        logging.info("Preparing train dataset loader...")
+        train_dataset = dataloader.create_loader(
+            data_plan.data_files,
+            hyperparams["batch_size"],
+            shuffle=True,
+            part_size=data_plan.part_size,
+            buffer_size=buffer_size,
+        )
+        epoch = initial_epoch
+        if initial_step and epoch < hyperparams["num_epochs"] and not stopped:
+            stopped = fit(train_dataset, epoch, epoch + 1, skip=initial_step)
+            epoch += 1
+        if epoch < hyperparams["num_epochs"] and not stopped:
+            fit(train_dataset, epoch, hyperparams["num_epochs"])
     logging.info("Model fitting finished.")
 
     return recommendation_model
 
 
-def evaluate(recommendation_model, eval_data_file_pattern, hyperparams):
+def evaluate(recommendation_model, eval_data_file_pattern, hyperparams, strategy=None):
+
+    if strategy:
+        # Every worker evaluates its own shards; the metrics are aggregated.
+        num_workers, _ = distribution.get_worker_info()
+        eval_dataset, steps = dataloader.create_distributed_dataset(
+            strategy,
+            eval_data_file_pattern,
+            hyperparams["batch_size"],
+            shuffle=False,
+            num_workers=num_workers,
+        )
+        logging.info("Evaluating the model...")
+        evaluation_metrics = recommendation_model.evaluate(eval_dataset, steps=steps)
+        logging.info(
+            f"Evaluation loss: {evaluation_metrics[0]} - Evaluation MAE {evaluation_metrics[1]}"
+        )
+        return evaluation_metrics
 
     logging.info("Preparing evaluation dataset loader...")
-    eval_dataset = KerasSequenceLoader(
-        eval_data_file_pattern,
-        batch_size=hyperparams["batch_size"],
-        label_names=features.TARGET_FEATURE_NAME,
-        cat_names=features.get_categorical_feature_names(),
-        cont_names=features.NUMERICAL_FEATURE_NAMES,
-        engine="parquet",
+    data_plan = dataloader.create_data_plan(eval_data_file_pattern)
+    eval_dataset = dataloader.create_loader(
+        data_plan.data_files,
+        hyperparams["batch_size"],
         shuffle=False,
-        buffer_size=0.06,  # how many batches to load at once
-        parts_per_chunk=1,
+        part_size=data_plan.part_size,
     )
 
     logging.info("Evaluating the model...")
@@ -118,7 +434,45 @@ def evaluate(recommendation_model, eval_data_file_pattern, hyperparams):
     return evaluation_metrics
 
 
-def export(recommendation_model, nvt_workflow, model_name, export_dir):
+def export_retrieval(recommendation_model, workflow_dir, retrieval_dir, ivf_lists=0):
+    # Exports the movie embedding table and its ids for top-K retrieval.
+    item_embeddings = model.get_embedding_tables(recommendation_model)[
+        "movieId_embedding/embedding_weights"
+    ].numpy()
+    retrieval_artifact.export_artifact(
+        item_embeddings, workflow_dir, retrieval_dir, ivf_lists
+    )
+    logging.info(f"Retrieval artifact is exported to {retrieval_dir}.")
+
+
+def export(
+    recommendation_model,
+    nvt_workflow,
+    model_name,
+    export_dir,
+    retrieval_dir=None,
+    workflow_dir=None,
+    ivf_lists=0,
+    online_transform_dir=None,
+):
+
+    # The retrieval and online transform artifacts are kept out of export_dir,
+    # which is a Triton model repository for NVTabular workflows.
+    if retrieval_dir:
+        export_retrieval(recommendation_model, workflow_dir, retrieval_dir, ivf_lists)
+
+    if online_transform_dir:
+        OnlineTransform.from_workflow_dir(workflow_dir).save(online_transform_dir)
+        logging.info(f"Online transform is exported to {online_transform_dir}.")
+
+    if isinstance(nvt_workflow, cpu_workflow.CpuWorkflow):
+        # The Triton ensemble needs an NVTabular workflow, so only the model and
+        # the workflow it was trained with are exported.
+        recommendation_model.save(os.path.join(export_dir, model_name))
+        nvt_workflow.save(os.path.join(export_dir, "transform_workflow"))
+        return
+
+    from nvtabular.inference.triton import export_tensorflow_ensemble
 
     for feature_name in features.CATEGORICAL_FEATURE_NAMES:
         nvt_workflow.output_dtypes[feature_name] = "int32"
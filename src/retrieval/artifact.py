@@ -0,0 +1,131 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Retrieval artifact exported with the model.
+
+The model scores (userId, movieId) pairs with a DNN, so its user and movie
+embeddings are not in one space. The artifact holds the movie embedding table
+as a contiguous float32 matrix, where row i is the movie encoded as i, and the
+raw movieId of each row (-1 for row 0, the unknown movie). A user is queried
+with the mean embedding of the movies they rated positively, and the nearest
+movies are the candidates to score with the model.
+"""
+
+import io
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import tensorflow.io as tf_io
+
+from src.common import categories
+from src.retrieval.index import BruteForceIndex, IVFIndex
+
+ITEM_EMBEDDINGS_FILE = "item_embeddings.npy"
+ITEM_IDS_FILE = "item_ids.npy"
+METADATA_FILE = "retrieval.json"
+TOP_K = 10
+
+
+def save_npy(path, array):
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(array))
+    with tf_io.gfile.GFile(path, "wb") as file:
+        file.write(buffer.getvalue())
+
+
+def load_npy(path):
+    with tf_io.gfile.GFile(path, "rb") as file:
+        return np.load(io.BytesIO(file.read()))
+
+
+def get_item_ids(workflow_dir):
+    # The raw movieId of each encoded movie, from the Categorify vocabulary.
+    item_ids = pd.Series(categories.read_categories(workflow_dir, "movieId"))
+    return item_ids.fillna(-1).astype(np.int64).values
+
+
+def export_artifact(item_embeddings, workflow_dir, retrieval_dir, ivf_lists=0):
+    item_embeddings = np.asarray(item_embeddings, dtype=np.float32)
+    item_ids = get_item_ids(workflow_dir)
+    if len(item_ids) != len(item_embeddings):
+        raise ValueError(
+            f"The {len(item_embeddings)} item embeddings do not match the "
+            f"{len(item_ids)} movieId categories."
+        )
+    tf_io.gfile.makedirs(retrieval_dir)
+    save_npy(os.path.join(retrieval_dir, ITEM_EMBEDDINGS_FILE), item_embeddings)
+    save_npy(os.path.join(retrieval_dir, ITEM_IDS_FILE), item_ids)
+    with tf_io.gfile.GFile(os.path.join(retrieval_dir, METADATA_FILE), "w") as file:
+        json.dump(
+            {
+                "num_items": len(item_ids) - 1,
+                "dimension": item_embeddings.shape[1],
+                "metric": "cosine",
+            },
+            file,
+        )
+    if ivf_lists:
+        IVFIndex.build(item_embeddings[1:], item_ids[1:], ivf_lists).save(retrieval_dir)
+
+
+class RetrievalArtifact:
+    def __init__(self, item_embeddings, item_ids, ivf_index=None):
+        self.item_embeddings = item_embeddings
+        self.item_ids = item_ids
+        self._rows = pd.Index(item_ids)
+        # The unknown movie, row 0, is never retrieved.
+        self.brute_force_index = BruteForceIndex(item_embeddings[1:], item_ids[1:])
+        self.ivf_index = ivf_index
+
+    @classmethod
+    def load(cls, retrieval_dir):
+        ivf_index = None
+        if IVFIndex.exists(retrieval_dir):
+            ivf_index = IVFIndex.load(retrieval_dir)
+        return cls(
+            load_npy(os.path.join(retrieval_dir, ITEM_EMBEDDINGS_FILE)),
+            load_npy(os.path.join(retrieval_dir, ITEM_IDS_FILE)),
+            ivf_index,
+        )
+
+    def encode(self, movie_ids):
+        # Raw movie ids to encoded rows; unknown movies are dropped.
+        rows = self._rows.get_indexer(np.asarray(movie_ids).reshape(-1))
+        return rows[rows > 0]
+
+    def user_vectors(self, histories):
+        # The pooled vector of each user, from the raw ids of the movies they
+        # rated positively. Users without known movies get a zero vector.
+        vectors = np.zeros(
+            (len(histories), self.item_embeddings.shape[1]), dtype=np.float32
+        )
+        for user_index, history in enumerate(histories):
+            rows = self.encode(history)
+            if len(rows):
+                vectors[user_index] = self.item_embeddings[rows].mean(axis=0)
+        return vectors
+
+    def recommend(self, histories, k=TOP_K, approximate=False, exclude_history=True):
+        # Returns the raw ids and scores of the top k movies of each user, by
+        # default without the movies of their history. approximate uses the IVF
+        # index when it was exported.
+        queries = self.user_vectors(histories)
+        exclude_rows = None
+        if exclude_history:
+            # The indexes hold rows 1.. of the embedding matrix.
+            exclude_rows = [self.encode(history) - 1 for history in histories]
+        if approximate and self.ivf_index is not None:
+            return self.ivf_index.search(queries, k, exclude_rows=exclude_rows)
+        return self.brute_force_index.search(queries, k, exclude_rows=exclude_rows)
@@ -0,0 +1,212 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Top-K search over item embeddings by cosine similarity.
+
+BruteForceIndex scores every item with one matrix product per chunk of
+queries. IVFIndex clusters the items with k-means and only scores the items of
+the clusters nearest to each query, optionally stored as int8 codes.
+"""
+
+import io
+import os
+import json
+
+import numpy as np
+import tensorflow.io as tf_io
+
+QUERY_CHUNK_SIZE = 256
+NUM_PROBES = 8
+KMEANS_ITERATIONS = 10
+RANDOM_STATE = 42
+IVF_FILE = "ivf_index.npz"
+IVF_METADATA_FILE = "ivf_index.json"
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.ascontiguousarray(vectors / np.maximum(norms, 1e-12))
+
+
+def top_k(scores, k):
+    # Returns the positions and scores of the k highest scores of each row,
+    # best first, without sorting the whole rows.
+    k = min(k, scores.shape[1])
+    positions = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, positions, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return (
+        np.take_along_axis(positions, order, axis=1),
+        np.take_along_axis(top_scores, order, axis=1),
+    )
+
+
+def mask_rows(scores, exclude_rows):
+    # Excludes, e.g., the items a user already rated. exclude_rows holds an
+    # array of item rows per query.
+    if exclude_rows is None:
+        return scores
+    for query_index, rows in enumerate(exclude_rows):
+        scores[query_index, rows] = -np.inf
+    return scores
+
+
+def save_npz(path, **arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    with tf_io.gfile.GFile(path, "wb") as file:
+        file.write(buffer.getvalue())
+
+
+def load_npz(path):
+    with tf_io.gfile.GFile(path, "rb") as file:
+        return dict(np.load(io.BytesIO(file.read())))
+
+
+class BruteForceIndex:
+    def __init__(self, embeddings, ids):
+        self.embeddings = normalize(embeddings)
+        self.ids = np.asarray(ids)
+
+    def search(self, queries, k=10, exclude_rows=None):
+        # Returns the ids and scores of the k nearest items of each query.
+        queries = normalize(np.atleast_2d(queries))
+        result_ids, result_scores = [], []
+        for start in range(0, len(queries), QUERY_CHUNK_SIZE):
+            chunk = slice(start, start + QUERY_CHUNK_SIZE)
+            scores = queries[chunk] @ self.embeddings.T
+            if exclude_rows is not None:
+                scores = mask_rows(scores, exclude_rows[chunk])
+            positions, top_scores = top_k(scores, k)
+            result_ids.append(self.ids[positions])
+            result_scores.append(top_scores)
+        return np.concatenate(result_ids), np.concatenate(result_scores)
+
+
+def kmeans(vectors, num_clusters, iterations=KMEANS_ITERATIONS, seed=RANDOM_STATE):
+    # Spherical k-means on normalised vectors. Empty clusters keep their
+    # previous centroid.
+    random_state = np.random.RandomState(seed)
+    centroids = vectors[
+        random_state.choice(len(vectors), num_clusters, replace=False)
+    ].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        is_filled = np.bincount(assignments, minlength=num_clusters) > 0
+        centroids[is_filled] = normalize(sums[is_filled])
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+class IVFIndex:
+    # The items are stored grouped by cluster: the items of cluster c are rows
+    # list_offsets[c]:list_offsets[c + 1] of vectors, and rows maps them back
+    # to their rows in the embedding matrix. With int8 codes, each dimension
+    # is stored as round(value / scale) with a per-dimension scale.
+
+    def __init__(self, centroids, list_offsets, rows, vectors, ids, scales=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.rows = rows
+        self.vectors = vectors
+        self.ids = np.asarray(ids)
+        self.scales = scales
+
+    @classmethod
+    def build(cls, embeddings, ids, num_lists=None, quantize=True):
+        vectors = normalize(embeddings)
+        num_lists = num_lists or max(1, int(np.sqrt(len(vectors))))
+        centroids, assignments = kmeans(vectors, min(num_lists, len(vectors)))
+        rows = np.argsort(assignments, kind="stable")
+        list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))]
+        )
+        vectors = vectors[rows]
+        scales = None
+        if quantize:
+            scales = np.maximum(np.abs(vectors).max(axis=0), 1e-12) / 127
+            vectors = np.round(vectors / scales).astype(np.int8)
+        return cls(centroids, list_offsets, rows, vectors, ids, scales)
+
+    def search(self, queries, k=10, num_probes=NUM_PROBES, exclude_rows=None):
+        # Scores the items of the num_probes clusters nearest to each query.
+        # Queries with fewer than k items in those clusters are padded with -1.
+        queries = normalize(np.atleast_2d(queries))
+        num_probes = min(num_probes, len(self.centroids))
+        probes, _ = top_k(queries @ self.centroids.T, num_probes)
+        result_ids = np.full((len(queries), k), -1, dtype=self.ids.dtype)
+        result_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for query_index, query in enumerate(queries):
+            positions = np.concatenate(
+                [
+                    np.arange(self.list_offsets[probe], self.list_offsets[probe + 1])
+                    for probe in probes[query_index]
+                ]
+            )
+            if self.scales is not None:
+                scores = self.vectors[positions].astype(np.float32) @ (
+                    query * self.scales
+                )
+            else:
+                scores = self.vectors[positions] @ query
+            rows = self.rows[positions]
+            if exclude_rows is not None:
+                scores[np.isin(rows, exclude_rows[query_index])] = -np.inf
+            if not len(scores):
+                continue
+            top_positions, top_scores = top_k(scores[np.newaxis], k)
+            result_ids[query_index, : top_positions.shape[1]] = self.ids[
+                rows[top_positions[0]]
+            ]
+            result_scores[query_index, : top_scores.shape[1]] = top_scores[0]
+        return result_ids, result_scores
+
+    def save(self, index_dir):
+        tf_io.gfile.makedirs(index_dir)
+        arrays = {
+            "centroids": self.centroids,
+            "list_offsets": self.list_offsets,
+            "rows": self.rows,
+            "vectors": self.vectors,
+            "ids": self.ids,
+        }
+        if self.scales is not None:
+            arrays["scales"] = self.scales
+        save_npz(os.path.join(index_dir, IVF_FILE), **arrays)
+        with tf_io.gfile.GFile(os.path.join(index_dir, IVF_METADATA_FILE), "w") as file:
+            json.dump(
+                {
+                    "num_lists": len(self.centroids),
+                    "num_items": len(self.rows),
+                    "quantized": self.scales is not None,
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, index_dir):
+        arrays = load_npz(os.path.join(index_dir, IVF_FILE))
+        return cls(
+            arrays["centroids"],
+            arrays["list_offsets"],
+            arrays["rows"],
+            arrays["vectors"],
+            arrays["ids"],
+            arrays.get("scales"),
+        )
+
+    @staticmethod
+    def exists(index_dir):
+        return tf_io.gfile.exists(os.path.join(index_dir, IVF_FILE))
@@ -0,0 +1,214 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Latency benchmark of the online transform against the workflow transform.
+
+Transforms batches of raw (userId, movieId) requests, sampled from the
+vocabularies with a share of unknown ids, one batch at a time, and reports the
+p50 and p99 latency of each batch size for the online transform and for the
+transform of the fitted workflow, NVTabular or CPU. It also checks that both
+encode the ids and the genres of every timed request the same way. For example:
+
+    python -m src.serving.benchmark \
+        --transform-workflow-dir transform_workflow \
+        --batch-sizes 1,8,64,1024
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import tensorflow as tf
+
+from src.common import categories, features
+from src.data_preprocessing import cpu_workflow
+from src.serving.online_transform import OnlineTransform
+
+BATCH_SIZES = "1,4,16,64,256,1024"
+NUM_REQUESTS = 200
+WARMUP_REQUESTS = 10
+UNKNOWN_FRACTION = 0.05
+RANDOM_STATE = 42
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--transform-workflow-dir", required=True, type=str)
+
+    parser.add_argument(
+        "--online-transform-dir",
+        type=str,
+        default=None,
+        help="Exported online transform. Built from the workflow by default.",
+    )
+
+    parser.add_argument("--batch-sizes", type=str, default=BATCH_SIZES)
+
+    parser.add_argument(
+        "--num-requests",
+        type=int,
+        default=NUM_REQUESTS,
+        help="Timed batches per batch size.",
+    )
+
+    parser.add_argument(
+        "--skip-workflow",
+        action="store_true",
+        help="Only time the online transform.",
+    )
+
+    parser.add_argument("--output-file", type=str, default=None)
+
+    return parser.parse_args()
+
+
+def sample_requests(workflow_dir, num_rows, random_state):
+    # Raw ids drawn from the vocabularies, with UNKNOWN_FRACTION of them
+    # replaced by ids outside any vocabulary.
+    request = {}
+    for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+        vocabulary = categories.read_categories(workflow_dir, feature_name)[1:]
+        raw_ids = random_state.choice(vocabulary.astype(np.int64), num_rows)
+        is_unknown = random_state.rand(num_rows) < UNKNOWN_FRACTION
+        raw_ids[is_unknown] = -1 - random_state.randint(0, 1000, is_unknown.sum())
+        request[feature_name] = raw_ids
+    return request
+
+
+def workflow_transform(transform_workflow, request):
+    # The transform of the full workflow, as run for each request by the
+    # Triton ensemble, from the request arrays. Returns its output table, a
+    # pyarrow table for the CPU workflow and a pandas DataFrame otherwise.
+    request = pd.DataFrame(
+        dict(request, rating=np.zeros(len(request["userId"]), dtype=np.float32))
+    )
+    if isinstance(transform_workflow, cpu_workflow.CpuWorkflow):
+        return transform_workflow.transform(request)
+    import nvtabular as nvt
+
+    transformed = transform_workflow.transform(nvt.Dataset(request)).to_ddf().compute()
+    if hasattr(transformed, "to_pandas"):
+        transformed = transformed.to_pandas()
+    return transformed
+
+
+def get_workflow_arrays(transformed):
+    # The encoded ids and the genres__values / genres__nnzs pair of a workflow
+    # output, like OnlineTransform.transform_arrays.
+    arrays = {}
+    if isinstance(transformed, pa.Table):
+        for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+            arrays[feature_name] = transformed.column(feature_name).to_pandas().values
+        genres = pa.concat_arrays(transformed.column("genres").chunks)
+        arrays["genres__values"] = genres.flatten().to_numpy()
+        arrays["genres__nnzs"] = np.diff(genres.offsets.to_numpy())
+        return arrays
+    for feature_name in features.CATEGORICAL_FEATURE_NAMES:
+        arrays[feature_name] = transformed[feature_name].values
+    genres = [np.asarray(row, dtype=np.int64) for row in transformed["genres"]]
+    arrays["genres__values"] = np.concatenate(genres + [np.empty(0, np.int64)])
+    arrays["genres__nnzs"] = np.array([len(row) for row in genres])
+    return arrays
+
+
+def count_mismatches(transform_workflow, online_transform, requests):
+    # Requests that the online transform encodes differently from the workflow,
+    # ids and genres.
+    num_mismatches = 0
+    for request in requests:
+        expected = get_workflow_arrays(workflow_transform(transform_workflow, request))
+        actual = online_transform.transform_arrays(
+            request["userId"], request["movieId"]
+        )
+        num_mismatches += not all(
+            np.array_equal(expected[name], actual[name]) for name in expected
+        )
+    return num_mismatches
+
+
+def time_batches(transform_fn, requests):
+    latencies = []
+    for index, request in enumerate(requests):
+        start_time = time.perf_counter()
+        transform_fn(request)
+        if index >= WARMUP_REQUESTS:
+            latencies.append(time.perf_counter() - start_time)
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean()),
+    }
+
+
+def run(args):
+    workflow_dir = args.transform_workflow_dir
+    if args.online_transform_dir:
+        online_transform = OnlineTransform.load(args.online_transform_dir)
+    else:
+        online_transform = OnlineTransform.from_workflow_dir(workflow_dir)
+    transform_workflow = None
+    if not args.skip_workflow:
+        transform_workflow = cpu_workflow.load_workflow(workflow_dir)
+
+    random_state = np.random.RandomState(RANDOM_STATE)
+    results = []
+    for batch_size in [int(value) for value in args.batch_sizes.split(",")]:
+        requests = [
+            sample_requests(workflow_dir, batch_size, random_state)
+            for _ in range(WARMUP_REQUESTS + args.num_requests)
+        ]
+        result = {
+            "batch_size": batch_size,
+            "online_transform": time_batches(
+                lambda request: online_transform.transform(
+                    request["userId"], request["movieId"]
+                ),
+                requests,
+            ),
+        }
+        if transform_workflow is not None:
+            result["workflow_transform"] = time_batches(
+                lambda request: workflow_transform(transform_workflow, request),
+                requests,
+            )
+            result["p50_speedup"] = (
+                result["workflow_transform"]["p50_ms"]
+                / result["online_transform"]["p50_ms"]
+            )
+            # Both transforms must encode every timed request the same way.
+            result["workflow_mismatches"] = count_mismatches(
+                transform_workflow, online_transform, requests[WARMUP_REQUESTS:]
+            )
+            result["matches_workflow"] = result["workflow_mismatches"] == 0
+        logging.info(f"batch_size={batch_size}: {result}")
+        results.append(result)
+
+    if args.output_file:
+        with tf.io.gfile.GFile(args.output_file, "w") as file:
+            json.dump(results, file, indent=2)
+        logging.info(f"Benchmark results are written to {args.output_file}.")
+    return results
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info(f"Python Version = {sys.version}")
+    logging.info(f"TensorFlow Version = {tf.__version__}")
+    run(get_args())
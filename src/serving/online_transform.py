@@ -0,0 +1,221 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Online transform artifact exported with the model.
+
+It applies the transform workflow to raw (userId, movieId) requests with NumPy
+gathers only, without the dataframes of the NVTabular JoinExternal and
+Categorify ops, which dominate the latency of small batches:
+  - Each Categorify vocabulary is a lookup from raw id to encoded id: a dense
+    array indexed by the raw id when the ids are small, non-negative integers
+    (a perfect hash), and otherwise the sorted raw ids with their encoded ids,
+    searched with np.searchsorted.
+  - The genres of the movies are a dense [num_movies, max_genres] matrix,
+    padded with 0, and the number of genres of each movie, indexed by the
+    encoded movie id.
+Unknown ids are encoded as 0, like Categorify does.
+"""
+
+import io
+import os
+import json
+
+import numpy as np
+import tensorflow.io as tf_io
+
+from src.common import categories, features
+from src.common.movie_features import MovieFeatureTable
+
+ONLINE_TRANSFORM_FILE = "online_transform.npz"
+ONLINE_TRANSFORM_METADATA_FILE = "online_transform.json"
+# Dense lookups are used while the largest raw id is at most this many times
+# the vocabulary size.
+MAX_DENSE_LOOKUP_RATIO = 4
+
+
+class CategoryLookup:
+    # Encodes raw ids either with a dense table, where table[raw_id] is the
+    # encoded id, or with the sorted raw ids and their encoded ids.
+
+    def __init__(self, table=None, sorted_ids=None, encoded_ids=None):
+        self.table = table
+        self.sorted_ids = sorted_ids
+        self.encoded_ids = encoded_ids
+
+    @property
+    def is_dense(self):
+        return self.table is not None
+
+    @classmethod
+    def build(cls, vocabulary, max_dense_lookup_ratio=MAX_DENSE_LOOKUP_RATIO):
+        # vocabulary holds the raw id encoded as i + 1 at position i.
+        vocabulary = np.asarray(vocabulary, dtype=np.int64)
+        encoded_ids = np.arange(1, len(vocabulary) + 1, dtype=np.int32)
+        if len(vocabulary) and vocabulary.min() >= 0:
+            table_size = int(vocabulary.max()) + 1
+            if table_size <= max(1, len(vocabulary)) * max_dense_lookup_ratio:
+                table = np.zeros(table_size, dtype=np.int32)
+                table[vocabulary] = encoded_ids
+                return cls(table=table)
+        order = np.argsort(vocabulary, kind="stable")
+        return cls(sorted_ids=vocabulary[order], encoded_ids=encoded_ids[order])
+
+    def encode(self, raw_ids):
+        raw_ids = np.asarray(raw_ids, dtype=np.int64).reshape(-1)
+        if self.is_dense:
+            is_known = (raw_ids >= 0) & (raw_ids < len(self.table))
+            return np.where(is_known, self.table[np.where(is_known, raw_ids, 0)], 0)
+        if not len(self.sorted_ids):
+            return np.zeros(len(raw_ids), dtype=np.int32)
+        # Searching the ids in order touches the sorted ids in order, which
+        # is faster for large batches than random probes.
+        order = np.argsort(raw_ids)
+        positions = np.empty(len(raw_ids), dtype=np.int64)
+        positions[order] = np.searchsorted(self.sorted_ids, raw_ids[order])
+        positions = np.minimum(positions, len(self.sorted_ids) - 1)
+        return np.where(
+            self.sorted_ids[positions] == raw_ids, self.encoded_ids[positions], 0
+        )
+
+    def to_arrays(self, prefix):
+        if self.is_dense:
+            return {f"{prefix}table": self.table}
+        return {
+            f"{prefix}sorted_ids": self.sorted_ids,
+            f"{prefix}encoded_ids": self.encoded_ids,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        return cls(
+            table=arrays.get(f"{prefix}table"),
+            sorted_ids=arrays.get(f"{prefix}sorted_ids"),
+            encoded_ids=arrays.get(f"{prefix}encoded_ids"),
+        )
+
+
+class OnlineTransform:
+    def __init__(self, lookups, genre_matrix, genre_nnzs):
+        self.lookups = lookups
+        self.genre_matrix = genre_matrix
+        self.genre_nnzs = genre_nnzs
+
+    @property
+    def num_movies(self):
+        return len(self.genre_nnzs)
+
+    @classmethod
+    def build(cls, vocabularies, movie_features):
+        # vocabularies holds the raw ids of each categorical feature, without
+        # the null row 0 of the categories files.
+        lookups = {
+            feature_name: CategoryLookup.build(vocabularies[feature_name])
+            for feature_name in features.CATEGORICAL_FEATURE_NAMES
+        }
+        genre_nnzs = np.diff(movie_features.genre_offsets).astype(np.int32)
+        genre_matrix = np.zeros(
+            (len(genre_nnzs), max(1, int(genre_nnzs.max(initial=0)))), dtype=np.int32
+        )
+        genre_rows = np.repeat(np.arange(len(genre_nnzs)), genre_nnzs)
+        genre_columns = np.arange(len(genre_rows)) - np.repeat(
+            movie_features.genre_offsets[:-1], genre_nnzs
+        )
+        genre_matrix[genre_rows, genre_columns] = movie_features.genre_values
+        return cls(lookups, genre_matrix, genre_nnzs)
+
+    @classmethod
+    def from_workflow_dir(cls, workflow_dir):
+        # Works for both the NVTabular and the CPU workflow, which write the
+        # same categories files and movie features table.
+        vocabularies = {
+            feature_name: categories.read_categories(workflow_dir, feature_name)[
+                1:
+            ].astype(np.int64)
+            for feature_name in features.CATEGORICAL_FEATURE_NAMES
+        }
+        return cls.build(vocabularies, MovieFeatureTable.load(workflow_dir))
+
+    def transform_arrays(self, user_ids, movie_ids):
+        # Returns the model inputs of raw (userId, movieId) pairs, with the
+        # genres as the genres__values / genres__nnzs pair.
+        transformed = {
+            "userId": self.lookups["userId"].encode(user_ids),
+            "movieId": self.lookups["movieId"].encode(movie_ids),
+        }
+        # The encoded ids are in 0..num_movies - 1, so this is a plain gather.
+        genre_nnzs = self.genre_nnzs[transformed["movieId"]]
+        genre_rows = self.genre_matrix[transformed["movieId"]]
+        transformed["genres__values"] = genre_rows[
+            np.arange(genre_rows.shape[1]) < genre_nnzs[:, np.newaxis]
+        ]
+        transformed["genres__nnzs"] = genre_nnzs
+        return transformed
+
+    def transform(self, user_ids, movie_ids):
+        # Returns the inputs of the Keras model, as fed by evaluation.predict.
+        transformed = self.transform_arrays(user_ids, movie_ids)
+        return {
+            "userId": transformed["userId"].reshape(-1, 1),
+            "movieId": transformed["movieId"].reshape(-1, 1),
+            "genres": (
+                transformed["genres__values"].astype(np.int64).reshape(-1, 1),
+                transformed["genres__nnzs"].astype(np.int64).reshape(-1, 1),
+            ),
+        }
+
+    def save(self, export_dir):
+        tf_io.gfile.makedirs(export_dir)
+        arrays = {"genre_matrix": self.genre_matrix, "genre_nnzs": self.genre_nnzs}
+        for feature_name, lookup in self.lookups.items():
+            arrays.update(lookup.to_arrays(f"{feature_name}__"))
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        with tf_io.gfile.GFile(
+            os.path.join(export_dir, ONLINE_TRANSFORM_FILE), "wb"
+        ) as file:
+            file.write(buffer.getvalue())
+        with tf_io.gfile.GFile(
+            os.path.join(export_dir, ONLINE_TRANSFORM_METADATA_FILE), "w"
+        ) as file:
+            json.dump(
+                {
+                    "features": list(self.lookups),
+                    "dense_lookups": [
+                        feature_name
+                        for feature_name, lookup in self.lookups.items()
+                        if lookup.is_dense
+                    ],
+                    "num_movies": self.num_movies,
+                    "max_genres": self.genre_matrix.shape[1],
+                },
+                file,
+            )
+
+    @classmethod
+    def load(cls, export_dir):
+        with tf_io.gfile.GFile(
+            os.path.join(export_dir, ONLINE_TRANSFORM_METADATA_FILE), "r"
+        ) as file:
+            feature_names = json.load(file)["features"]
+        with tf_io.gfile.GFile(
+            os.path.join(export_dir, ONLINE_TRANSFORM_FILE), "rb"
+        ) as file:
+            arrays = dict(np.load(io.BytesIO(file.read())))
+        return cls(
+            {
+                feature_name: CategoryLookup.from_arrays(arrays, f"{feature_name}__")
+                for feature_name in feature_names
+            },
+            arrays["genre_matrix"],
+            arrays["genre_nnzs"],
+        )
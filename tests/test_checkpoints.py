@@ -0,0 +1,90 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the training checkpoints and early stopping."""
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from src.model_training import checkpoints  # noqa: E402
+
+FEATURES = np.arange(16, dtype=np.float32).reshape(8, 2) / 10
+LABELS = FEATURES.sum(axis=1, keepdims=True)
+
+
+def create_model():
+    model = tf.keras.Sequential([tf.keras.layers.Dense(1, input_shape=(2,))])
+    model.compile(optimizer=tf.keras.optimizers.Adam(0.01), loss="mse")
+    return model
+
+
+def test_resumes_at_the_saved_step(tmp_path):
+    checkpoint_dir = str(tmp_path)
+    model = create_model()
+    early_stopping = checkpoints.EarlyStopping(patience=2)
+    checkpoint = checkpoints.TrainingCheckpoint(
+        checkpoint_dir, model, save_steps=2, early_stopping=early_stopping
+    )
+    assert checkpoint.restore() == (0, 0)
+
+    model.fit(
+        FEATURES, LABELS, batch_size=4, epochs=1, callbacks=[checkpoint], verbose=0
+    )
+    early_stopping.wait.assign(1)
+    # A fit call that resumes the second epoch after 3 batches saves the steps
+    # of the epoch, not of the call.
+    checkpoint.step_offset = 3
+    model.train_on_batch(FEATURES[:4], LABELS[:4])
+    checkpoint.on_train_batch_end(0)
+
+    restored_model = create_model()
+    restored_early_stopping = checkpoints.EarlyStopping(patience=2)
+    restored_checkpoint = checkpoints.TrainingCheckpoint(
+        checkpoint_dir,
+        restored_model,
+        save_steps=2,
+        early_stopping=restored_early_stopping,
+    )
+    assert restored_checkpoint.restore() == (1, 4)
+    # The optimizer slots are restored when training creates them.
+    restored_model.fit(FEATURES, LABELS, batch_size=8, epochs=1, verbose=0)
+    model.fit(FEATURES, LABELS, batch_size=8, epochs=1, verbose=0)
+    assert int(restored_model.optimizer.iterations) == int(model.optimizer.iterations)
+    for restored_var, var in zip(restored_model.weights, model.weights):
+        np.testing.assert_allclose(restored_var.numpy(), var.numpy(), rtol=1e-6)
+        for slot_name in ["m", "v"]:
+            np.testing.assert_allclose(
+                restored_model.optimizer.get_slot(restored_var, slot_name).numpy(),
+                model.optimizer.get_slot(var, slot_name).numpy(),
+                rtol=1e-6,
+            )
+    assert int(restored_early_stopping.wait.numpy()) == 1
+
+
+def test_early_stopping_restores_the_best_weights(tmp_path):
+    model = create_model()
+    early_stopping = checkpoints.EarlyStopping(
+        patience=2, best_weights_dir=str(tmp_path)
+    )
+    early_stopping.set_model(model)
+    early_stopping.on_epoch_end(0, {"val_loss": 1.0})
+    best_weights = model.get_weights()
+    for epoch, val_loss in enumerate([1.5, 2.0], start=1):
+        model.set_weights([weights + 1 for weights in model.get_weights()])
+        early_stopping.on_epoch_end(epoch, {"val_loss": val_loss})
+    assert early_stopping.stopped
+    assert model.stop_training
+    for weights, expected in zip(model.get_weights(), best_weights):
+        np.testing.assert_array_equal(weights, expected)
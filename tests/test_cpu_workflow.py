@@ -0,0 +1,159 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the NumPy workflow, and its parity with the NVTabular workflow."""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.common import categories  # noqa: E402
+from src.common.movie_features import MovieFeatureTable  # noqa: E402
+from src.data_preprocessing import cpu_workflow, etl  # noqa: E402
+from src.data_preprocessing.profiler import NullProfiler  # noqa: E402
+
+MOVIES = pd.DataFrame(
+    {
+        "movieId": [10, 20, 30, 40],
+        "title": ["A", "B", "C", "D"],
+        "genres": ["Drama|Comedy", "Comedy", "Action|Drama", "Horror"],
+    }
+)
+# Movie 40 is only rated in the test split, and movie 30 only once, below the
+# frequency threshold.
+TRAIN_RATINGS = pd.DataFrame(
+    {
+        "userId": [1, 1, 2, 2, 3, 3],
+        "movieId": [10, 20, 10, 20, 10, 30],
+        "rating": [5.0, 2.0, 4.0, 3.0, 1.0, 5.0],
+    }
+)
+TEST_RATINGS = pd.DataFrame(
+    {
+        "userId": [1, 4, 2, 3],
+        "movieId": [20, 10, 40, 30],
+        "rating": [4.0, 5.0, 3.0, 2.0],
+    }
+)
+FREQ_THRESHOLD = 2
+
+
+def decode(workflow_dir, transformed):
+    # Maps the encoded ids back to raw values, as the encodings can differ.
+    # Unknown ids decode to None, and unknown genres are left out.
+    vocabularies = {
+        feature_name: categories.read_categories(workflow_dir, feature_name)
+        for feature_name in ["userId", "movieId", "genres"]
+    }
+    decoded = {
+        feature_name: [
+            vocabularies[feature_name][index] if index else None
+            for index in np.asarray(transformed[feature_name], dtype=np.int64)
+        ]
+        for feature_name in ["userId", "movieId"]
+    }
+    decoded["genres"] = [
+        sorted(vocabularies["genres"][index] for index in genres if index)
+        for genres in transformed["genres"]
+    ]
+    decoded["rating"] = np.asarray(transformed["rating"]).tolist()
+    return decoded
+
+
+def fit_cpu_workflow(workflow_dir):
+    workflow = cpu_workflow.CpuWorkflow(MOVIES, freq_threshold=FREQ_THRESHOLD).fit(
+        TRAIN_RATINGS
+    )
+    workflow.save(workflow_dir)
+    return workflow
+
+
+def test_vocabularies_are_ordered_by_frequency(tmp_path):
+    workflow = fit_cpu_workflow(str(tmp_path))
+    assert workflow.vocabularies["userId"].tolist() == [1, 2, 3]
+    assert workflow.vocabularies["movieId"].tolist() == [10, 20]
+    assert workflow.vocabularies["genres"].tolist() == ["Comedy", "Drama", "Action"]
+
+
+def test_movies_outside_the_vocabulary_get_no_genres(tmp_path):
+    workflow_dir = str(tmp_path)
+    transformed = fit_cpu_workflow(workflow_dir).transform(TEST_RATINGS)
+    decoded = decode(workflow_dir, transformed.to_pydict())
+    assert decoded["movieId"] == [20, 10, None, None]
+    assert decoded["genres"] == [["Comedy"], ["Comedy", "Drama"], [], []]
+    assert decoded["rating"] == [1, 1, 0, 0]
+
+
+class FakeDataset:
+    # The to_ddf() of an NVTabular dataset.
+
+    def __init__(self, dataframe, npartitions):
+        self.dataframe = dataframe
+        self.npartitions = npartitions
+
+    def to_ddf(self):
+        import dask.dataframe
+
+        return dask.dataframe.from_pandas(self.dataframe, npartitions=self.npartitions)
+
+
+def test_transform_partitions_with_the_loaded_categories(tmp_path):
+    pytest.importorskip("dask.dataframe")
+
+    workflow_dir = str(tmp_path)
+    expected = fit_cpu_workflow(workflow_dir).transform(TEST_RATINGS)
+    encoder = cpu_workflow.CpuWorkflow.from_categories(workflow_dir)
+    transformed = list(
+        cpu_workflow.transform_partitions(
+            encoder, FakeDataset(TEST_RATINGS, 2), NullProfiler(), "transform_test"
+        )
+    )
+    assert len(transformed) == 2
+    assert pa.concat_tables(transformed).equals(expected)
+
+
+def test_parity_with_the_nvtabular_workflow(tmp_path):
+    nvt = pytest.importorskip("nvtabular")
+
+    cpu_dir, nvt_dir = str(tmp_path / "cpu"), str(tmp_path / "nvt")
+    cpu_transformed = fit_cpu_workflow(cpu_dir).transform(TEST_RATINGS).to_pydict()
+
+    # The NVTabular ETL fits the workflow, and encodes the splits with its
+    # vocabularies and movie features table.
+    nvt_workflow = etl.create_workflow(
+        etl.prep_dataframe(MOVIES.copy()), FREQ_THRESHOLD
+    )
+    nvt_workflow.fit(nvt.Dataset(TRAIN_RATINGS, cpu=True))
+    nvt_workflow.save(nvt_dir)
+    MovieFeatureTable.from_workflow_categories(nvt_dir, MOVIES).save(nvt_dir)
+    nvt_transformed = (
+        cpu_workflow.CpuWorkflow.from_categories(nvt_dir)
+        .transform(TEST_RATINGS)
+        .to_pydict()
+    )
+    assert decode(cpu_dir, cpu_transformed) == decode(nvt_dir, nvt_transformed)
+
+    # The workflow that Triton runs joins the genres of the movies outside the
+    # vocabulary on the raw movie id, so movie 30 keeps them there.
+    served = (
+        nvt_workflow.transform(nvt.Dataset(TEST_RATINGS, cpu=True))
+        .to_ddf()
+        .compute()
+        .reset_index(drop=True)
+    )
+    served_decoded = decode(nvt_dir, served)
+    assert served_decoded["genres"][:2] == decode(cpu_dir, cpu_transformed)["genres"][:2]
+    assert served_decoded["genres"][3] == ["Action", "Drama"]
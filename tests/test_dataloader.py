@@ -0,0 +1,202 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the CPU loader and the shard cache, on local files."""
+
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.common import multihot  # noqa: E402
+from src.model_training import dataloader  # noqa: E402
+
+FILE_ROWS = [7, 5, 9, 3]
+BATCH_SIZE = 4
+
+
+@pytest.fixture
+def data_files(tmp_path):
+    data_files, start = [], 0
+    for file_index, num_rows in enumerate(FILE_ROWS):
+        rows = np.arange(start, start + num_rows)
+        start += num_rows
+        table = pa.table(
+            {
+                "userId": rows,
+                "movieId": rows * 10,
+                "genres": multihot.to_list_array(
+                    np.repeat(rows, 2),
+                    multihot.lengths_to_offsets(np.full(num_rows, 2)),
+                ),
+                "rating": rows.astype(np.float32),
+            }
+        )
+        data_file = str(tmp_path / f"part_{file_index}.parquet")
+        pq.write_table(table, data_file)
+        data_files.append(data_file)
+    return data_files
+
+
+def get_rows(batches):
+    return [batch["userId"].reshape(-1).tolist() for batch, _ in batches]
+
+
+def test_cpu_loader_reads_every_row_once_per_epoch(data_files):
+    loader = dataloader.CpuParquetLoader(data_files, BATCH_SIZE, shuffle=True)
+    assert len(loader) == sum(-(-num_rows // BATCH_SIZE) for num_rows in FILE_ROWS)
+    first_epoch = get_rows(loader)
+    assert sorted(sum(first_epoch, [])) == list(range(sum(FILE_ROWS)))
+    loader.on_epoch_end()
+    assert get_rows(loader) != first_epoch
+
+
+def test_cpu_loader_batches_follow_their_index(data_files):
+    loader = dataloader.CpuParquetLoader(data_files, BATCH_SIZE, shuffle=True)
+    batches = get_rows(loader)
+    # Keras peeks at the first batch before the epoch starts.
+    loader[0]
+    assert get_rows(loader[index] for index in range(len(loader))) == batches
+    assert get_rows([loader[3], loader[1]]) == [batches[3], batches[1]]
+    batch, labels = loader[2]
+    np.testing.assert_array_equal(batch["movieId"], batch["userId"] * 10)
+    np.testing.assert_array_equal(
+        batch["genres"][1], np.full((len(batch["userId"]), 1), 2)
+    )
+    np.testing.assert_array_equal(labels.reshape(-1), batch["userId"].reshape(-1))
+
+
+@pytest.mark.parametrize("num_batches", [0, 1, 3, 5])
+def test_cpu_loader_resumes_an_epoch_at_a_batch(data_files, num_batches):
+    loader = dataloader.CpuParquetLoader(data_files, BATCH_SIZE, shuffle=True)
+    loader.on_epoch_end()
+    second_epoch = get_rows(loader)
+
+    # A restarted job resumes the second epoch after the batches trained on.
+    resumed_loader = dataloader.CpuParquetLoader(data_files, BATCH_SIZE, shuffle=True)
+    assert dataloader.seek(resumed_loader, 1, num_batches) == (
+        num_batches,
+        len(second_epoch) - num_batches,
+    )
+    assert get_rows(resumed_loader) == second_epoch[num_batches:]
+    resumed_loader.on_epoch_end()
+    assert len(resumed_loader) == len(second_epoch)
+
+
+def test_shard_cache_evicts_read_shards(data_files, tmp_path):
+    sizes = [os.path.getsize(data_file) for data_file in data_files]
+    cache_dir = str(tmp_path / "cache")
+    shard_cache = dataloader.ShardCache(
+        data_files, cache_dir, max_cache_bytes=max(sizes) * 2
+    ).start()
+    try:
+        for _ in range(2):
+            loader = dataloader.CpuParquetLoader(
+                data_files, BATCH_SIZE, shuffle=False, shard_cache=shard_cache
+            )
+            assert sorted(sum(get_rows(loader), [])) == list(range(sum(FILE_ROWS)))
+            cached_files = os.listdir(cache_dir)
+            assert 0 < len(cached_files) <= 2
+            assert sum(
+                os.path.getsize(os.path.join(cache_dir, file_name))
+                for file_name in cached_files
+            ) <= max(sizes) * 2
+    finally:
+        shard_cache.close()
+    assert not os.path.exists(cache_dir)
+
+
+class FakeGpuLoader:
+    # Batches of the files of a group, in order, like KerasSequenceLoader.
+
+    def __init__(self, data_files, batch_size, shuffle, **kwargs):
+        self.data_files = data_files
+        rows = np.concatenate(
+            [
+                pq.read_table(data_file)["userId"].to_pandas().values
+                for data_file in data_files
+            ]
+        )
+        self.batches = [
+            ({"userId": rows[start : start + batch_size].reshape(-1, 1)}, None)
+            for start in range(0, len(rows), batch_size)
+        ]
+        self.is_stopped = False
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def stop(self):
+        self.is_stopped = True
+
+
+def test_shard_group_loader_opens_cached_groups(data_files, tmp_path, monkeypatch):
+    created_loaders = []
+
+    def create_gpu_loader(data_files, batch_size, shuffle, **kwargs):
+        created_loaders.append(FakeGpuLoader(data_files, batch_size, shuffle))
+        return created_loaders[-1]
+
+    monkeypatch.setattr(dataloader, "create_gpu_loader", create_gpu_loader)
+    cache_dir = str(tmp_path / "cache")
+    shard_cache = dataloader.ShardCache(data_files, cache_dir).start()
+    try:
+        loader = dataloader.ShardGroupLoader(
+            data_files, BATCH_SIZE, True, shard_cache, group_size=2
+        )
+        loader[0]
+        rows = get_rows(loader)
+        loader.on_epoch_end()
+    finally:
+        shard_cache.close()
+    assert len(rows) == len(loader)
+    assert sorted(sum(rows, [])) == list(range(sum(FILE_ROWS)))
+    assert len(created_loaders) == 2
+    for created_loader in created_loaders:
+        assert created_loader.is_stopped
+        assert all(
+            os.path.dirname(data_file) == cache_dir
+            for data_file in created_loader.data_files
+        )
+
+
+def test_shard_group_loader_resumes_at_the_group_of_a_batch(
+    data_files, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(dataloader, "create_gpu_loader", FakeGpuLoader)
+    shard_cache = dataloader.ShardCache(data_files, str(tmp_path / "cache")).start()
+    try:
+        loader = dataloader.ShardGroupLoader(
+            data_files, BATCH_SIZE, True, shard_cache, group_size=2
+        )
+        num_batches = len(loader)
+        first_group_batches = loader._get_num_batches(loader._get_groups()[0])
+        # A batch inside the second group resumes at its first batch.
+        assert dataloader.seek(loader, 0, first_group_batches + 1) == (
+            first_group_batches,
+            num_batches - first_group_batches,
+        )
+        loader[0]
+        rows = get_rows(loader)
+        second_group = loader._get_groups()[1]
+    finally:
+        shard_cache.close()
+    group_rows = [
+        pq.read_table(data_file)["userId"].to_pylist() for data_file in second_group
+    ]
+    assert len(rows) == num_batches - first_group_batches
+    assert sorted(sum(rows, [])) == sorted(sum(group_rows, []))
@@ -0,0 +1,145 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the splits and the incremental runs of the ETL, on the pandas backend."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.common import categories  # noqa: E402
+from src.data_preprocessing import etl  # noqa: E402
+
+
+def create_ratings(num_rows=20000, seed=0):
+    random_state = np.random.RandomState(seed)
+    return pd.DataFrame(
+        {
+            "userId": random_state.randint(1, 1000, num_rows),
+            "movieId": random_state.randint(1, 5000, num_rows),
+            "rating": random_state.rand(num_rows) * 5,
+            "timestamp": random_state.randint(0, 10 ** 9, num_rows),
+        }
+    )
+
+
+def test_test_mask_size():
+    ratings = create_ratings()
+    is_test = etl.get_test_mask(ratings, 0.2)
+    assert abs(is_test.mean() - 0.2) < 0.02
+    assert not etl.get_test_mask(ratings, 0.0).any()
+    assert etl.get_test_mask(ratings, 1.0).all()
+
+
+def test_test_mask_only_depends_on_the_row():
+    # Chunked and incremental runs split each block on its own, so a rating
+    # must land in the same split whatever block and position it is in.
+    ratings = create_ratings()
+    is_test = etl.get_test_mask(ratings, 0.2)
+    order = np.random.RandomState(1).permutation(len(ratings))
+    np.testing.assert_array_equal(
+        etl.get_test_mask(ratings.iloc[order], 0.2), is_test[order]
+    )
+    np.testing.assert_array_equal(
+        etl.get_test_mask(ratings.iloc[:100], 0.2), is_test[:100]
+    )
+
+
+def test_hash_split_partitions_the_rows():
+    ratings = create_ratings()
+    train, test = etl.split_dataframe(ratings, 0.2, method="hash")
+    assert len(train) + len(test) == len(ratings)
+    assert not set(train.index) & set(test.index)
+
+
+def test_time_holdout_split_holds_out_the_latest_ratings():
+    ratings = create_ratings()
+    train, test = etl.split_dataframe(ratings, 0.2, method="time")
+    assert len(train) + len(test) == len(ratings)
+    latest_train = train.groupby("userId")["timestamp"].max()
+    earliest_test = test.groupby("userId")["timestamp"].min()
+    users = earliest_test.index
+    assert (latest_train[users] <= earliest_test[users]).all()
+    num_test = test.groupby("userId").size()
+    num_ratings = ratings.groupby("userId").size()[users]
+    np.testing.assert_array_equal(num_test, np.floor(num_ratings * 0.2))
+
+
+def test_invalid_split_method():
+    with pytest.raises(ValueError):
+        etl.split_dataframe(create_ratings(100), 0.2, method="random")
+
+
+def test_watermark_keeps_late_ratings_of_the_watermark_second():
+    processed = pd.DataFrame(
+        {"userId": [1, 2, 3], "movieId": [10, 20, 30], "timestamp": [5, 9, 9]}
+    )
+    watermark = etl.Watermark()
+    watermark.update(processed.iloc[:2])
+    watermark.update(processed.iloc[2:])
+    assert watermark.timestamp == 9
+    assert watermark.keys == {(2, 20), (3, 30)}
+
+    late = pd.DataFrame(
+        {"userId": [4, 5, 6], "movieId": [40, 50, 60], "timestamp": [8, 9, 12]}
+    )
+    ratings = pd.concat([processed, late], ignore_index=True)
+    new_ratings = watermark.drop_processed(watermark.filter(ratings))
+    assert new_ratings["userId"].tolist() == [5, 6]
+
+    restored = etl.Watermark.from_state(watermark.to_state())
+    assert (restored.timestamp, restored.keys) == (9, watermark.keys)
+
+
+def test_watermark_without_keys_only_keeps_later_ratings():
+    ratings = pd.DataFrame(
+        {"userId": [1, 2], "movieId": [10, 20], "timestamp": [9, 10]}
+    )
+    watermark = etl.Watermark.from_state({"watermark": 9})
+    assert watermark.drop_processed(watermark.filter(ratings))["userId"].tolist() == [
+        2
+    ]
+
+
+def test_extend_workflow_categories_keeps_the_existing_encodings(tmp_path):
+    workflow_dir = str(tmp_path)
+    categories.write_categories(workflow_dir, "userId", np.array([1, 2]))
+    categories.write_categories(workflow_dir, "movieId", np.array([10, 20]))
+    categories.write_categories(workflow_dir, "genres", np.array(["Drama"]))
+
+    ratings = pd.DataFrame({"userId": [3, 2, 3, 4], "movieId": [30, 10, 30, 40]})
+    movies = pd.DataFrame({"movieId": [30], "genres": [["Comedy", "Drama"]]})
+    etl.extend_workflow_categories(workflow_dir, ratings, movies, freq_threshold=2)
+    assert categories.read_categories(workflow_dir, "userId")[1:].tolist() == [1, 2, 3]
+    assert categories.read_categories(workflow_dir, "movieId")[1:].tolist() == [
+        10,
+        20,
+        30,
+    ]
+    assert categories.read_categories(workflow_dir, "genres")[1:].tolist() == [
+        "Drama",
+        "Comedy",
+    ]
+
+    # The counts of the rare values carry over to the next runs.
+    etl.extend_workflow_categories(
+        workflow_dir, ratings.iloc[3:], movies.iloc[:0], freq_threshold=2
+    )
+    assert categories.read_categories(workflow_dir, "userId")[1:].tolist() == [
+        1,
+        2,
+        3,
+        4,
+    ]
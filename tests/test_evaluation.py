@@ -0,0 +1,166 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the ranking metrics and the streaming evaluation, on local files."""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from src.common import multihot  # noqa: E402
+from src.common.movie_features import MovieFeatureTable  # noqa: E402
+from src.model_training import evaluation  # noqa: E402
+
+# The known movies are encoded as 1..NUM_MOVIES, and row 0 of the movie
+# features table is the unknown movie.
+NUM_MOVIES = 6
+KEY_BASE = NUM_MOVIES + 2
+
+
+class FakeModel:
+    # Scores a movie by its encoded id, whatever the user.
+
+    def __call__(self, inputs, training=False):
+        return tf.constant(inputs["movieId"].astype(np.float32) / 10)
+
+
+@pytest.fixture
+def movie_features():
+    return MovieFeatureTable(
+        np.zeros(0, dtype=np.int64), np.zeros(NUM_MOVIES + 2, dtype=np.int64)
+    )
+
+
+def write_ratings(path, user_ids, movie_ids, ratings):
+    pq.write_table(
+        pa.table(
+            {
+                "userId": np.array(user_ids, dtype=np.int64),
+                "movieId": np.array(movie_ids, dtype=np.int64),
+                "genres": multihot.to_list_array(
+                    np.zeros(0, dtype=np.int64),
+                    multihot.lengths_to_offsets(np.zeros(len(user_ids))),
+                ),
+                "rating": np.array(ratings, dtype=np.float32),
+            }
+        ),
+        path,
+    )
+    return path
+
+
+def test_hit_rate_and_ndcg_of_known_ranks():
+    metrics = evaluation.RankingMetrics(top_k=3)
+    metrics.update_ranks(np.array([0, 2]))
+    metrics.update_ranks(np.array([3, 5]))
+    result = metrics.result()
+    assert result["hr@3"] == pytest.approx(0.5)
+    assert result["ndcg@3"] == pytest.approx((1 + 1 / np.log2(4)) / 4)
+    assert result["ranked_positives"] == 4
+
+
+@pytest.mark.parametrize(
+    "predictions, labels, expected_auc",
+    [
+        ([0.1, 0.2, 0.7, 0.9], [0, 0, 1, 1], 1.0),
+        ([0.1, 0.2, 0.7, 0.9], [1, 1, 0, 0], 0.0),
+        ([0.1, 0.2, 0.7, 0.9], [0, 1, 0, 1], 0.75),
+        # Predictions in the same bin are tied.
+        ([0.5, 0.5], [0, 1], 0.5),
+        ([0.1, 0.9], [1, 1], None),
+    ],
+)
+def test_auc_of_known_predictions(predictions, labels, expected_auc):
+    metrics = evaluation.RankingMetrics()
+    metrics.update_predictions(np.array(predictions), np.array(labels, dtype=float))
+    result = metrics.result()
+    assert result["auc"] == pytest.approx(expected_auc)
+    assert result["rows"] == len(labels)
+
+
+def test_rated_items_without_keys():
+    rated_items = evaluation.RatedItems(np.zeros(0, dtype=np.int64), KEY_BASE)
+    assert not rated_items.contains(np.array([1, 2]), np.array([3, 4])).any()
+    assert len(rated_items.movies(1)) == 0
+
+
+def test_rated_items_of_a_block_of_users(tmp_path):
+    data_files = [
+        write_ratings(str(tmp_path / "train.parquet"), [1, 2, 3], [1, 2, 3], [1] * 3),
+        write_ratings(str(tmp_path / "test.parquet"), [3, 4, 3], [4, 5, 1], [1] * 3),
+    ]
+    rated_items = evaluation.RatedItems.from_files(
+        data_files, KEY_BASE, num_blocks=2, block=1
+    )
+    assert rated_items.movies(1).tolist() == [1]
+    assert rated_items.movies(3).tolist() == [1, 3, 4]
+    assert len(rated_items.movies(2)) == 0
+    is_rated = rated_items.contains(np.array([3, 3, 2]), np.array([4, 5, 2]))
+    assert is_rated.tolist() == [True, False, False]
+    assert evaluation.get_num_blocks(data_files, max_keys=4) == 2
+
+
+def test_full_ranking_skips_the_rated_movies(movie_features):
+    # Movies 4..6 score above movie 3, and user 1 rated movie 5.
+    rated_items = evaluation.RatedItems(np.array([1 * KEY_BASE + 5]), KEY_BASE)
+    ranks = evaluation.rank_positives(
+        FakeModel(),
+        np.array([1, 2]),
+        np.array([3, 3]),
+        np.array([0.3, 0.3], dtype=np.float32),
+        movie_features,
+        "full",
+        num_negatives=None,
+        score_batch_size=4,
+        random_state=None,
+        rated_items=rated_items,
+    )
+    assert ranks.tolist() == [2, 3]
+
+
+def test_evaluation_by_blocks_of_users(tmp_path, movie_features):
+    test_files = [
+        write_ratings(
+            str(tmp_path / "test_0.parquet"), [1, 2, 3, 4], [6, 3, 5, 1], [1, 1, 0, 1]
+        ),
+        write_ratings(str(tmp_path / "test_1.parquet"), [5, 2], [2, 4], [1, 1]),
+    ]
+    train_files = [
+        write_ratings(str(tmp_path / "train.parquet"), [2, 5], [6, 3], [1, 1])
+    ]
+    results = [
+        evaluation.evaluate_ranking(
+            FakeModel(),
+            test_files,
+            movie_features,
+            candidates="full",
+            top_k=2,
+            batch_size=3,
+            score_batch_size=NUM_MOVIES,
+            train_data_files=train_files,
+            max_rated_keys=max_rated_keys,
+        )
+        for max_rated_keys in [evaluation.MAX_RATED_KEYS, 3]
+    ]
+    # The ranks of the positives, without the other movies the user rated:
+    # user 1 movie 6: 0; user 2 movie 3: 1 (movie 5); user 4 movie 1: 5; user 5
+    # movie 2: 3 (movies 4, 5 and 6); user 2 movie 4: 1 (movie 5).
+    assert results[0]["ranked_positives"] == 5
+    assert results[0]["hr@2"] == pytest.approx(3 / 5)
+    assert results[0]["ndcg@2"] == pytest.approx((1 + 2 / np.log2(3)) / 5)
+    for metric in ["hr@2", "ndcg@2", "auc", "expected_calibration_error"]:
+        assert results[1][metric] == pytest.approx(results[0][metric])
+    assert results[1]["rows"] == results[0]["rows"] == 6
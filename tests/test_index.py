@@ -0,0 +1,93 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the top-K search over item embeddings."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.retrieval import index  # noqa: E402
+
+
+@pytest.fixture
+def embeddings():
+    return np.random.RandomState(0).randn(500, 16).astype(np.float32)
+
+
+def test_top_k_matches_a_full_sort():
+    scores = np.random.RandomState(0).rand(10, 50).astype(np.float32)
+    positions, top_scores = index.top_k(scores, 5)
+    expected = np.argsort(-scores, axis=1)[:, :5]
+    np.testing.assert_array_equal(positions, expected)
+    np.testing.assert_array_equal(
+        top_scores, np.take_along_axis(scores, expected, axis=1)
+    )
+    assert index.top_k(scores, 100)[0].shape == (10, 50)
+
+
+def test_brute_force_index(embeddings):
+    ids = np.arange(1000, 1500)
+    brute_force_index = index.BruteForceIndex(embeddings, ids)
+    result_ids, result_scores = brute_force_index.search(embeddings[:3], k=4)
+    np.testing.assert_array_equal(result_ids[:, 0], ids[:3])
+    np.testing.assert_allclose(result_scores[:, 0], 1, rtol=1e-5)
+    assert (np.diff(result_scores, axis=1) <= 0).all()
+
+    exclude_rows = [np.array([0]), np.array([1]), np.array([], dtype=np.int64)]
+    result_ids, _ = brute_force_index.search(
+        embeddings[:3], k=4, exclude_rows=exclude_rows
+    )
+    assert 1000 not in result_ids[0]
+    assert 1001 not in result_ids[1]
+    assert result_ids[2, 0] == 1002
+
+
+def test_ivf_index_with_all_probes_matches_brute_force(embeddings):
+    ids = np.arange(500)
+    queries = np.random.RandomState(1).randn(20, 16)
+    expected_ids, expected_scores = index.BruteForceIndex(embeddings, ids).search(
+        queries, k=10
+    )
+    ivf_index = index.IVFIndex.build(embeddings, ids, num_lists=8, quantize=False)
+    result_ids, result_scores = ivf_index.search(queries, k=10, num_probes=8)
+    np.testing.assert_array_equal(result_ids, expected_ids)
+    np.testing.assert_allclose(result_scores, expected_scores, rtol=1e-5)
+
+
+def test_quantized_ivf_index_recall(embeddings):
+    ids = np.arange(500)
+    queries = np.random.RandomState(1).randn(20, 16)
+    expected_ids, _ = index.BruteForceIndex(embeddings, ids).search(queries, k=10)
+    ivf_index = index.IVFIndex.build(embeddings, ids, num_lists=8)
+    result_ids, _ = ivf_index.search(queries, k=10, num_probes=8)
+    recall = np.mean(
+        [
+            len(np.intersect1d(expected, result)) / 10
+            for expected, result in zip(expected_ids, result_ids)
+        ]
+    )
+    assert recall >= 0.9
+
+
+def test_ivf_index_save_and_load(embeddings, tmp_path):
+    ids = np.arange(500)
+    ivf_index = index.IVFIndex.build(embeddings, ids, num_lists=8)
+    ivf_index.save(str(tmp_path))
+    assert index.IVFIndex.exists(str(tmp_path))
+    loaded_index = index.IVFIndex.load(str(tmp_path))
+    queries = embeddings[:5]
+    np.testing.assert_array_equal(
+        loaded_index.search(queries, k=5)[0], ivf_index.search(queries, k=5)[0]
+    )
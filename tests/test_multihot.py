@@ -0,0 +1,78 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the CSR helpers of the multi-hot features."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.common import multihot
+
+
+def test_lengths_to_offsets():
+    np.testing.assert_array_equal(
+        multihot.lengths_to_offsets([2, 0, 3]), [0, 2, 2, 5]
+    )
+    np.testing.assert_array_equal(multihot.lengths_to_offsets([]), [0])
+
+
+@pytest.mark.parametrize(
+    "column",
+    [
+        pd.Series(["Drama|Comedy", "", None, "Action"]),
+        pd.Series([["Drama", "Comedy"], [], [], ["Action"]]),
+    ],
+)
+def test_split_multivalue(column):
+    tokens, offsets = multihot.split_multivalue(column)
+    assert list(tokens) == ["Drama", "Comedy", "Action"]
+    np.testing.assert_array_equal(offsets, [0, 2, 2, 2, 3])
+
+
+@pytest.mark.parametrize(
+    "column",
+    [
+        pd.Series([None, "Drama|Comedy", "Action"]),
+        pd.Series([np.nan, ["Drama", "Comedy"], ["Action"]]),
+    ],
+)
+def test_split_multivalue_with_null_first_row(column):
+    tokens, offsets = multihot.split_multivalue(column)
+    assert list(tokens) == ["Drama", "Comedy", "Action"]
+    np.testing.assert_array_equal(offsets, [0, 0, 2, 3])
+
+
+def test_encode_tokens_encodes_unknown_tokens_as_zero():
+    encoded = multihot.encode_tokens(
+        np.array(["Comedy", "Western", "Drama"]), ["Drama", "Comedy"]
+    )
+    np.testing.assert_array_equal(encoded, [2, 0, 1])
+
+
+def test_gather_rows():
+    values = np.array([10, 11, 20, 21, 22])
+    offsets = np.array([0, 2, 2, 5])
+    gathered, nnzs = multihot.gather_rows(values, offsets, [2, -1, 1, 0])
+    np.testing.assert_array_equal(gathered, [20, 21, 22, 10, 11])
+    np.testing.assert_array_equal(nnzs, [3, 0, 0, 2])
+
+
+def test_to_list_array():
+    values = np.array([10, 11, 20])
+    offsets = multihot.lengths_to_offsets([2, 0, 1])
+    assert multihot.to_list_array(values, offsets).to_pylist() == [
+        [10, 11],
+        [],
+        [20],
+    ]
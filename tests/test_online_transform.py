@@ -0,0 +1,95 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the online transform against the CPU transform workflow."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.data_preprocessing import cpu_workflow  # noqa: E402
+from src.serving.online_transform import CategoryLookup, OnlineTransform  # noqa: E402
+
+
+@pytest.fixture
+def transform_workflow():
+    random_state = np.random.RandomState(0)
+    genres = ["Action", "Comedy", "Drama", "Horror", "Western"]
+    movies = pd.DataFrame(
+        {
+            "movieId": np.arange(1, 101) * 3,
+            "title": "",
+            "genres": [
+                "|".join(
+                    random_state.choice(genres, random_state.randint(0, 4), False)
+                )
+                for _ in range(100)
+            ],
+        }
+    )
+    ratings = pd.DataFrame(
+        {
+            "userId": random_state.randint(1, 300, 5000) * 1000003,
+            "movieId": random_state.choice(movies["movieId"].values, 5000),
+            "rating": random_state.rand(5000) * 5,
+        }
+    )
+    return cpu_workflow.CpuWorkflow(movies).fit(ratings)
+
+
+@pytest.mark.parametrize("max_dense_lookup_ratio", [0, 1000])
+def test_category_lookup(max_dense_lookup_ratio):
+    vocabulary = np.array([7, 3, 12, 5])
+    lookup = CategoryLookup.build(vocabulary, max_dense_lookup_ratio)
+    assert lookup.is_dense == bool(max_dense_lookup_ratio)
+    encoded = lookup.encode([3, 12, 4, -1, 100, 7, 5, 3])
+    np.testing.assert_array_equal(encoded, [2, 3, 0, 0, 0, 1, 4, 2])
+
+
+def test_category_lookup_to_and_from_arrays():
+    for vocabulary in [np.array([2, 0, 1]), np.array([10 ** 12, -5])]:
+        lookup = CategoryLookup.build(vocabulary)
+        loaded_lookup = CategoryLookup.from_arrays(lookup.to_arrays("x__"), "x__")
+        raw_ids = np.concatenate([vocabulary, [3, -7]])
+        np.testing.assert_array_equal(
+            loaded_lookup.encode(raw_ids), lookup.encode(raw_ids)
+        )
+
+
+def test_online_transform_matches_the_workflow(transform_workflow, tmp_path):
+    random_state = np.random.RandomState(1)
+    requests = pd.DataFrame(
+        {
+            "userId": np.append(
+                random_state.choice(transform_workflow.vocabularies["userId"], 99),
+                -1,
+            ),
+            "movieId": np.append(
+                random_state.choice(transform_workflow.vocabularies["movieId"], 99),
+                4,
+            ),
+            "rating": np.zeros(100),
+        }
+    )
+    expected = transform_workflow.transform_arrays(requests)
+
+    transform_workflow.save(str(tmp_path / "workflow"))
+    online_transform = OnlineTransform.from_workflow_dir(str(tmp_path / "workflow"))
+    online_transform.save(str(tmp_path / "online"))
+    for transform in [online_transform, OnlineTransform.load(str(tmp_path / "online"))]:
+        actual = transform.transform_arrays(requests["userId"], requests["movieId"])
+        for name in ["userId", "movieId", "genres__values", "genres__nnzs"]:
+            np.testing.assert_array_equal(actual[name], expected[name])
+    assert actual["userId"][-1] == 0 and actual["movieId"][-1] == 0
@@ -0,0 +1,111 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the sparse embedding optimizers, against the dense Keras ones."""
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from src.model_training import optimizers  # noqa: E402
+
+NUM_ROWS, DIMENSION = 6, 3
+# Row 1 is looked up twice, rows 0, 2 and 5 never.
+INDICES = [1, 3, 1, 4]
+NUM_STEPS = 3
+LEARNING_RATE = 0.1
+
+
+def create_table():
+    return tf.Variable(
+        np.arange(NUM_ROWS * DIMENSION, dtype=np.float32).reshape(NUM_ROWS, DIMENSION)
+        / 10,
+        name="embedding_weights",
+    )
+
+
+def get_weights(num_columns):
+    # The weights of the looked up rows in the loss, constant across a row
+    # when num_columns is 1.
+    weights = np.linspace(-1.0, 2.0, len(INDICES) * num_columns, dtype=np.float32)
+    return tf.constant(weights.reshape(len(INDICES), num_columns))
+
+
+def train(optimizer, weights, dense):
+    table = create_table()
+    for _ in range(NUM_STEPS):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(tf.gather(table, INDICES) * weights)
+        gradient = tape.gradient(loss, table)
+        assert isinstance(gradient, tf.IndexedSlices)
+        if dense:
+            gradient = tf.convert_to_tensor(gradient)
+        optimizer.apply_gradients([(gradient, table)])
+    return table.numpy()
+
+
+def assert_touched_rows_match(table, expected_table):
+    touched = sorted(set(INDICES))
+    untouched = sorted(set(range(NUM_ROWS)) - set(touched))
+    np.testing.assert_allclose(table[touched], expected_table[touched], rtol=1e-5)
+    np.testing.assert_array_equal(table[untouched], create_table().numpy()[untouched])
+
+
+def test_lazy_adam_matches_adam_on_the_touched_rows():
+    weights = get_weights(DIMENSION)
+    table = train(
+        optimizers.EmbeddingAdam(LEARNING_RATE, "lazy_adam"), weights, dense=False
+    )
+    expected_table = train(
+        tf.keras.optimizers.Adam(LEARNING_RATE), weights, dense=True
+    )
+    assert_touched_rows_match(table, expected_table)
+
+
+def test_rowwise_adagrad_matches_adagrad_on_the_touched_rows():
+    # With gradients constant across a row, the mean of the squared gradients
+    # of the row is the squared gradient of each of its elements.
+    weights = get_weights(1)
+    optimizer = optimizers.EmbeddingAdam(LEARNING_RATE, "rowwise_adagrad")
+    table = train(optimizer, weights, dense=False)
+    expected_table = train(
+        tf.keras.optimizers.Adagrad(
+            LEARNING_RATE,
+            initial_accumulator_value=optimizers.INITIAL_ACCUMULATOR_VALUE,
+            epsilon=optimizer.epsilon,
+        ),
+        weights,
+        dense=True,
+    )
+    assert_touched_rows_match(table, expected_table)
+
+
+@pytest.mark.parametrize("dense", [False, True])
+def test_rowwise_adagrad_keeps_one_accumulator_per_row(dense):
+    optimizer = optimizers.EmbeddingAdam(LEARNING_RATE, "rowwise_adagrad")
+    table = create_table()
+    with tf.GradientTape() as tape:
+        loss = tf.reduce_sum(tf.gather(table, INDICES) * get_weights(DIMENSION))
+    gradient = tape.gradient(loss, table)
+    if dense:
+        gradient = tf.convert_to_tensor(gradient)
+    optimizer.apply_gradients([(gradient, table)])
+
+    accumulator = optimizer.get_slot(table, "accumulator").numpy()
+    assert accumulator.shape == (NUM_ROWS, 1)
+    expected_accumulator = optimizers.INITIAL_ACCUMULATOR_VALUE + np.mean(
+        np.square(tf.convert_to_tensor(gradient).numpy()), axis=1, keepdims=True
+    )
+    np.testing.assert_allclose(accumulator, expected_accumulator, rtol=1e-6)
+    assert optimizers.get_slot_bytes(optimizer, [table]) == (NUM_ROWS * 4, 0)
@@ -0,0 +1,79 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the parquet cache of the raw CSV files, on the pandas backend."""
+
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("dask.dataframe")
+
+from src.data_preprocessing import etl, raw_cache  # noqa: E402
+
+MOVIES = pd.DataFrame(
+    {
+        "movieId": [1, 2, 3],
+        "title": ["A", "B", "C"],
+        "genres": [None, "Drama|Comedy", "Action"],
+    }
+)
+
+
+@pytest.fixture
+def movies_csv(tmp_path):
+    movies_csv = str(tmp_path / "movies.csv")
+    MOVIES.to_csv(movies_csv, index=False)
+    return movies_csv
+
+
+def read_movies(movies_csv, cache_dir):
+    return etl.prep_dataframe(etl.read_raw(movies_csv, "cpu", cache_dir=cache_dir))
+
+
+def test_cache_is_reused_while_the_source_is_unchanged(movies_csv, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    movies = read_movies(movies_csv, cache_dir)
+    assert raw_cache.is_cache_valid(movies_csv, cache_dir)
+    assert [list(genres) for genres in movies["genres"].iloc[1:]] == [
+        ["Drama", "Comedy"],
+        ["Action"],
+    ]
+
+    data_dir, _ = raw_cache.get_cache_paths(movies_csv, cache_dir)
+    cached_files = os.listdir(data_dir)
+    mtimes = [os.path.getmtime(os.path.join(data_dir, name)) for name in cached_files]
+    read_movies(movies_csv, cache_dir)
+    assert [
+        os.path.getmtime(os.path.join(data_dir, name)) for name in cached_files
+    ] == mtimes
+
+
+def test_cache_is_rebuilt_when_the_source_changes(movies_csv, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    read_movies(movies_csv, cache_dir)
+    MOVIES.iloc[1:].to_csv(movies_csv, index=False)
+    assert not raw_cache.is_cache_valid(movies_csv, cache_dir)
+    assert read_movies(movies_csv, cache_dir)["movieId"].tolist() == [2, 3]
+    assert raw_cache.is_cache_valid(movies_csv, cache_dir)
+
+
+def test_interrupted_conversion_is_redone(movies_csv, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    read_movies(movies_csv, cache_dir)
+    _, metadata_file = raw_cache.get_cache_paths(movies_csv, cache_dir)
+    os.remove(metadata_file)
+    assert not raw_cache.is_cache_valid(movies_csv, cache_dir)
+    assert read_movies(movies_csv, cache_dir)["movieId"].tolist() == [1, 2, 3]
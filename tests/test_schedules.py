@@ -0,0 +1,109 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the learning rate scaling and schedules."""
+
+import math
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.model_training import schedules, trainer  # noqa: E402
+
+
+def get_learning_rates(schedule, steps):
+    return np.array([float(schedule(step)) for step in steps])
+
+
+@pytest.mark.parametrize(
+    "scaling, expected", [("none", 0.001), ("linear", 0.004), ("sqrt", 0.002)]
+)
+def test_scale_learning_rate(scaling, expected):
+    assert schedules.scale_learning_rate(0.001, 8192, 2048, scaling) == pytest.approx(
+        expected
+    )
+
+
+def test_invalid_scaling():
+    with pytest.raises(ValueError):
+        schedules.scale_learning_rate(0.001, 8192, 2048, "log")
+
+
+def test_warmup_ramps_up_to_the_peak():
+    schedule = schedules.WarmupDecaySchedule(0.1, warmup_steps=4)
+    np.testing.assert_allclose(
+        get_learning_rates(schedule, range(6)),
+        [0.025, 0.05, 0.075, 0.1, 0.1, 0.1],
+        rtol=1e-6,
+    )
+
+
+def test_linear_decay_after_the_warmup():
+    schedule = schedules.WarmupDecaySchedule(
+        0.1, warmup_steps=2, decay="linear", decay_steps=4
+    )
+    np.testing.assert_allclose(
+        get_learning_rates(schedule, range(8)),
+        [0.05, 0.1, 0.1, 0.075, 0.05, 0.025, 0.0, 0.0],
+        rtol=1e-6,
+        atol=1e-8,
+    )
+
+
+def test_cosine_decay():
+    schedule = schedules.WarmupDecaySchedule(0.1, decay="cosine", decay_steps=4)
+    np.testing.assert_allclose(
+        get_learning_rates(schedule, range(6)),
+        [0.1 * 0.5 * (1 + math.cos(math.pi * step / 4)) for step in range(4)]
+        + [0.0, 0.0],
+        rtol=1e-6,
+        atol=1e-8,
+    )
+
+
+def test_invalid_schedules():
+    with pytest.raises(ValueError):
+        schedules.WarmupDecaySchedule(0.1, decay="step", decay_steps=4)
+    with pytest.raises(ValueError):
+        schedules.WarmupDecaySchedule(0.1, decay="linear")
+
+
+def test_config_round_trip():
+    schedule = schedules.WarmupDecaySchedule(
+        0.1, warmup_steps=2, decay="cosine", decay_steps=4
+    )
+    restored = schedules.WarmupDecaySchedule.from_config(schedule.get_config())
+    np.testing.assert_allclose(
+        get_learning_rates(restored, range(8)), get_learning_rates(schedule, range(8))
+    )
+
+
+def test_decay_runs_to_the_end_of_training():
+    hyperparams = trainer.update_hyperparams(
+        {
+            "batch_size": 8192,
+            "lr_scaling": "linear",
+            "warmup_steps": 2,
+            "lr_decay": "linear",
+            "num_epochs": 2,
+        }
+    )
+    schedule = trainer.create_learning_rate(hyperparams, steps_per_epoch=5)
+    assert schedule.learning_rate == pytest.approx(
+        trainer.LEARNING_RATE * 8192 / trainer.BASE_BATCH_SIZE
+    )
+    assert schedule.decay_steps == 8
+    with pytest.raises(ValueError):
+        trainer.create_learning_rate(hyperparams)
@@ -0,0 +1,100 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the resumable directory transfers, on local paths."""
+
+import os
+
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.common import utils  # noqa: E402
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+def read_file(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    source_dir = str(tmp_path / "source")
+    write_file(os.path.join(source_dir, "a.bin"), b"a" * 10)
+    write_file(os.path.join(source_dir, "nested", "b.bin"), b"b" * 20)
+    return source_dir
+
+
+def test_upload_directory_copies_the_tree(source_dir, tmp_path):
+    destination_dir = str(tmp_path / "destination")
+    stats = utils.upload_directory(source_dir, destination_dir, num_workers=2)
+    assert (stats.files_copied, stats.files_skipped, stats.bytes_copied) == (2, 0, 30)
+    assert utils.list_files(destination_dir) == ["a.bin", "nested/b.bin"]
+    assert read_file(os.path.join(destination_dir, "nested", "b.bin")) == b"b" * 20
+
+
+def test_rerun_skips_matching_files(source_dir, tmp_path):
+    destination_dir = str(tmp_path / "destination")
+    utils.upload_directory(source_dir, destination_dir)
+    stats = utils.upload_directory(source_dir, destination_dir)
+    assert (stats.files_copied, stats.files_skipped) == (0, 2)
+
+
+def test_rerun_copies_changed_files_of_the_same_size(source_dir, tmp_path):
+    destination_dir = str(tmp_path / "destination")
+    utils.upload_directory(source_dir, destination_dir)
+    write_file(os.path.join(source_dir, "a.bin"), b"c" * 10)
+    stats = utils.upload_directory(source_dir, destination_dir)
+    assert (stats.files_copied, stats.files_skipped) == (1, 1)
+    assert read_file(os.path.join(destination_dir, "a.bin")) == b"c" * 10
+
+
+def test_rerun_resumes_a_failed_transfer(source_dir, tmp_path):
+    destination_dir = str(tmp_path / "destination")
+    file_pairs = [
+        (os.path.join(source_dir, path), os.path.join(destination_dir, path))
+        for path in ["a.bin", "nested/b.bin", "missing.bin"]
+    ]
+    with pytest.raises(RuntimeError):
+        utils.transfer_files(file_pairs)
+    write_file(os.path.join(source_dir, "missing.bin"), b"m")
+    stats = utils.transfer_files(file_pairs)
+    assert (stats.files_copied, stats.files_skipped) == (1, 2)
+
+
+def test_forced_transfer_replaces_a_matching_file(source_dir, tmp_path):
+    destination = str(tmp_path / "destination" / "a.bin")
+    write_file(destination, b"a" * 10)
+    source = os.path.join(source_dir, "a.bin")
+    assert utils.transfer_file(source, destination) == (False, 0)
+    assert utils.transfer_file(source, destination, force=True) == (True, 10)
+
+
+def test_parquet_round_trip_through_an_arrow_file(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+
+    path = str(tmp_path / "table.parquet")
+    table = pa.table({"userId": [1, 2, 3], "genres": [[1], [], [2, 3]]})
+    with utils.open_arrow_file(path, "wb") as file:
+        pq.write_table(table, file)
+    with utils.open_arrow_file(path) as file:
+        assert pq.ParquetFile(file).metadata.num_rows == 3
+    with utils.open_arrow_file(path) as file:
+        assert pq.read_table(file).equals(table)
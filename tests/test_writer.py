@@ -0,0 +1,156 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for the ETL shard writer, on local paths."""
+
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from src.data_preprocessing import writer  # noqa: E402
+
+
+def create_tables(table_sizes):
+    tables, start = [], 0
+    for table_size in table_sizes:
+        tables.append(pa.table({"row": np.arange(start, start + table_size)}))
+        start += table_size
+    return tables
+
+
+def get_rows(tables):
+    return np.concatenate([table.column("row").to_pandas().values for table in tables])
+
+
+def write(output_dir, table_sizes, **kwargs):
+    shard_writer = writer.ParquetShardWriter(output_dir, **kwargs)
+    shard_writer.write_splits({"train": (iter(create_tables(table_sizes)), False)})
+    return shard_writer.close()
+
+
+def list_shards(output_dir):
+    return sorted(
+        file_name
+        for file_name in os.listdir(os.path.join(output_dir, "train"))
+        if file_name.endswith(".parquet")
+    )
+
+
+def test_full_run_removes_the_shards_of_previous_runs(tmp_path):
+    output_dir = str(tmp_path)
+    write(output_dir, [3, 3, 3])
+    write(output_dir, [2], file_prefix="delta-1-", append=True)
+    assert len(list_shards(output_dir)) == 4
+
+    manifests = write(output_dir, [4])
+    assert list_shards(output_dir) == ["part_0.parquet"]
+    assert [shard["file"] for shard in manifests["train"]["shards"]] == [
+        "part_0.parquet"
+    ]
+
+
+def test_append_keeps_the_previous_shards(tmp_path):
+    output_dir = str(tmp_path)
+    write(output_dir, [3, 3])
+    manifests = write(output_dir, [2], file_prefix="delta-1-", append=True)
+    assert list_shards(output_dir) == [
+        "delta-1-part_0.parquet",
+        "part_0.parquet",
+        "part_1.parquet",
+    ]
+    assert manifests["train"]["num_rows"] == 8
+
+
+def test_get_shard_sizes():
+    assert writer.get_shard_sizes(10, 3) == [4, 3, 3]
+    assert writer.get_shard_sizes(2, 4) == [1, 1, 0, 0]
+
+
+def test_rebalance_keeps_the_rows_in_order():
+    tables = create_tables([5, 1, 7, 3])
+    shards = list(writer.rebalance(iter(tables), writer.get_shard_sizes(16, 3)))
+    assert [shard.num_rows for shard in shards] == [6, 5, 5]
+    np.testing.assert_array_equal(get_rows(shards), np.arange(16))
+
+
+def test_rebalance_yields_unexpected_rows_as_an_extra_shard():
+    shards = list(writer.rebalance(iter(create_tables([4, 4])), [3, 3]))
+    assert [shard.num_rows for shard in shards] == [3, 3, 2]
+    np.testing.assert_array_equal(get_rows(shards), np.arange(8))
+
+
+def test_manifest_lists_the_shards_by_index(tmp_path):
+    output_dir = str(tmp_path)
+    manifests = write(output_dir, [1] * 12)
+    write(output_dir, [1, 1], file_prefix="delta-1-", append=True)
+    manifest = writer.read_manifest(os.path.join(output_dir, "train"))
+    assert [shard["file"] for shard in manifest["shards"]] == [
+        shard["file"] for shard in manifests["train"]["shards"]
+    ] + ["delta-1-part_0.parquet", "delta-1-part_1.parquet"]
+    assert [shard["file"] for shard in manifests["train"]["shards"]] == [
+        f"part_{part_index}.parquet" for part_index in range(12)
+    ]
+
+
+def test_select_shards():
+    manifest = {
+        "shards": [{"file": f"part_{part_index}.parquet"} for part_index in range(3)]
+    }
+    assert writer.select_shards(manifest, ["part_2.parquet", "part_0.parquet"]) == [
+        {"file": "part_0.parquet"},
+        {"file": "part_2.parquet"},
+    ]
+
+
+def test_bucket_shuffle(tmp_path):
+    scratch_dir = os.path.join(str(tmp_path), "buckets")
+    tables = create_tables([300, 500, 200])
+    shuffled = list(writer.bucket_shuffle(iter(tables), 8, scratch_dir))
+    rows = get_rows(shuffled)
+    assert not np.array_equal(rows, np.arange(1000))
+    np.testing.assert_array_equal(np.sort(rows), np.arange(1000))
+    assert not os.path.exists(scratch_dir)
+
+
+def test_bucket_shuffle_is_seeded(tmp_path):
+    scratch_dir = os.path.join(str(tmp_path), "buckets")
+    first = get_rows(writer.bucket_shuffle(iter(create_tables([100])), 4, scratch_dir))
+    second = get_rows(
+        writer.bucket_shuffle(iter(create_tables([100])), 4, scratch_dir)
+    )
+    np.testing.assert_array_equal(first, second)
+
+
+def test_global_shuffle_writes_every_row_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    output_dir = str(tmp_path / "output")
+    shard_writer = writer.ParquetShardWriter(
+        output_dir, num_shards=3, global_shuffle=True
+    )
+    shard_writer.write_splits(
+        {"train": (iter(create_tables([40, 25, 35])), True, 100)}
+    )
+    manifests = shard_writer.close()
+    assert manifests["train"]["global_shuffle"]
+    assert [shard["rows"] for shard in manifests["train"]["shards"]] == [34, 33, 33]
+    rows = get_rows(
+        pq.read_table(os.path.join(output_dir, "train", shard["file"]))
+        for shard in manifests["train"]["shards"]
+    )
+    assert not np.array_equal(rows, np.arange(100))
+    np.testing.assert_array_equal(np.sort(rows), np.arange(100))